@@ -8,8 +8,12 @@ import time
 import csv
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
+from zoneinfo import ZoneInfo
 from dateutil.relativedelta import relativedelta, MO
 from calendar import monthrange
+import matplotlib
+matplotlib.use("Agg") # non-interactive backend, plots are only written to image files
 import matplotlib.pyplot as plt
 from matplotlib import dates as mpl_dates
 import seaborn as sns
@@ -18,6 +22,26 @@ import seaborn as sns
 #import plotly.express as px
 #import chart_studio.tools as tls
 import os
+try:
+    import pyarrow # optional, faster parsing of the trend csv downloads
+    trend_csv_engine = "pyarrow"
+except ImportError:
+    trend_csv_engine = "c"
+import sqlite3
+import pickle
+import shutil
+import traceback
+import threading
+import tempfile
+import difflib
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import closing, contextmanager, nullcontext
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
 # DESCRIPTION
 # Script interacts with Swagger api using the user's api token based on admin crendentials.
@@ -35,6 +59,9 @@ import os
 #        report_month_yr (used for document titles)
 # 3. Verify the desired measurement points in the mps list. 
 # 4. Run this script from Anaconda prompt for best results.  Most libraries are built into Anaconda.
+# 5. Optionally set fast_report = True to build the conclusions from the server-side aggregates 
+#    and skip the minute trend downloads wherever those aggregates already answer the metric.
+# 6. To report on several accounts with their own api tokens, list them in api_accounts (section 21) instead.
 
 
 # 1. API login credentials and base url
@@ -52,60 +79,30 @@ report_month_yr = "May 2021"
 # Variables
 newline = '\n' # used in text file output for new lines
 
-# All trend variables below assign readable names to the firmware names based on the "20200525 Channels Definition.xlsx" file
-L1_curr_avg = "c_16_avg_a"
-L2_curr_avg = "c_17_avg_a"
-L3_curr_avg = "c_18_avg_a"
-N_curr_avg = "c_19_avg_a"
-gnd_curr_avg = "c_20_avg_a"
-tot_app_pwr_avg = "c_106_avg_va"
-tot_activ_pwr_avg = "c_70_avg_w"
-tot_react_pwr_avg = "c_88_avg_var"
-tot_pf_avg = "c_124_avg_none"
-L1_v_avg = "c_4_avg_v"
-L2_v_avg = "c_5_avg_v"
-L3_v_avg = "c_6_avg_v"
-tot_Pst_avg = "c_1612_avg_none"
-thd_avg = "c_1609_avg_%"
-tdd_avg = "c_1610_avg_%"
-neg_v_unbal = "c_287_avg_%"
-neg_i_unbal = "c_288_avg_%"
-
-# Some sites had issues with too many columns in the dataframe and returned a 504 code. 
-# For this reason, two of the least useful metrics were commented out for now.
-# When changing the trend_list, it is imporant to also change the correlating trend_names.
-#  - _list is used for accessing data, and _names is used for column headers.    
-trend_list = [ 
-    L1_curr_avg,
-    L2_curr_avg,
-    L3_curr_avg,
-    gnd_curr_avg, 
-    tot_activ_pwr_avg, 
-    #tot_app_pwr_avg, 
-    #tot_react_pwr_avg, 
-    tot_pf_avg, 
-    tot_Pst_avg, 
-    thd_avg, 
-    tdd_avg, 
-    neg_i_unbal, 
-    neg_v_unbal
-    ]
-
-trend_names = [
-            "L1_curr_avg",
-            "L2_curr_avg",
-            "L3_curr_avg",
-            "gnd_curr_avg", 
-            "tot_activ_pwr_avg", 
-            #"tot_app_pwr_avg", 
-            #"tot_react_pwr_avg", 
-            "tot_pf_avg", 
-            "tot_Pst_avg", 
-            "thd_avg", 
-            "tdd_avg", 
-            "neg_i_unbal", 
-            "neg_v_unbal"
-            ]
+# Channel registry: readable name of every trend channel with its firmware name (from the "20200525 Channels Definition.xlsx"
+# file), dtype, unit and native resolution. Trend requests only ask for the channels the report's metrics read (see
+# metric_channels), in this order, so add a channel here and to metric_channels to use it.
+# Some sites returned a 504 code for requests with too many columns, so the columns of a period are split into
+# requests of at most trend_max_columns (section 14).
+channel_registry = {
+    "L1_curr_avg": {"firmware": "c_16_avg_a", "dtype": "float64", "unit": "A", "resolution": "1min"},
+    "L2_curr_avg": {"firmware": "c_17_avg_a", "dtype": "float64", "unit": "A", "resolution": "1min"},
+    "L3_curr_avg": {"firmware": "c_18_avg_a", "dtype": "float64", "unit": "A", "resolution": "1min"},
+    "N_curr_avg": {"firmware": "c_19_avg_a", "dtype": "float64", "unit": "A", "resolution": "1min"},
+    "gnd_curr_avg": {"firmware": "c_20_avg_a", "dtype": "float64", "unit": "A", "resolution": "1min"},
+    "tot_activ_pwr_avg": {"firmware": "c_70_avg_w", "dtype": "float64", "unit": "W", "resolution": "1min"},
+    "tot_app_pwr_avg": {"firmware": "c_106_avg_va", "dtype": "float64", "unit": "VA", "resolution": "1min"},
+    "tot_react_pwr_avg": {"firmware": "c_88_avg_var", "dtype": "float64", "unit": "var", "resolution": "1min"},
+    "tot_pf_avg": {"firmware": "c_124_avg_none", "dtype": "float64", "unit": "", "resolution": "1min"},
+    "tot_Pst_avg": {"firmware": "c_1612_avg_none", "dtype": "float64", "unit": "", "resolution": "1min"},
+    "thd_avg": {"firmware": "c_1609_avg_%", "dtype": "float64", "unit": "%", "resolution": "1min"},
+    "tdd_avg": {"firmware": "c_1610_avg_%", "dtype": "float64", "unit": "%", "resolution": "1min"},
+    "neg_i_unbal": {"firmware": "c_288_avg_%", "dtype": "float64", "unit": "%", "resolution": "1min"},
+    "neg_v_unbal": {"firmware": "c_287_avg_%", "dtype": "float64", "unit": "%", "resolution": "1min"},
+    "L1_v_avg": {"firmware": "c_4_avg_v", "dtype": "float64", "unit": "V", "resolution": "1min"},
+    "L2_v_avg": {"firmware": "c_5_avg_v", "dtype": "float64", "unit": "V", "resolution": "1min"},
+    "L3_v_avg": {"firmware": "c_6_avg_v", "dtype": "float64", "unit": "V", "resolution": "1min"},
+    }
         
 
 
@@ -113,7 +110,8 @@ trend_names = [
 #       Format is "measurement point id": "UTC time zone offset" 
 #          Example: Pinnacle is PDT time zone (+7 hours).
 #       ** Time zone offsets will need manually adjusted depending on daylight savings time.
-#       TODO: Detect daylight savings time automatically. 
+#       A timezone name such as "America/Los_Angeles" can be used instead of the offset to detect 
+#       daylight savings time automatically. Set discover_mps (section 10) to list the sites from the API instead.
 mps = {
     # "15": "7",  #Pinnacle - PDT
     # "21": "6",  #Energy Txfr Lea
@@ -128,19 +126,481 @@ mps = {
     # "2167": "7",#Ready Roast North
     "2168": "7" #Ready Roast South
     }
+
+# 4. Report options
+#       fast_report builds the conclusion strings from the aggregates returned by get_pq_meausres 
+#       (P95_THD, P95_TDD, P95_V_UNB, P95_I_UNB, P95_PST). Minute trends are only downloaded for metrics the
+#       aggregates cannot answer, or when an aggregate is within aggregate_margin (fraction of the threshold)
+#       of its threshold. Power factor, ground current and voltage fluctuation are always downloaded, as no
+#       aggregate answers them (see aggregate_metrics).
+#       Aggregates covering less than aggregate_min_coverage of the period are not trusted.
+fast_report = False
+aggregate_margin = 0.1
+aggregate_min_coverage = 0.95
+
+# 5. Results store
+#       Every computed metric is also appended to this SQLite database, keyed by measurement point, 
+#       report period and metric name, so fleet-wide questions can be answered with query_metric
+#       instead of re-running the script or parsing the text reports.
+results_db = "insite_results.db"
+
+# 6. Plots
+#       render_plots writes PNG charts next to each text report. Line and scatter series are downsampled
+#       to plot_points with LTTB before drawing, and each site's charts are drawn in one of plot_workers
+#       background processes while the next site is downloaded and analyzed.
+render_plots = True
+plot_points = 2000
+plot_workers = 2
+
+# 7. Histograms
+#       Fixed-bin histograms built during the metrics pass: channel: (lower edge, upper edge, bin width).
+#       Values outside the edges are counted in an underflow and an overflow bin.
+#       They are stored per site and period in the results store (see load_histograms).
+histogram_bins = {
+    "neg_v_unbal": (0, 10, 0.25),
+    "neg_i_unbal": (0, 100, 2),
+    "tdd_avg": (0, 100, 2),
+    "thd_avg": (0, 20, 0.5),
+    "tot_pf_avg": (0.5, 1, 0.01),
+    }
+
+# 8. Correlation
+#       Cross-channel correlation matrices written as CSV next to each report, one file per method 
+#       ("pearson", "spearman", "kendall"). Leave the list empty to skip them.
+#       Set correlation_sample to a row count to estimate them from a sample stratified by hour of day.
+correlation_methods = ["pearson", "spearman", "kendall"]
+correlation_sample = None
+
+# 9. Fleet runner
+#       run_mode "report" runs the dates entered in section 2 for every site in mps.
+#       run_mode "backfill" runs a range of months (section 13).
+#       run_mode "serve" answers metric queries over HTTP (section 17).
+#       run_mode "regression" checks the report pipeline against its golden outputs (section 19).
+#       run_mode "alert" keeps polling the newest minutes of every site and records alerts (section 24).
+#       run_mode "benchmark" compares the trend transport formats on the first site (section 12).
+#       run_mode "schedule" keeps running and starts each month's batch automatically once the month has closed,
+#       schedule_delay_hours after midnight UTC on the 1st so every site's local month is over.
+#       Each site and period is tracked in the job_ledger database and checkpointed in checkpoint_dir after 
+#       every completed stage (fetch, metrics, report). Rerunning resumes unfinished sites from their last
+#       completed stage and skips finished ones, unless rerun_completed is True.
+run_mode = "report"
+schedule_delay_hours = 12
+job_ledger = "insite_jobs.db"
+checkpoint_dir = "checkpoints"
+rerun_completed = False
+
+# 10. Measurement point discovery
+#       With discover_mps = True the sites are listed from the API instead of taken from the mps dict.
+#       discovery_accounts limits them to those account ids (leave empty for every account the token can see)
+#       and discovery_status to measurement points with that status name ("" for any status).
+#       Pages of discovery_page_size measurement points are fetched discovery_workers at a time.
+#       Discovered sites use their timezone name, so daylight savings time is handled automatically.
+discover_mps = False
+discovery_accounts = []
+discovery_status = "commissioned"
+discovery_page_size = 100
+discovery_workers = 8
+
+# 11. API rate limiting
+#       Every API call goes through a per-endpoint token bucket, api_rate_limits = (requests per second, burst),
+#       and an AIMD concurrency limit, api_concurrency = (initial, minimum, maximum) requests in flight.
+#       The limit grows by one after api_concurrency_increase healthy responses and is halved on 429, 502 and 503
+#       responses (and 504 responses with a Retry-After header) or when latency exceeds api_latency_factor
+#       times its running average. Other 5xx responses are returned at once: trend requests answered with 500 or 504
+#       are split into shorter periods (section 12), other requests fail.
+#       Throttled requests and connection errors are retried api_retries times, waiting api_backoff * 2^attempt seconds.
+#       fleet_workers sites are processed at the same time.
+api_rate_limits = {
+    "trends": (2, 4),
+    "default": (10, 20),
+    }
+api_concurrency = {
+    "trends": (2, 1, 8),
+    "default": (4, 1, 16),
+    }
+api_concurrency_increase = 10
+api_latency_factor = 3
+api_retries = 4
+api_backoff = 2
+api_timeout = 300
+fleet_workers = 4
+
+# 12. Trend transport
+#       trend_output is the "output" format requested from the trends endpoint, one of trend_formats ("csv", "json").
+#       Responses are requested gzip/deflate compressed. run_mode "benchmark" downloads the first site's 
+#       current month in every format and reports bytes on the wire, download time and parse time per format.
+#       A trend request answered with one of trend_split_statuses (server error, gateway timeout) is split into
+#       two requests of half its period each, again and again down to trend_min_split_minutes.
+trend_output = "csv"
+trend_split_statuses = (500, 504)
+trend_min_split_minutes = 60
+
+# 13. Backfill
+#       run_mode "backfill" writes the monthly report of every site for each month from backfill_start to backfill_end
+#       ("YYYY-MM", both included) instead of the dates entered in section 2. Each site's months are run in order,
+#       and the trends and energy downloaded for a month are reused as the previous month of the next report,
+#       so every month is downloaded once.
+backfill_start = "2021-01"
+backfill_end = "2021-12"
+
+# 14. Dry run
+#       With dry_run = True nothing is downloaded. The API calls run_mode would make for the sites (the dates of section 2,
+#       or the backfill range) are listed with their estimated rows, bytes and duration, printed and written to plan_file.
+#       Reports already done in the job ledger, or resumable from a fetch checkpoint, are left out.
+#       Estimates come from the trend requests earlier runs recorded in the job_ledger database
+#       (plan_bytes_per_value and plan_seconds_per_row until there are any); other calls take plan_seconds_per_call.
+#       Trend requests over trend_max_columns columns or trend_max_rows rows, or at least as large as a request that
+#       returned a 504 for the same site before, are flagged. The channels of a period are always split into requests
+#       of at most trend_max_columns columns.
+dry_run = False
+plan_file = "request_plan.csv"
+plan_bytes_per_value = 4
+plan_seconds_per_row = 0.0005
+plan_seconds_per_call = 0.5
+trend_max_columns = 11
+trend_max_rows = 44640
+
+# 15. Energy and demand
+#       A period's energy is integrated from its tot_activ_pwr_avg minute trend when the trend covers at least
+#       local_energy_min_coverage of the period, and only requested from the energy endpoint otherwise.
+#       With energy_cross_check the endpoint is called anyway and differences over energy_tolerance (fraction) are printed.
+#       Peak demand is the highest demand_window minute rolling average of active power.
+local_energy_min_coverage = 1.0
+energy_cross_check = False
+energy_tolerance = 0.01
+demand_window = 15
+
+# 16. Local archive
+#       Every downloaded period is also kept under archive_dir/<measurement point>/<period start>_<period end>/:
+#       the minute channels as one (channels x minutes) float64 array in values.npy, the UTC timestamps in date_time.npy,
+#       and the period's API responses as JSON. Archived periods are memory-mapped instead of downloaded again, but only
+#       for the same start and end (set archive_dir = None to turn the archive off). With offline = True nothing is downloaded and reports are computed from the archive.
+archive_dir = "archive"
+offline = False
+
+# 17. Metrics service
+#       run_mode "serve" answers GET http://serve_host:serve_port/metrics?site=<measurement point>&month=YYYY-MM
+#       (or &start=YYYY-MM-DD&end=YYYY-MM-DD for another period) with the site's metrics as JSON, durations in minutes.
+#       Add &metrics=name,name to return only those metrics. GET /sites lists the sites that can be queried.
+#       Answers come from an in-memory cache of the last serve_cache_size queries, then from the results store,
+#       and are only computed (from the archive, downloading what is missing) when neither has them.
+#       Queries arriving while the same site and period is being computed wait for that result.
+serve_host = "127.0.0.1"
+serve_port = 8050
+serve_cache_size = 256
+
+# 18. Profiling
+#       The stages listed in profile_stages ("fetch", "parse", "metrics", "render") of the sites in profile_sites
+#       (every site when empty) run under cProfile. Each profiled stage writes profile_dir/<site>_<stage>_<period>.prof
+#       (open with pstats or snakeviz) and a .txt summary with its wall time and profile_top most expensive functions.
+#       With profile_memory allocations are traced with tracemalloc: the summary adds the peak traced memory and the
+#       largest allocation sites, and the snapshot is written to a .snapshot file (tracemalloc.Snapshot.load).
+#       Profiled stages run one at a time, and a stage run inside another profiled stage (parse within fetch) is part
+#       of that stage's profile. Leave profile_stages empty to turn profiling off.
+profile_stages = []
+profile_sites = []
+profile_dir = "profiles"
+profile_memory = True
+profile_top = 30
+
+# 19. Regression
+#       run_mode "regression" runs the report pipeline (fetch from the archive, metrics, report text) on synthetic
+#       fixture sites (see regression_fixtures) and compares every metric and report line with the golden files in
+#       golden_dir: <fixture>.json holds the metrics (as returned by metrics_json) and <fixture>.txt the report.
+#       Numbers may differ by regression_tolerance (relative), everything else must be identical.
+#       Every stage must also stay within its regression_budgets (wall seconds, MiB of peak traced memory).
+#       The script exits with status 1 when anything differs. Only a change meant to alter the report output should
+#       set regression_update = True once to rewrite the golden files. Review their diff, commit them with that change
+#       and say so in its message. A speed-up or refactor must pass against the golden files as they are.
+#       The settings that change the metrics are pinned to regression_settings (the defaults the golden files were
+#       written with) for the run, whatever they are set to above and below, and restored afterwards.
+golden_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+regression_tolerance = 1e-9
+regression_update = False
+regression_budgets = {
+    "fetch": (0.5, 16),
+    "metrics": (0.5, 16),
+    "render": (0.1, 2),
+    }
+regression_settings = {
+    "fast_report": False,
+    "aggregate_margin": 0.1,
+    "aggregate_min_coverage": 0.95,
+    "histogram_bins": {
+        "neg_v_unbal": (0, 10, 0.25),
+        "neg_i_unbal": (0, 100, 2),
+        "tdd_avg": (0, 100, 2),
+        "thd_avg": (0, 20, 0.5),
+        "tot_pf_avg": (0.5, 1, 0.01),
+        },
+    "local_energy_min_coverage": 1.0,
+    "energy_cross_check": False,
+    "demand_window": 15,
+    "qualifying_load": {},
+    "stream_days": 32,
+    "stream_chunk_days": 7,
+    "rollup_thresholds": {
+        "tot_pf_avg": [("<", 0.9)],
+        "thd_avg": [(">=", 5)],
+        "tdd_avg": [(">=", 25)],
+        "neg_v_unbal": [(">=", 2)],
+        "neg_i_unbal": [(">=", 50)],
+        "gnd_curr_avg": [(">=", 0.1)],
+        "tot_Pst_avg": [(">=", 1)],
+        "L1_v_avg": [("outside", 0.07)],
+        "L2_v_avg": [("outside", 0.07)],
+        "L3_v_avg": [("outside", 0.07)],
+        },
+    }
+
+# 20. Qualifying load
+#       Minutes at light load can be left out of the threshold metrics ("pf", "thd", "tdd", "nvu", "niu", "gnd", "pst", "vf").
+#       A minute counts for a metric only when it meets every rule listed for the metric in qualifying_load:
+#           "min_phase_current": all three phase currents above this many A
+#           "min_power_fraction": active power above this fraction of the period's maximum
+#       Example: {"pf": {"min_power_fraction": 0.4}, "niu": {"min_phase_current": 30}}
+#       Each rule's bitmap is computed once per site and period and shared by the metrics using it. Rules needing
+#       channels that were not downloaded are skipped. Percentages remain of the whole sampled time.
+qualifying_load = {}
+
+# 21. Accounts
+#       api_accounts runs the pipeline for several accounts, each with its own api token and sites:
+#           api_accounts = {
+#               "Acme": {"token": "Basic zmVy...", "mps": {"2168": "7"}},
+#               "Globex": {"token": "Basic a2l0...", "discover": True},
+#               }
+#       "mps" lists the account's sites like section 3, or with "discover": True they are listed from the API (section 10).
+#       Every account has its own connection pool of api_pool_size connections and its own rate and concurrency
+#       limits (section 11), so a slow or throttled account does not hold up the others.
+#       account_workers accounts run at the same time, each with fleet_workers sites.
+#       Leave api_accounts empty to run the api_token of section 1 on the sites of section 3.
+api_accounts = {}
+account_workers = 4
+api_pool_size = 32
+
+# 22. Streaming
+#       Report periods longer than stream_days (e.g. start_time "2021-01-01" to end_time "2022-01-01" in section 2)
+#       are not held in memory: their minute trends are downloaded stream_chunk_days at a time and summarized chunk
+#       by chunk (see MetricsAccumulator), so memory does not grow with the length of the period.
+#       The previous period then only provides the energy, and the charts and correlation matrices are skipped.
+#       The "min_power_fraction" qualifying load rule (section 20) needs the whole period and cannot be streamed.
+stream_days = 32
+stream_chunk_days = 7
+
+# 23. Rollups
+#       Downloaded minute trends are also summarized in rollup_db (SQLite, "" to turn it off): one hourly record per
+#       site, channel and hour with its samples, sum, min and max and the minutes beyond each of rollup_thresholds,
+#       and daily and monthly records (local days of the measurement point) once all of their hours are stored.
+#       Any period can then be answered by summing the records inside it (see query_rollups) instead of
+#       downloading its minutes again, like last year's energy for the year over year change of the report.
+#       Thresholds are (operator, value) with the operators of rollup_operators; "outside" counts the minutes
+#       further than value (a fraction) from the nominal phase to neutral voltage. Qualifying load rules are not applied.
+rollup_db = "insite_rollups.db"
+rollup_thresholds = {
+    "tot_pf_avg": [("<", 0.9)],
+    "thd_avg": [(">=", 5)],
+    "tdd_avg": [(">=", 25)],
+    "neg_v_unbal": [(">=", 2)],
+    "neg_i_unbal": [(">=", 50)],
+    "gnd_curr_avg": [(">=", 0.1)],
+    "tot_Pst_avg": [(">=", 1)],
+    "L1_v_avg": [("outside", 0.07)],
+    "L2_v_avg": [("outside", 0.07)],
+    "L3_v_avg": [("outside", 0.07)],
+    }
+
+# 24. Alerting
+#       run_mode "alert" polls every site every alert_interval seconds for the minutes received since its last poll,
+#       and keeps the last alert_window minutes of each rule in memory. A rule fires an "alert" event when more than
+#       tolerance percent of its window's minutes are beyond its threshold, and a "clear" event when they fall back.
+#       Rules are name: (channel, operator, threshold, tolerance), with the operators of the rollup thresholds
+#       (section 23). The tolerances follow the monthly report's percentages of time, except for the power factor,
+#       whose 5 hours a month has no per-window equivalent. A tolerance of 0 fires on the first minute beyond the threshold.
+#       Windows with fewer than alert_min_coverage of their minutes received are not evaluated.
+#       Events are printed and appended to alert_file as JSON lines ("" to only print them).
+alert_interval = 60
+alert_window = 60
+alert_min_coverage = 0.5
+alert_file = "insite_alerts.jsonl"
+alert_rules = {
+    "pf": ("tot_pf_avg", "<", 0.9, 50),
+    "gnd": ("gnd_curr_avg", ">=", 0.1, 0),
+    "thd": ("thd_avg", ">=", 5, 5),
+    "tdd": ("tdd_avg", ">=", 25, 25),
+    "nvu": ("neg_v_unbal", ">=", 2, 5),
+    "niu": ("neg_i_unbal", ">=", 50, 5),
+    "pst": ("tot_Pst_avg", ">=", 1, 95),
+    }
  
 # API HEADERS 
+# The authorization header is added by the account's session (see ApiAccount).
 get_headers = {
     'accept': 'application/json',
-    'authorization': api_token,
     }
 
 post_headers = {
             'accept': 'text/csv',
-            'authorization': api_token,
+            'accept-encoding': 'gzip, deflate',
             'Content-Type': 'application/json',
             }
 
+# API RATE LIMITING
+class TokenBucket:
+    '''
+    Requests per second budget of one API endpoint: rate tokens are added every second up to burst,
+    and each request takes one.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveLimiter:
+    '''
+    AIMD concurrency limit of one API endpoint. The limit grows by one after api_concurrency_increase
+    healthy responses in a row and is halved on a 429/5xx response, a connection error or a latency
+    above api_latency_factor times the running average of healthy latencies.
+    '''
+    def __init__(self, initial, minimum, maximum):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.healthy = 0
+        self.avg_latency = None
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, ok, latency):
+        with self.condition:
+            self.in_flight -= 1
+            slow = ok and self.avg_latency is not None and latency > api_latency_factor * self.avg_latency
+            if ok and not slow:
+                self.avg_latency = latency if self.avg_latency is None else 0.8 * self.avg_latency + 0.2 * latency
+                self.healthy += 1
+                if self.healthy >= api_concurrency_increase:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.healthy = 0
+            else:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.healthy = 0
+            self.condition.notify_all()
+
+class ApiAccount:
+    '''
+    One set of API credentials: a requests session (its own pool of api_pool_size connections) sending the
+    account's token, and the account's own token bucket and adaptive limiter per endpoint.
+    '''
+    def __init__(self, name, token):
+        self.name = name
+        self.session = requests.Session()
+        self.session.headers['authorization'] = token
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=api_pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.endpoint_limits = {}
+        self.lock = threading.Lock()
+
+    def get_endpoint_limits(self, endpoint):
+        '''
+        Token bucket and adaptive limiter of an endpoint, created from api_rate_limits and api_concurrency
+        (or their "default" entry) on first use.
+        '''
+        with self.lock:
+            if endpoint not in self.endpoint_limits:
+                rate, burst = api_rate_limits.get(endpoint, api_rate_limits["default"])
+                initial, minimum, maximum = api_concurrency.get(endpoint, api_concurrency["default"])
+                self.endpoint_limits[endpoint] = (TokenBucket(rate, burst), AdaptiveLimiter(initial, minimum, maximum))
+            return self.endpoint_limits[endpoint]
+
+api_account_state = threading.local()
+default_account = None
+default_account_lock = threading.Lock()
+
+def get_account():
+    '''
+    Account of the API calls made by this thread (see using_account), by default the api_token of section 1.
+    '''
+    global default_account
+    account = getattr(api_account_state, "account", None)
+    if account is not None:
+        return account
+    with default_account_lock:
+        if default_account is None:
+            default_account = ApiAccount("default", api_token)
+        return default_account
+
+@contextmanager
+def using_account(account):
+    '''
+    Make the API calls of the enclosed code in this thread with account.
+    '''
+    previous = getattr(api_account_state, "account", None)
+    api_account_state.account = account
+    try:
+        yield account
+    finally:
+        api_account_state.account = previous
+
+def in_account(function):
+    '''
+    function bound to the calling thread's account, for work handed to other threads.
+    '''
+    account = get_account()
+    def run(*args, **kwargs):
+        with using_account(account):
+            return function(*args, **kwargs)
+    return run
+
+def api_request(endpoint, method, url, **kwargs):
+    '''
+    Send an API request with the thread's account (see get_account), through its endpoint token bucket and
+    adaptive concurrency limit. 429, 502 and 503 responses, 504 responses with a Retry-After header and connection errors
+    are retried api_retries times with exponential backoff, honouring Retry-After. Other responses, including other 5xx
+    errors, are returned straight away (post_trend_data splits the trend requests answered with them). Returns the last response.
+    '''
+    account = get_account()
+    bucket, limiter = account.get_endpoint_limits(endpoint)
+    for attempt in range(api_retries + 1):
+        bucket.acquire()
+        limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = account.session.request(method, url, timeout=api_timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            limiter.release(False, time.monotonic() - start)
+            if attempt == api_retries:
+                raise
+            time.sleep(api_backoff * 2 ** attempt)
+            continue
+
+        retry_after = response.headers.get('Retry-After', '')
+        throttled = response.status_code in (429, 502, 503) or (response.status_code == 504 and retry_after != '')
+        limiter.release(not throttled, time.monotonic() - start)
+        if not throttled or attempt == api_retries:
+            return response
+
+        time.sleep(float(retry_after) if retry_after.isdigit() else api_backoff * 2 ** attempt)
+
 # FUNCTION DEFINITIONS            
 def get_mp(p):
     '''
@@ -165,7 +625,24 @@ def get_mp(p):
     '''
     api_url = '{0}measurementPoint/{1}'.format(api_url_base, p)
 
-    response = requests.get(api_url, headers=get_headers)
+    response = api_request("measurementPoint", "GET", api_url, headers=get_headers)
+
+    if response.status_code == 200:
+        return json.loads(response.content.decode('utf-8'))
+    else:
+        return None
+
+def get_mp_page(o, n, a=None):
+    '''
+    Page of n measurement points starting at offset o, optionally for account id a.
+    The items have the same fields as get_mp plus the measurement point id.
+    '''
+    api_url = '{0}measurementPoint'.format(api_url_base)
+    params = {"offset": o, "limit": n}
+    if a is not None:
+        params["accountId"] = a
+
+    response = api_request("measurementPoint", "GET", api_url, headers=get_headers, params=params)
 
     if response.status_code == 200:
         return json.loads(response.content.decode('utf-8'))
@@ -178,27 +655,117 @@ def get_month_days(t):
             x, y = monthrange(yr, mo)
             return y
 
-def post_trend_data(j, t, c):
+def parse_trend_csv(content):
+    return pd.read_csv(io.BytesIO(content), engine=trend_csv_engine)
+
+def parse_trend_json(content):
+    '''
+    Trend rows as a list of objects, or an object holding "columns" and "data" rows or a list of objects.
+    '''
+    rows = json.loads(content)
+    if isinstance(rows, dict):
+        if "columns" in rows and "data" in rows:
+            return pd.DataFrame(rows["data"], columns=rows["columns"])
+        rows = next(v for v in rows.values() if isinstance(v, list))
+    return pd.DataFrame(rows)
+
+# Output formats of the trends endpoint: "output" value: (accept header, parser of the response body)
+trend_formats = {
+    "csv": ("text/csv", parse_trend_csv),
+    "json": ("application/json", parse_trend_json),
+    }
+
+def send_trend_request(m, j):
+    '''
+    Send the trend request j for measurement point m, asking for the body in j["output"] format.
+    Returns the last response, whatever its status.
+    '''
+    api_url = '{0}trends/measurementPoint/{1}'.format(api_url_base, m)
+    headers = dict(post_headers, accept=trend_formats[j["output"]][0])
 
-    api_url = '{0}trends/measurementPoint/{1}'.format(api_url_base, measurementPointId)
+    start = time.perf_counter()
+    response = api_request("trends", "POST", api_url, headers=headers, json=j)
+    record_trend_request(m, j, response, time.perf_counter() - start)
+    return response
 
-    response = requests.post(api_url, headers=post_headers, json=j)
+def post_trend_request(m, j):
+    '''
+    Send the trend request j for measurement point m (see send_trend_request).
+    Returns the response, or None when the API had no response.
+    '''
+    response = send_trend_request(m, j)
 
     if response.status_code == 200:
-        r_text = response.text
-        df = pd.read_csv(io.StringIO(r_text))
-        col = ["date_time"] + c
-        df.columns = col
-        df.date_time = pd.to_datetime(df.date_time)
-        df = df.set_index("date_time")
-        df = df.tz_convert(tz = t) #acct_tz
-        df = df.reset_index()
-        return df
+        return response
     else:
         print("post_trend_data API had no response - ", response.status_code)
         return None
 
-def get_energy_data(p):
+trend_request_state = threading.local()
+
+def record_trend_request(m, j, response, seconds):
+    '''
+    Keep the size, duration and status of a trend request for the dry run estimates. Only requests sent
+    by a ledger-backed site job (see run_site_job) are kept; the job writes them to the job ledger when it ends.
+    '''
+    rows = getattr(trend_request_state, "rows", None)
+    if rows is None:
+        return
+    minutes = (pd.Timestamp(j["endTime"]) - pd.Timestamp(j["startTime"])) / pd.Timedelta(1, 'minutes')
+    wire_bytes = response.raw.tell() if response.raw is not None else len(response.content)
+    rows.append((m, j["startTime"], j["endTime"], len(j["columns"]), minutes, response.status_code, wire_bytes, seconds,
+                 datetime.now(timezone.utc).isoformat()))
+
+def store_trend_requests(rows):
+    '''
+    Write the trend requests kept by record_trend_request to the job ledger in one transaction.
+    '''
+    if not rows:
+        return
+    with closing(open_job_ledger()) as con:
+        with con:
+            con.executemany("INSERT INTO trend_requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+def parse_trend_response(content, o, t, c):
+    '''
+    Trend dataframe from a response body in output format o, with the columns named date_time + c
+    and the timestamps converted to the measurement point's timezone t.
+    '''
+    df = trend_formats[o][1](content)
+    col = ["date_time"] + c
+    df.columns = col
+    df = df.astype({name: channel_registry[name]["dtype"] for name in c})
+    df.date_time = pd.to_datetime(df.date_time)
+    df = df.set_index("date_time")
+    df = df.tz_convert(tz = t) #acct_tz
+    df = df.reset_index()
+    return df
+
+def post_trend_data(m, j, t, c):
+    '''
+    Trend dataframe of the request j (see parse_trend_response), or None when the API had no response.
+    A request the server fails on or times out on (trend_split_statuses) is sent again as two halves of its period,
+    down to trend_min_split_minutes, and the halves are joined.
+    '''
+    response = send_trend_request(m, j)
+
+    if response.status_code == 200:
+        with profiled(m, "parse", j["startTime"][:19]):
+            return parse_trend_response(response.content, j["output"], t, c)
+
+    start, end = pd.Timestamp(j["startTime"]), pd.Timestamp(j["endTime"])
+    if response.status_code in trend_split_statuses and end - start >= pd.Timedelta(2 * trend_min_split_minutes, 'minutes'):
+        middle = (start + (end - start) / 2).floor('min').strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        print(f"Trend request of {m} from {j['startTime']} to {j['endTime']} got {response.status_code}, splitting it at {middle}")
+        halves = [post_trend_data(m, dict(j, startTime=s, endTime=e), t, c) for s, e in ((j["startTime"], middle), (middle, j["endTime"]))]
+        if all(half is not None for half in halves):
+            return pd.concat(halves, ignore_index=True)
+        return None
+
+    print("post_trend_data API had no response - ", response.status_code)
+    return None
+
+def get_energy_data(m, p):
     '''
     {
       "status": 2,
@@ -217,16 +784,16 @@ def get_energy_data(p):
     }
     '''
 
-    api_url = '{0}energy/measurementPoint/{1}'.format(api_url_base, measurementPointId)
+    api_url = '{0}energy/measurementPoint/{1}'.format(api_url_base, m)
 
-    response = requests.get(api_url, headers=get_headers, params=p)
+    response = api_request("energy", "GET", api_url, headers=get_headers, params=p)
 
     if response.status_code == 200:
         return json.loads(response.content.decode('utf-8'))
     else:
         return None
 
-def get_pq_meausres(p):
+def get_pq_meausres(m, p):
     '''
         {
           "sagsAndSwellsPrior30Days": {
@@ -433,9 +1000,9 @@ def get_pq_meausres(p):
           }
         }
     '''
-    api_url = '{0}powerQualityMeasures/measurementPoint/{1}'.format(api_url_base, measurementPointId)
+    api_url = '{0}powerQualityMeasures/measurementPoint/{1}'.format(api_url_base, m)
 
-    response = requests.get(api_url, headers=get_headers, params=p)
+    response = api_request("powerQualityMeasures", "GET", api_url, headers=get_headers, params=p)
 
     if response.status_code == 200:
         return json.loads(response.content.decode('utf-8'))
@@ -482,881 +1049,3474 @@ def get_params(p):
     '''
     api_url = '{0}parameters/{1}'.format(api_url_base, p)
 
-    response = requests.get(api_url, headers=get_headers)
+    response = api_request("parameters", "GET", api_url, headers=get_headers)
 
     if response.status_code == 200:
         return json.loads(response.content.decode('utf-8'))
     else:
-        return None              
+        return None
 
-if __name__ == '__main__':
-    
-    for num, tz in mps.items():
-        mp_info = get_mp(num)
-        acct_tz = mp_info['timezone']
-        pr_s_t = prev_start_time + "T0" + tz + ":00:00.000Z"
-        s_t = start_time + "T0" + tz + ":00:00.000Z"
-        e_t = end_time + "T0" + tz + ":00:00.000Z"
-        measurementPointId = num
-        acct_a_name = mp_info['accountName']
-        acct_b_name = mp_info['mpId']
-        acct_name = acct_a_name+acct_b_name
-        
-# All of the below datetime manipulation is for formatting time,days,months,timespan for various parts of script. 
-        previous_month_days = get_month_days(pr_s_t)    
-        p_time = datetime.fromisoformat(pr_s_t[:-1])
-        e_time = datetime.fromisoformat(e_t[:-1])
-        pe_time = datetime.fromisoformat(s_t[:-1])
-        pe_str = pe_time.strftime('%Y-%m-%dT%H:%M:%S')
-        s_time = datetime.fromisoformat(s_t[:-1])
-        ps_time = s_time - timedelta(days=previous_month_days)
-        ps_str = ps_time.strftime('%Y-%m-%dT%H:%M:%S')
-        report_timespan = e_time - s_time
-        prev_report_timespan = s_time - p_time
-
-        trend_json = {
-            "startTime": s_t, 
-            "endTime": e_t, 
-            "table": "oneminute", 
-            "interval": 1, 
-            "period": "minute", 
-            "output": "csv", 
-            "writeToFile": False, 
-            "columns": trend_list
-            }
+# Conclusion strings shared by the minute trend and the server aggregate metrics.
+conclusion_strings = {
+    "vf": {
+        "within": "Voltage fluctuation remained within 7% of nominal voltage for more than 95% of the month.",
+        "exceeded": "Voltage fluctuation exceeded 7% of nominal voltage for more than 5% of the month",
+        },
+    "pst": {
+        "within": "Short Term Flicker Perceptibility (Pst) values remained under 1 for 95% of the month.",
+        "exceeded": "Short Term Flicker Perceptibility (Pst) values exceeded 1 for at least 95% of the month.",
+        },
+    "thd": {
+        "within": "Total Harmonic Distortion (THD-V) values remained under 5% for at least 95% of the month.",
+        "exceeded": "Total Harmonic Distortion (THD-V) values exceeded 5% for more than 5% of the month.",
+        },
+    "tdd": {
+        "within": "TDD values remained under the defined tolerance of 25% for at least 75% of the month.",
+        "exceeded": "Total Demand Distortion (TDD) values exceeded 25% for more than 25% of the month.",
+        },
+    "nvu": {
+        "within": "Negative voltage unbalance remained within the defined tolerance of 2% for at least 95% of the month.",
+        "exceeded": "Negative voltage unbalance exceeded 2% for more than 5% of the month.",
+        },
+    "niu": {
+        "within": "Negative current unbalance remained within the defined tolerance of 50% for at least 95% of the month.",
+        "exceeded": "Negative current unbalance exceeded 50% for more than 5% of the month.",
+        },
+    "gnd": {
+        "within": "Ground current remained within the defined tolerance of 0.1 A during this 30-day period.",
+        },
+    }
 
-        prev_trend_json = {
-            "startTime": pr_s_t, 
-            "endTime": s_t, 
-            "table": "oneminute", 
-            "interval": 1, 
-            "period": "minute", 
-            "output": "csv", 
-            "writeToFile": False, 
-            "columns": trend_list
-            }
+# Channels (see channel_registry) read by each metric. "power" is the local energy and demand (see local_energy_data),
+# which is only computed when the trends are downloaded for other metrics anyway.
+metric_channels = {
+    "pf": ("tot_pf_avg", "L1_curr_avg", "L2_curr_avg", "L3_curr_avg"),
+    "thd": ("thd_avg",),
+    "tdd": ("tdd_avg",),
+    "nvu": ("neg_v_unbal",),
+    "niu": ("neg_i_unbal", "neg_v_unbal"),
+    "gnd": ("gnd_curr_avg",),
+    "pst": ("tot_Pst_avg",),
+    "vf": ("L1_v_avg", "L2_v_avg", "L3_v_avg"),
+    "power": ("tot_activ_pwr_avg", "tot_pf_avg"),
+    }
 
-        volt_fluct_names = [
-            "tot_Pst_avg",
-            "L1_v_avg", 
-            "L2_v_avg", 
-            "L3_v_avg"
-            ]
+# Metrics computed together by one metric function (see compute_site_metrics).
+metric_groups = (("pf",), ("thd", "tdd"), ("nvu", "niu"), ("gnd",), ("pst",), ("vf",))
 
-        volt_fluct_list = [
-            tot_Pst_avg,
-            L1_v_avg, 
-            L2_v_avg, 
-            L3_v_avg
-            ]
+def get_metric_channels(metrics, rules=True):
+    '''
+    Channels read by the metrics, and by their qualifying_load rules when rules is True, in channel_registry order.
+    '''
+    needed = set()
+    for metric in metrics:
+        needed.update(metric_channels[metric])
+        for rule in qualifying_load.get(metric, {}) if rules else ():
+            needed.update(load_rules[rule][0])
+    return [name for name in channel_registry if name in needed]
 
-        volt_fluct_json = {
-            "startTime": s_t, 
-            "endTime": e_t, 
-            "table": "oneminute", 
-            "interval": 1, 
-            "period": "minute", 
-            "output": "csv", 
-            "writeToFile": False, 
-            "columns": volt_fluct_list
-            }
+def get_trend_requests(names):
+    '''
+    The channels names split into the column lists of the trend requests, at most trend_max_columns each.
+    '''
+    return [names[i:i + trend_max_columns] for i in range(0, len(names), trend_max_columns)]
 
-        prev_volt_fluct_json = {
-            "startTime": pr_s_t, 
-            "endTime": s_t, 
-            "table": "oneminute", 
-            "interval": 1, 
-            "period": "minute", 
-            "output": "csv", 
-            "writeToFile": False, 
-            "columns": volt_fluct_list
+def get_report_dates(month=None):
+    '''
+    Report dates of the month containing the datetime month, in the same form as the user entered dates.
+    Without a month, the user entered dates are returned.
+    '''
+    if month is None:
+        return {
+            "prev_start_time": prev_start_time,
+            "start_time": start_time,
+            "end_time": end_time,
+            "report_month_yr": report_month_yr,
             }
 
-        period_params = (
+    start = datetime(month.year, month.month, 1)
+    return {
+        "prev_start_time": (start - relativedelta(months=1)).strftime('%Y-%m-%d'),
+        "start_time": start.strftime('%Y-%m-%d'),
+        "end_time": (start + relativedelta(months=1)).strftime('%Y-%m-%d'),
+        "report_month_yr": start.strftime('%B %Y'),
+        }
+
+def get_utc_start(d, tz):
+    '''
+    UTC time string of local midnight on date d ("YYYY-MM-DD") for a measurement point in tz.
+    tz is either the UTC offset in hours used in mps (e.g. "7" for PDT) or a timezone name
+    (e.g. "America/Toronto"), for which daylight savings time on that date is taken into account.
+    '''
+    local = datetime.fromisoformat(d)
+    try:
+        offset = timedelta(hours=float(tz))
+    except ValueError:
+        offset = -ZoneInfo(tz).utcoffset(local)
+    return (local + offset).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def get_report_period(tz, dates=None):
+    '''
+    Build the start/end times and timespans of the current and previous report periods
+    from the report dates (see get_report_dates) and the measurement point's UTC offset (tz).
+    '''
+    dates = dates or get_report_dates()
+    pr_s_t = get_utc_start(dates["prev_start_time"], tz)
+    s_t = get_utc_start(dates["start_time"], tz)
+    e_t = get_utc_start(dates["end_time"], tz)
+
+    # All of the below datetime manipulation is for formatting time,days,months,timespan for various parts of script.
+    previous_month_days = get_month_days(pr_s_t)
+    p_time = datetime.fromisoformat(pr_s_t[:-1])
+    e_time = datetime.fromisoformat(e_t[:-1])
+    pe_time = datetime.fromisoformat(s_t[:-1])
+    pe_str = pe_time.strftime('%Y-%m-%dT%H:%M:%S')
+    s_time = datetime.fromisoformat(s_t[:-1])
+    ps_time = s_time - timedelta(days=previous_month_days)
+    ps_str = ps_time.strftime('%Y-%m-%dT%H:%M:%S')
+    # Same dates a year earlier, for the year over year energy change.
+    ly_s_t, ly_e_t = [get_utc_start((datetime.fromisoformat(dates[k]) - relativedelta(years=1)).strftime('%Y-%m-%d'), tz) for k in ("start_time", "end_time")]
+
+    return {
+        "period_start": dates["start_time"],
+        "period_end": dates["end_time"],
+        "report_month_yr": dates["report_month_yr"],
+        "pr_s_t": pr_s_t,
+        "s_t": s_t,
+        "e_t": e_t,
+        "ly_s_t": ly_s_t,
+        "ly_e_t": ly_e_t,
+        "ps_time": ps_time,
+        "pe_time": pe_time,
+        "ps_str": ps_str,
+        "pe_str": pe_str,
+        "report_timespan": e_time - s_time,
+        "prev_report_timespan": s_time - p_time,
+        "period_params": (
             ('dateRangeStart', s_t),
             ('dateRangeEnd', e_t),
-            )
-            
-        prev_period_params = (
+            ),
+        "prev_period_params": (
             ('dateRangeStart', ps_str),
             ('dateRangeEnd', pe_str),
-            )
-        
-        pq_measures = get_pq_meausres(period_params)
-        pq_params = get_params(measurementPointId)
-        
-        #power_config = pq_measures['voltageFluctuationsPrior30Days']['value']['wiringConfiguration']
-        power_config_1 = pq_params['content']['powerConfiguration'].get('value')
-        power_config_2 = pq_params['content']['powerConfiguration'].get('defaultValue')
-        #nom_pp_voltage = float(pq_measures['voltageFluctuationsPrior30Days']['value']['nominalPhaseToPhaseVoltage'])
-        nom_pp_voltage_1 = pq_params['content']['nominalPhaseToPhaseVoltage'].get('value')
-        nom_pp_voltage_2 = pq_params['content']['nominalPhaseToPhaseVoltage'].get('defaultValue')
-        nom_pn_voltage_1 = pq_params['content']['nominalPhaseToNeutralVoltage'].get('value')
-        nom_pn_voltage_2 = pq_params['content']['nominalPhaseToNeutralVoltage'].get('defaultValue')
-        
-        if power_config_1:
-            power_config = power_config_1
-        else:
-            power_config = power_config_2
-            
-        if nom_pn_voltage_1:
-            nom_pn_voltage = float(nom_pn_voltage_1)
-        else:
-            nom_pn_voltage = float(nom_pn_voltage_2)
-        
-        if nom_pp_voltage_2:
-            nom_pp_voltage = float(nom_pp_voltage_1)
-        else:
-            nom_pp_voltage = float(nom_pp_voltage_2)
-            
-        filename = f"{acct_name} - {report_month_yr}.txt"
-        file = open(filename, "w")
+            ),
+        }
 
-        #print(json.dumps(pq_measures, indent=1))
+def get_trend_json(s, e, c):
+    '''
+    Body of a one minute trend request for the columns c between s and e.
+    '''
+    return {
+        "startTime": s,
+        "endTime": e,
+        "table": "oneminute",
+        "interval": 1,
+        "period": "minute",
+        "output": trend_output,
+        "writeToFile": False,
+        "columns": c
+        }
 
-        #######################################################################      
-        # TODO: Look into why I needed to set, reset index to date_time in order for conversion to work
-        trend_df = post_trend_data(trend_json, acct_tz, trend_names)
-        prev_trend_df = post_trend_data(prev_trend_json, acct_tz, trend_names)
-        #trend_df['date_time'] = pd.to_datetime(trend_df['date_time']).dt.strftime('%H:%M:%S')
-
-        volt_fluct_df = post_trend_data(volt_fluct_json, acct_tz, volt_fluct_names)
-        prev_volt_fluct_df = post_trend_data(prev_volt_fluct_json, acct_tz, volt_fluct_names)
-
-
-        # Build differential dataframe columns to find increases in rates
-        #print(trend_df)
-        trend_df['pwr_diff'] = trend_df['tot_activ_pwr_avg'].diff()
-        trend_df['pf_diff'] = trend_df['tot_pf_avg'].diff()
-        trend_df['pst_diff'] = trend_df['tot_Pst_avg'].diff()
-        trend_df['thd_diff'] = trend_df['thd_avg'].diff()
-        trend_df['tdd_diff'] = trend_df['tdd_avg'].diff()
-        trend_df['nv_diff'] = trend_df['neg_v_unbal'].diff()
-        trend_df['ni_diff'] = trend_df['neg_i_unbal'].diff()
-        trend_df['gnd_diff'] = trend_df['gnd_curr_avg'].diff()
-        trend_df['weekday'] = trend_df['date_time'].dt.day_name()
-        sun_mask = trend_df['weekday'] == 'Sunday'
-        mon_mask = trend_df['weekday'] == 'Monday'
-        tue_mask = trend_df['weekday'] == 'Tuesday'
-        wed_mask = trend_df['weekday'] == 'Wednesday'
-        thu_mask = trend_df['weekday'] == 'Thursday'
-        fri_mask = trend_df['weekday'] == 'Friday'
-        sat_mask = trend_df['weekday'] == 'Saturday'
-        sun_df = trend_df[sun_mask]
-        mon_df = trend_df[mon_mask]
-        tue_df = trend_df[tue_mask]
-        wed_df = trend_df[wed_mask]
-        thu_df = trend_df[thu_mask]
-        fri_df = trend_df[fri_mask]
-        sat_df = trend_df[sat_mask]
-        
-        
+def get_site_config(pq_params):
+    '''
+    Wiring configuration and nominal voltages from the measurement point parameters (see get_params).
+    The configured value is used when present, otherwise the default value.
+    '''
+    #power_config = pq_measures['voltageFluctuationsPrior30Days']['value']['wiringConfiguration']
+    power_config_1 = pq_params['content']['powerConfiguration'].get('value')
+    power_config_2 = pq_params['content']['powerConfiguration'].get('defaultValue')
+    #nom_pp_voltage = float(pq_measures['voltageFluctuationsPrior30Days']['value']['nominalPhaseToPhaseVoltage'])
+    nom_pp_voltage_1 = pq_params['content']['nominalPhaseToPhaseVoltage'].get('value')
+    nom_pp_voltage_2 = pq_params['content']['nominalPhaseToPhaseVoltage'].get('defaultValue')
+    nom_pn_voltage_1 = pq_params['content']['nominalPhaseToNeutralVoltage'].get('value')
+    nom_pn_voltage_2 = pq_params['content']['nominalPhaseToNeutralVoltage'].get('defaultValue')
 
-        prev_trend_df['pwr_diff'] = prev_trend_df['tot_activ_pwr_avg'].diff()
-        prev_trend_df['pf_diff'] = prev_trend_df['tot_pf_avg'].diff()
-        prev_trend_df['pst_diff'] = prev_trend_df['tot_Pst_avg'].diff()
-        prev_trend_df['thd_diff'] = prev_trend_df['thd_avg'].diff()
-        prev_trend_df['tdd_diff'] = prev_trend_df['tdd_avg'].diff()
-        prev_trend_df['nv_diff'] = prev_trend_df['neg_v_unbal'].diff()
-        prev_trend_df['ni_diff'] = prev_trend_df['neg_i_unbal'].diff()
-        prev_trend_df['gnd_diff'] = prev_trend_df['gnd_curr_avg'].diff()
-        
-        
+    if power_config_1:
+        power_config = power_config_1
+    else:
+        power_config = power_config_2
 
-        #######################################################################
-        #  BUILD METRICS
-        #  
-        #######################################################################   
-
-        # Power ###############################################################
-        # This 30 day period energy use is > 15% compared to prev month
-        # OR this 30 day period > 30% of prev year 30 day period
-        energy_dict = get_energy_data(period_params)
-        this_month_active_energy = energy_dict['totalActiveEnergyConsumed']
-        last_month_active_energy = get_energy_data(prev_period_params)['totalActiveEnergyConsumed']
-        #print(last_month_active_energy)
-        chg = this_month_active_energy - last_month_active_energy
-        perc_chg = abs(round(100 * chg / last_month_active_energy, 2))
-        #print("percent change")
-        #print(perc_chg, "percent change")
-        if perc_chg >= 0 and perc_chg <= 15:
-            pwr_recommend = "No action."
-            pwr_state = "a minor increase "
-        elif perc_chg < 0:
-            pwr_state = "a reduction "
-        else:
-            pwr_recommend = "Investigate increase in energy consumption."
-            pwr_state = "an excessive increase "
-
-
-
-        # Power Factor ########################################################
-        # TODO - Evaluate maximum kw  - PF values below 40% of maximum will not be counted
-        # Below 0.9 more than 5 cumulated hrs over 30 days.
-        pf_mask = (trend_df["tot_pf_avg"] < 0.9) #& (trend_df["L1_curr_avg"] > 40) & (trend_df["L2_curr_avg"] > 40) & (trend_df["L3_curr_avg"] > 40)
-        pf_diff_result_df = trend_df[pf_mask]
-        #print(pf_diff_result_df)
-        this_month_pf_result_time = pd.to_timedelta(pf_diff_result_df["tot_pf_avg"].count(), unit='minutes')
-        pf_time_percent = round(100*this_month_pf_result_time/report_timespan, 2)
-        this_month_pf_result_avg = round(pf_diff_result_df["tot_pf_avg"].mean(), 2)
-        this_month_pf_result_min = round(pf_diff_result_df["tot_pf_avg"].min(), 2)
-        #this_month_var_result_avg = round(pf_diff_result_df["tot_react_pwr_avg"].mean(), 2)
-
-        prev_pf_mask = (prev_trend_df["tot_pf_avg"] < 0.9) & (prev_trend_df["L1_curr_avg"] > 40) & (prev_trend_df["L2_curr_avg"] > 40) & (prev_trend_df["L3_curr_avg"] > 40)
-        prev_pf_diff_result_df = prev_trend_df[prev_pf_mask]
-        prev_month_pf_result_time = pd.to_timedelta(prev_pf_diff_result_df["tot_pf_avg"].count(), unit='minutes')
-        prev_pf_time_percent = round(100*prev_month_pf_result_time/prev_report_timespan, 2)
-        prev_month_pf_result_avg = round(prev_pf_diff_result_df["tot_pf_avg"].mean(), 2)
-        prev_month_pf_result_min = round(prev_pf_diff_result_df["tot_pf_avg"].min(), 2)
-        #prev_month_var_result_avg = round(prev_pf_diff_result_df["tot_react_pwr_avg"].mean(), 2)
-        pf_change = round(pf_time_percent - prev_pf_time_percent, 2)
-        if this_month_pf_result_time > pd.Timedelta(5,'h'):
-            pf_state = "exceeds"
-        else:
-            pf_state = "is within tolerance of"
+    if nom_pn_voltage_1:
+        nom_pn_voltage = float(nom_pn_voltage_1)
+    else:
+        nom_pn_voltage = float(nom_pn_voltage_2)
 
-        if pf_change > 0:
-            pf_recommend = "Investigate why power factor has degraded since previous month"
-        else:
-            pf_recommend = "No action."
+    if nom_pp_voltage_2:
+        nom_pp_voltage = float(nom_pp_voltage_1)
+    else:
+        nom_pp_voltage = float(nom_pp_voltage_2)
 
-        # Volt fluctuation ####################################################
-        # 10min Pst > 1 for 95% of 30 day period.
-        # OR 1min volt outside +/- 7% nom_pn_voltage more than 5% of 30 day period.
-        # TODO look into taknig average variance of nom_pn_voltage as a metric to display.  
-        #  Report would show Voltage fluctuation percentage to 347 L-N: max, min, avg 
+    return power_config, nom_pn_voltage, nom_pp_voltage
 
-        # Absolute value of voltage fluctuation (Percent of nominal phase to neutral Voltage).
-        volt_fluct_df["L1_%_fluct"] = abs((1 - nom_pn_voltage / volt_fluct_df["L1_v_avg"])) * 100
-        volt_fluct_df["L2_%_fluct"] = abs((1 - nom_pn_voltage / volt_fluct_df["L2_v_avg"])) * 100
-        volt_fluct_df["L3_%_fluct"] = abs((1 - nom_pn_voltage / volt_fluct_df["L3_v_avg"])) * 100
+def diff_channel(name):
+    # Differential channel to find increases in rates.
+    return lambda d: np.concatenate(([np.nan], np.diff(d.view(name))))
 
-        L1_fluct_avg = round(volt_fluct_df["L1_%_fluct"].mean(), 2)
-        L2_fluct_avg = round(volt_fluct_df["L2_%_fluct"].mean(), 2)
-        L3_fluct_avg = round(volt_fluct_df["L3_%_fluct"].mean(), 2)
+# Channels computed from the downloaded ones the first time they are used: name: function of the SiteData.
+derived_channels = {
+    "pwr_diff": diff_channel("tot_activ_pwr_avg"),
+    "pf_diff": diff_channel("tot_pf_avg"),
+    "pst_diff": diff_channel("tot_Pst_avg"),
+    "thd_diff": diff_channel("thd_avg"),
+    "tdd_diff": diff_channel("tdd_avg"),
+    "nv_diff": diff_channel("neg_v_unbal"),
+    "ni_diff": diff_channel("neg_i_unbal"),
+    "gnd_diff": diff_channel("gnd_curr_avg"),
+    }
 
+# Per-phase channels, evaluated together as one (phases x minutes) array (see SiteData.phases).
+phase_names = ("L1", "L2", "L3")
+phase_voltages = ("L1_v_avg", "L2_v_avg", "L3_v_avg")
+phase_currents = ("L1_curr_avg", "L2_curr_avg", "L3_curr_avg")
 
-        lower_fluct_thresh = nom_pn_voltage - nom_pn_voltage*0.07
-        upper_fluct_thresh = nom_pn_voltage + nom_pn_voltage*0.07
+def phase_band(x, low=-np.inf, high=np.inf):
+    '''
+    Samples of the (phases x minutes) array x outside the band [low, high], as a boolean array of the same shape,
+    and the minutes during which any phase and all phases were outside it. NaN samples are never outside.
+    '''
+    outside = (x > high) | (x < low)
+    return outside, outside.any(axis=0), outside.all(axis=0)
 
-        a_mask = (volt_fluct_df["L1_v_avg"] >  upper_fluct_thresh) | (volt_fluct_df["L1_v_avg"] <  lower_fluct_thresh)
-        b_mask = (volt_fluct_df["L2_v_avg"] >  upper_fluct_thresh) | (volt_fluct_df["L2_v_avg"] <  lower_fluct_thresh)
-        c_mask = (volt_fluct_df["L3_v_avg"] >  upper_fluct_thresh) | (volt_fluct_df["L3_v_avg"] <  lower_fluct_thresh)
+# Qualifying load rules (see qualifying_load): name: (channels used, function of the SiteData and the rule's value).
+load_rules = {
+    "min_phase_current": (phase_currents, lambda d, v: phase_band(d.phases(phase_currents), high=v)[2]),
+    "min_power_fraction": (("tot_activ_pwr_avg",), lambda d, v: d.view("tot_activ_pwr_avg") > v * np.nanmax(d.view("tot_activ_pwr_avg"))),
+    }
 
-        a_result_df = volt_fluct_df[a_mask]
-        b_result_df = volt_fluct_df[b_mask]
-        c_result_df = volt_fluct_df[c_mask]
+# Operators of rollup_thresholds: function of the values, the threshold and the nominal phase to neutral voltage.
+rollup_operators = {
+    "<": lambda x, v, nom: x < v,
+    ">=": lambda x, v, nom: x >= v,
+    "outside": lambda x, v, nom: (x > nom + nom*v) | (x < nom - nom*v),
+    }
 
-        L1_fluct_time = pd.to_timedelta(a_result_df["L1_%_fluct"].count(), unit='minutes')
-        L2_fluct_time = pd.to_timedelta(a_result_df["L2_%_fluct"].count(), unit='minutes')
-        L3_fluct_time = pd.to_timedelta(a_result_df["L3_%_fluct"].count(), unit='minutes')
+# Qualifying load rules comparing a minute with the whole period, which cannot be applied chunk by chunk (see MetricsAccumulator).
+period_load_rules = ("min_power_fraction",)
 
-        L1_fluct_time_perc = round(100*L1_fluct_time/report_timespan, 2)
-        L2_fluct_time_perc = round(100*L2_fluct_time/report_timespan, 2)
-        L3_fluct_time_perc = round(100*L3_fluct_time/report_timespan, 2)
+def get_period_load_rules():
+    '''
+    (metric, rule) of the qualifying_load rules that need the whole period (see period_load_rules).
+    '''
+    return [(metric, rule) for metric, rules in qualifying_load.items() for rule in rules if rule in period_load_rules]
 
-        pst_threshold = 1
-        pst_mask = (volt_fluct_df["tot_Pst_avg"] >= pst_threshold)
-        pst_result_df = volt_fluct_df[pst_mask]
+def phase_means(x):
+    '''
+    Mean of each phase (row) of x, skipping NaN like Series.mean.
+    '''
+    valid = ~np.isnan(x)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(valid, x, 0).sum(axis=1) / valid.sum(axis=1)
 
-        pst_time = pd.to_timedelta(pst_result_df["tot_Pst_avg"].count(), unit='minutes')
-        pst_mask_perc = round(100* pst_time / report_timespan, 2)
 
+class SiteData:
+    '''
+    Minute data of one site and period: one timestamp vector shared by every channel and the channel
+    values in one contiguous (channels x minutes) float array.
+    site_data[name] is a pandas Series over a zero-copy view of the channel's row, site_data["date_time"]
+    the timestamps, and derived channels (see derived_channels) are computed on first use and cached.
+    '''
+    __slots__ = ("date_time", "values", "channels", "nom_pn_voltage", "derived")
 
-        # Absolute value of voltage fluctuation (Percent of nominal phase to neutral Voltage).
-        prev_volt_fluct_df["L1_%_fluct"] = abs((1 - nom_pn_voltage / prev_volt_fluct_df["L1_v_avg"])) * 100
-        prev_volt_fluct_df["L2_%_fluct"] = abs((1 - nom_pn_voltage / prev_volt_fluct_df["L2_v_avg"])) * 100
-        prev_volt_fluct_df["L3_%_fluct"] = abs((1 - nom_pn_voltage / prev_volt_fluct_df["L3_v_avg"])) * 100
+    def __init__(self, date_time, values, channels, nom_pn_voltage=None):
+        self.date_time = date_time
+        self.values = values
+        self.channels = {name: i for i, name in enumerate(channels)}
+        self.nom_pn_voltage = nom_pn_voltage
+        self.derived = {}
 
-        prev_L1_fluct_avg = round(prev_volt_fluct_df["L1_%_fluct"].mean(), 2)
-        prev_L2_fluct_avg = round(prev_volt_fluct_df["L2_%_fluct"].mean(), 2)
-        prev_L3_fluct_avg = round(prev_volt_fluct_df["L3_%_fluct"].mean(), 2)
+    @classmethod
+    def from_frames(cls, dfs, nom_pn_voltage=None):
+        '''
+        Merge trend dataframes (see post_trend_data) into one SiteData on the union of their timestamps.
+        A channel found in several dataframes (tot_Pst_avg) is taken from the first one.
+        Returns None when every dataframe is None.
+        '''
+        dfs = [df for df in dfs if df is not None]
+        if not dfs:
+            return None
+        date_time = pd.DatetimeIndex(dfs[0]["date_time"])
+        for df in dfs[1:]:
+            if not date_time.equals(pd.DatetimeIndex(df["date_time"])):
+                date_time = date_time.union(pd.DatetimeIndex(df["date_time"]))
 
-        prev_a_mask = (prev_volt_fluct_df["L1_v_avg"] >  upper_fluct_thresh) | (prev_volt_fluct_df["L1_v_avg"] <  lower_fluct_thresh)
-        prev_b_mask = (prev_volt_fluct_df["L2_v_avg"] >  upper_fluct_thresh) | (prev_volt_fluct_df["L2_v_avg"] <  lower_fluct_thresh)
-        prev_c_mask = (prev_volt_fluct_df["L3_v_avg"] >  upper_fluct_thresh) | (prev_volt_fluct_df["L3_v_avg"] <  lower_fluct_thresh)
+        channels = []
+        for df in dfs:
+            channels += [c for c in df.columns if c != "date_time" and c not in channels]
+        values = np.full((len(channels), len(date_time)), np.nan)
+        filled = set()
+        for df in dfs:
+            rows = date_time.get_indexer(pd.DatetimeIndex(df["date_time"]))
+            for c in df.columns:
+                if c == "date_time" or c in filled:
+                    continue
+                values[channels.index(c), rows] = df[c].to_numpy(dtype=float)
+                filled.add(c)
+        return cls(pd.Series(date_time, name="date_time"), values, channels, nom_pn_voltage)
 
-        prev_a_result_df = prev_volt_fluct_df[prev_a_mask]
-        prev_b_result_df = prev_volt_fluct_df[prev_b_mask]
-        prev_c_result_df = prev_volt_fluct_df[prev_c_mask]
+    def __len__(self):
+        return len(self.date_time)
 
-        prev_L1_fluct_time = pd.to_timedelta(prev_a_result_df["L1_%_fluct"].count(), unit='minutes')
-        prev_L2_fluct_time = pd.to_timedelta(prev_a_result_df["L2_%_fluct"].count(), unit='minutes')
-        prev_L3_fluct_time = pd.to_timedelta(prev_a_result_df["L3_%_fluct"].count(), unit='minutes')
+    def __contains__(self, name):
+        return name in self.channels or name in derived_channels
 
-        prev_L1_fluct_time_perc = round(100*prev_L1_fluct_time/prev_report_timespan, 2)
-        prev_L2_fluct_time_perc = round(100*prev_L2_fluct_time/prev_report_timespan, 2)
-        prev_L3_fluct_time_perc = round(100*prev_L3_fluct_time/prev_report_timespan, 2)
+    def has(self, names):
+        return all(name in self.channels for name in names)
 
-        prev_pst_mask = (prev_volt_fluct_df["tot_Pst_avg"] >= pst_threshold)
-        prev_pst_result_df = prev_volt_fluct_df[prev_pst_mask]
+    def view(self, name):
+        '''
+        Values of a downloaded or derived channel as a float array (a view of values for downloaded ones).
+        '''
+        if name in self.channels:
+            return self.values[self.channels[name]]
+        if name not in self.derived:
+            self.derived[name] = derived_channels[name](self)
+        return self.derived[name]
 
-        prev_pst_time = pd.to_timedelta(prev_pst_result_df["tot_Pst_avg"].count(), unit='minutes')
-        prev_pst_mask_perc = round(100* prev_pst_time / prev_report_timespan, 2)
+    def __getitem__(self, name):
+        if name == "date_time":
+            return self.date_time
+        return pd.Series(self.view(name), name=name, copy=False)
 
-        if (L1_fluct_time_perc < 5 or L2_fluct_time_perc < 5 or L3_fluct_time_perc < 5):
-            vf_conclusion_string = (
-                f"Voltage fluctuation remained within 7% of nominal voltage for more than 95% of the month."
-                )
-        else:
-            vf_conclusion_string = (
-                f"Voltage fluctuation exceeded 7% of nominal voltage for more than 5% of the month"
-                )
-            
-        if pst_mask_perc > 95:
-            pst_conclusion_string = (
-                f"Short Term Flicker Perceptibility (Pst) values exceeded 1 for at least 95% of the month."
-                )
-        else:
-            pst_conclusion_string = (
-                f"Short Term Flicker Perceptibility (Pst) values remained under 1 for 95% of the month."
-                )
-        #print(pst_result_df)
-        #print(a_result_df)
-        #print(b_result_df)
-
-        # Harmonics ###########################################################
-        # 1min THD-v >5% for more than 5% of 30 day period
-        # OR 1 min  current TDD >25% for more than 25% of the 30 day period 
-        tdd_trend_max = trend_df["tdd_avg"].max()
-        tdd_trend_avg = round(trend_df["tdd_avg"].mean(), 2)
-        thd_trend_avg = round(trend_df["thd_avg"].mean(), 2)
-        tdd_thresh = round(tdd_trend_max - tdd_trend_avg, 2)
-        tdd_mask = (trend_df["tdd_avg"] >= 25)
-        tdd_mask_df = trend_df[tdd_mask]
-        tdd_mask_time = pd.to_timedelta(tdd_mask_df["tdd_avg"].count(), unit='minutes')
-        tdd_mask_perc = round(100* tdd_mask_time / report_timespan, 2)
-
-        thd_mask = (trend_df["thd_avg"] >= 5)
-        thd_mask_df = trend_df[thd_mask]
-        thd_mask_time = pd.to_timedelta(thd_mask_df["thd_avg"].count(), unit='minutes')
-        thd_mask_perc = round(100* thd_mask_time / report_timespan, 2)
-        #print("tdd thresh    ", tdd_thresh)
-
-        prev_tdd_trend_max = prev_trend_df["tdd_avg"].max()
-        prev_tdd_trend_avg = round(prev_trend_df["tdd_avg"].mean(), 2)
-        prev_thd_trend_avg = round(prev_trend_df["thd_avg"].mean(), 2)
-        prev_tdd_thresh = round(prev_tdd_trend_max - tdd_trend_avg, 2)
-        prev_tdd_mask = (prev_trend_df["tdd_avg"] >= 25)
-        prev_tdd_mask_df = prev_trend_df[prev_tdd_mask]
-        prev_tdd_mask_time = pd.to_timedelta(prev_tdd_mask_df["tdd_avg"].count(), unit='minutes')
-        prev_tdd_mask_perc = round(100* prev_tdd_mask_time / prev_report_timespan, 2)
-
-        prev_thd_mask = (prev_trend_df["thd_avg"] >= 5)
-        prev_thd_mask_df = prev_trend_df[prev_thd_mask]
-        prev_thd_mask_time = pd.to_timedelta(prev_thd_mask_df["thd_avg"].count(), unit='minutes')
-        prev_thd_mask_perc = round(100* prev_thd_mask_time / prev_report_timespan, 2)
-
-        if thd_mask_perc > 5:
-            thd_conclusion_string = (
-                f"Total Harmonic Distortion (THD-V) values exceeded 5% for more than 5% of the month."
-                
-                )
-        else:
-            thd_conclusion_string = (
-                f"Total Harmonic Distortion (THD-V) values remained under 5% for at least 95% of the month."
-                
-                )
+    def qualifies(self, metric):
+        '''
+        Boolean array of the minutes that count for metric under its qualifying_load rules (all of them without rules).
+        The bitmaps of the rules and metrics are computed once and cached.
+        '''
+        key = ("qualifies", metric)
+        if key not in self.derived:
+            mask = np.ones(len(self), dtype=bool)
+            for rule, value in qualifying_load.get(metric, {}).items():
+                channels, function = load_rules[rule]
+                if not self.has(channels):
+                    continue
+                if (rule, value) not in self.derived:
+                    self.derived[(rule, value)] = function(self, value)
+                mask = mask & self.derived[(rule, value)]
+            self.derived[key] = mask
+        return self.derived[key]
 
-        if tdd_mask_perc > 25:
-            tdd_conclusion_string = (
-                f"Total Demand Distortion (TDD) values exceeded 25% for more than 25% of the month."
-                
-                )
-        else:
-            tdd_conclusion_string = (
-                f"TDD values remained under the defined tolerance of 25% for at least 75% of the month."
-                )
-                
-                
-        # Unbalance ###########################################################
-        #  TODO:  Add a mask for currents less than 30 amps
-        # Negative voltage unbalance is > 2% for more than 5% of the 30 day period 
-        # OR Negative current unbalance is > 50% for more than 5% of the 30 day period 
-        nvu_trend_avg = round(trend_df["neg_v_unbal"].mean(), 2)
-        nvu_mask = (trend_df["neg_v_unbal"] >= 2)
-        nvu_mask_df = trend_df[nvu_mask]
-        nvu_mask_time = pd.to_timedelta(nvu_mask_df["neg_v_unbal"].count(), unit='minutes')
-        nvu_mask_perc = round(100 * nvu_mask_time / report_timespan, 2)
-
-        niu_trend_avg = round(trend_df["neg_i_unbal"].mean(), 2)
-        niu_mask = (trend_df["neg_i_unbal"] >= 50)
-        niu_mask_df = trend_df[niu_mask]
-        niu_mask_time = pd.to_timedelta(niu_mask_df["neg_v_unbal"].count(), unit='minutes')
-        niu_mask_perc = round(100 * niu_mask_time / report_timespan, 2)
-
-        prev_nvu_trend_avg = round(prev_trend_df["neg_v_unbal"].mean(), 2)
-        prev_nvu_mask = (prev_trend_df["neg_v_unbal"] >= 2)
-        prev_nvu_mask_df = prev_trend_df[prev_nvu_mask]
-        prev_nvu_mask_time = pd.to_timedelta(prev_nvu_mask_df["neg_v_unbal"].count(), unit='minutes')
-        prev_nvu_mask_perc = round(100 * nvu_mask_time / prev_report_timespan, 2)
-
-        prev_niu_trend_avg = round(prev_trend_df["neg_i_unbal"].mean(), 2)
-        prev_niu_mask = (prev_trend_df["neg_i_unbal"] >= 50)
-        prev_niu_mask_df = prev_trend_df[prev_niu_mask]
-        prev_niu_mask_time = pd.to_timedelta(prev_niu_mask_df["neg_v_unbal"].count(), unit='minutes')
-        prev_niu_mask_perc = round(100 * prev_niu_mask_time / prev_report_timespan, 2)
-
-        if nvu_mask_perc > 5:
-            nvu_conclusion_string = (
-                f"Negative voltage unbalance exceeded 2% for more than 5% of the month."
-                )
-        else:
-            nvu_conclusion_string = (
-                f"Negative voltage unbalance remained within the defined tolerance of 2% for at least 95% of the month."
-                )
+    def phases(self, names):
+        '''
+        The channels names (one per phase) as one (phases x minutes) array: a view of values when they are
+        stored in consecutive rows, a copy otherwise.
+        '''
+        rows = [self.channels.get(name) for name in names]
+        if None not in rows and rows == list(range(rows[0], rows[0] + len(rows))):
+            return self.values[rows[0]:rows[0] + len(rows)]
+        return np.stack([self.view(name) for name in names])
 
-        if niu_mask_perc > 5:
-            niu_conclusion_string = (
-                f"Negative current unbalance exceeded 50% for more than 5% of the month."
-                )
-        else:
-            niu_conclusion_string = (
-                f"Negative current unbalance remained within the defined tolerance of 50% for at least 95% of the month."
-                )
-                
-        # Ground Current ######################################################
-        # 1 min avg > 0.1 amps for 30 day period
-        gnd_trend_avg = round(trend_df["gnd_curr_avg"].mean(), 2)
-        gnd_trend_max = round(trend_df["gnd_curr_avg"].max(), 2)
-        gnd_mask1 = (trend_df["gnd_curr_avg"] >= 0.1)
-        gnd_mask1_df = trend_df[gnd_mask1]
-        gnd_mask1_time = pd.to_timedelta(gnd_mask1_df["gnd_curr_avg"].count(), unit='minutes')
-        gnd_mask1_perc = round(100* gnd_mask1_time / report_timespan, 2)
-
-        gnd_mask = (trend_df["gnd_diff"] > 0.2) & (trend_df["gnd_curr_avg"] >= .1)
-        gnd_diff_result_df = trend_df[gnd_mask]
-        
-        
-        
-        
-        
+    def slice(self, first, last):
+        '''
+        SiteData of the rows first to last, with views of the timestamps and values.
+        '''
+        return SiteData(self.date_time.iloc[first:last], self.values[:, first:last], self.channels, self.nom_pn_voltage)
 
-        prev_gnd_trend_avg = round(prev_trend_df["gnd_curr_avg"].mean(), 2)
-        prev_gnd_trend_max = round(prev_trend_df["gnd_curr_avg"].max(), 2)
-        prev_gnd_mask1 = (prev_trend_df["gnd_curr_avg"] >= 0.1)
-        prev_gnd_mask1_df = prev_trend_df[prev_gnd_mask1]
-        prev_gnd_mask1_time = pd.to_timedelta(prev_gnd_mask1_df["gnd_curr_avg"].count(), unit='minutes')
-        prev_gnd_mask1_perc = round(100* prev_gnd_mask1_time / prev_report_timespan, 2)
+    def to_frame(self, names):
+        '''
+        Dataframe copy of date_time and the channels in names.
+        '''
+        return pd.DataFrame({"date_time": self.date_time, **{name: self.view(name) for name in names}})
 
-        prev_gnd_mask = (prev_trend_df["gnd_diff"] > 0.2) & (prev_trend_df["gnd_curr_avg"] >= .1)
-        prev_gnd_diff_result_df = prev_trend_df[prev_gnd_mask]
+class SiteTimeline:
+    '''
+    Minute grid of one site and report period, built once from the timestamps of its SiteData
+    (or trend dataframes) and shared by the metric functions.
+    present[i] is True when a sample was received for minute i after start, and gaps lists the runs of
+    missing minutes as (first missing minute, number of minutes).
+    Percentages are of the sampled time instead of the calendar timespan, so missing minutes do not
+    count as being within tolerance.
+    '''
+    resolution = pd.Timedelta(1, 'minutes')
 
-        if gnd_mask1_perc > 0:
-            gnd_conclusion_string = (
-                f"Ground current exceeded 0.1 A during this 30-day period for an accumulated time of {gnd_mask1_time} with an average ground current reading of {gnd_trend_avg} A and the maximum reading of {gnd_trend_max} A."
-                )
-        else: 
-            gnd_conclusion_string = (
-                f"Ground current remained within the defined tolerance of 0.1 A during this 30-day period."
-                )
-                
-        
-        
-        # print("Ground Current Events: \n", gnd_diff_result_df, "\n")
+    def __init__(self, start, end, *data):
+        self.start = pd.Timestamp(start)
+        self.end = pd.Timestamp(end)
+        self.minutes = int((self.end - self.start) / self.resolution)
+        self.present = np.zeros(self.minutes, dtype=bool)
+        for d in data:
+            if d is None:
+                continue
+            slots, rows = self.slots(d)
+            self.present[slots] = True
 
-        #######################################################################
-        #  BUILD REPORT STRINGS
-        #  
-        #######################################################################
-        
-        ##Your In-Site gateway provides six alarm indicators to help analyze and trend the quality of your facility’s power. It compares data for the current period to the data #from the previous period based on a rolling 30-day window. Below are findings for the month of ###MONTH VARIABLE. 
-        
-        report_header_string = (
-            f"###################    Monthly report for {acct_name}  ##################"
-            f"{newline}Nominal Phase to Neutral Voltage: {nom_pn_voltage} Volts"
-            f"{newline}Nominal Phase to Phase Voltage: {nom_pp_voltage} Volts"
-            f"{newline}Wiring Configuratoin: {power_config}"
-            f"{newline}"
-            f"{newline}+++ This Period +++"
-            f"{newline}Start time: {s_t}"
-            f"{newline}End time: {e_t}"
-            f"{newline}Duration: {report_timespan}"
-            f"{newline}"
-            f"{newline}+++ Prev Period +++"
-            f"{newline}Start time: {ps_str}Z"
-            f"{newline}End time: {pe_str}Z"
-            f"{newline}Duration: {pe_time - ps_time}"
-            f"{newline}################################################################################ " 
-            f"{newline}"
-            f"{newline}"
-            )
+        # -1 where a run of missing minutes starts and +1 after it ends.
+        edges = np.diff(np.concatenate(([1], self.present.astype(np.int8), [1])))
+        self.gaps = [
+            (self.start + int(s) * self.resolution, int(e - s))
+            for s, e in zip(np.flatnonzero(edges == -1), np.flatnonzero(edges == 1))
+            ]
+        self.sampled_minutes = int(self.present.sum())
+        self.sampled_timespan = self.sampled_minutes * self.resolution
 
+    def slots(self, d):
+        '''
+        Minutes of the grid and row positions of the samples of d (SiteData or trend dataframe) within the period.
+        '''
+        slots = ((pd.DatetimeIndex(d["date_time"]) - self.start) // self.resolution).to_numpy()
+        rows = np.flatnonzero((slots >= 0) & (slots < self.minutes))
+        return slots[rows], rows
 
-            
-        pwr_report_string = (
-            f"{newline}"
-            f"{newline}"
-            f"POWER"
-            
-            #f"{newline}Recommendation: {pwr_recommend}"
-            f"{newline}This measurement point had {pwr_state}in power consumption of {perc_chg}% from the previous month."
-            #f"{newline}This period energy consumption: {this_month_active_energy} kWh"
-            #f"{newline}Prev period energy consumption: {last_month_active_energy} kWh"
-            #f"{newline}Energy consumption change from prev period: {perc_chg} %"
-            #TODO A reduction in power usage of {perc_chg} % compared to the previous month.  
-            #TODO Add the reduction or increase in Max Power Demand
-            f"{newline}"
-            f"{newline}"
-            )
-            
-        pf_report_string = (
-            f"{newline}"
-            f"{newline}"
-            f"POWER FACTOR"
-            f"{newline}For this period, Power Factor (PF) degraded below 0.9 for a total of {this_month_pf_result_time} which {pf_state} the 5-hour threshold for a 30-day period.  ."
-            f"{newline}"
-            f"{newline}* Power Factor Correction may be required if your power factor slips below 0.9 for more than 5 hours in a 30-day period. Failing to correct a poor PF not only leads to much higher power bills, it may significantly damage sensitive electrical components in equipment and machinery."
-            # f"{newline}The percentage of time while PF was less than 0.9 changed by {pf_change} % from the previous month."
-            # f"{newline}Recommendation: {pf_recommend}"
-            # f"{newline}This Month"
-            # f"{newline}Total time while PF < 0.9: {this_month_pf_result_time}"
-            # f"{newline}Percentage of time in low PF: {pf_time_percent} %"
-            # f"{newline}Avg low PF: {this_month_pf_result_avg}"
-            # f"{newline}Min low PF: {this_month_pf_result_min}"
-            # f"{newline}Avg positive reactive power during low PF: {this_month_var_result_avg} VAR"
-            # f"{newline}"
-            # f"{newline}Previous Month"
-            # f"{newline}Total time while PF < 0.9: {prev_month_pf_result_time}"
-            # f"{newline}Percentage of time in low PF: {prev_pf_time_percent} %"
-            # f"{newline}Avg low PF: {prev_month_pf_result_avg}"
-            # f"{newline}Min low PF: {prev_month_pf_result_min}"
-            # #f"{newline}Avg positive reactive power during low PF: {prev_month_var_result_avg} VAR"
-            f"{newline}"
-            f"{newline}"
+    def grid(self, d, name):
+        '''
+        Values of channel name of d on the minute grid, NaN where no sample was received.
+        '''
+        values = np.full(self.minutes, np.nan)
+        slots, rows = self.slots(d)
+        values[slots] = d.view(name)[rows]
+        return values
 
-            )
-            
-        vf_report_string = (
-            f"{newline}"
-            f"{newline}"
-            f"VOLTAGE FLUCTUATION"
-            f"{newline}Short term Flicker (Pst) values exceeded 1 for {pst_mask_perc}% of the 30-day period."
-            f"{newline}{pst_conclusion_string}"
-            f"{newline}{vf_conclusion_string}"
-            # f"{newline}"
-            # f"{newline}This month's Voltage fluctuation percentages and durations by phase:"
-            # f"{newline}L1 avg fluctuation: {L1_fluct_avg} %"
-            # f"{newline}L2 avg fluctuation: {L2_fluct_avg} %"
-            # f"{newline}L3 avg fluctuation: {L3_fluct_avg} %"
-            # f"{newline}L1 fluctuation > 7% duration: {L1_fluct_time}"
-            # f"{newline}L2 fluctuation > 7% duration: {L2_fluct_time}"
-            # f"{newline}L3 fluctuation > 7% duration: {L3_fluct_time}"
-            # f"{newline}"
-            # f"{newline}* Voltage fluctuations are defined as repetitive or random variations in the magnitude of the supply voltage which may cause spurious tripping of relays, interference with communication equipment, or even severe fluctuations may not allow other loads to be started due to the reduction in supply voltage. Additionally, induction motors that operate at maximum torque may stall if voltage fluctuations are of significant magnitude."
-            # f"{newline}* The foremost effect of voltage fluctuations is lamp flicker. Lamp flicker is quantified using a measure called the short-term flicker index (Pst), which is normalized to 1.0 to represent the conventional threshold of irritability to the human eye."
-            # f"{newline}* In general, the magnitudes of these variations should not exceed 7% of the nominal supply voltage for more than 5% of the 30-day period, and Flicker Pst values should not exceed 1 for 95% of the 30-day period."    
-            # f"{newline}"
-            # f"{newline}Previous Month"
-            # f"{newline}L1 avg fluctuation: {prev_L1_fluct_avg} %"
-            # f"{newline}L2 avg fluctuation: {prev_L2_fluct_avg} %"
-            # f"{newline}L3 avg fluctuation: {prev_L3_fluct_avg} %"
-            # f"{newline}L1 fluctuation > +/- 7% time: {prev_L1_fluct_time}"
-            # f"{newline}L2 fluctuation > +/- 7% time: {prev_L2_fluct_time}"
-            # f"{newline}L3 fluctuation > +/- 7% time: {prev_L3_fluct_time}"
-            # f"{newline}"
-            # f"{newline}Total time while Flicker Pst >= {pst_threshold} : {prev_pst_time}"
-            # f"{newline}Percentage of time while flicker Pst >= {pst_threshold}: {prev_pst_mask_perc} %"
-            f"{newline}"
-            f"{newline}"
-            
-            )
+    def duration(self, mask):
+        '''
+        Sampled time during which the boolean Series mask is True.
+        '''
+        return int(mask.sum()) * self.resolution
 
-        unb_report_string = (
-            f"{newline}"
-            f"{newline}"
-            f"{newline}UNBALANCE"
-            f"{newline}{nvu_conclusion_string}"
-            f"{newline}{niu_conclusion_string}"
-            f"{newline}"
-            f"{newline}* The greatest effect of voltage unbalance is on three-phase induction motors. This will lead to a reduction in motor efficiency while reducing the insulation life caused by overheating."
-            f"{newline}* Powerside recommends that the negative sequence voltage unbalance remain under 2%, and the current unbalance to remain under 50%, both of which should remain below the thresholds for at least 95% of the 30-day period."
-            # f"{newline}This Month"
-            # f"{newline}Negative voltage unbalance average: {nvu_trend_avg} %"
-            #f"{newline}Negative current unbalance average: {niu_trend_avg} %"
-            # f"{newline}"
-            # f"{newline}Previous Month"
-            # f"{newline}Negative voltage unbalance average: {prev_nvu_trend_avg} %"
-            # f"{newline}Negative current unbalance average: {prev_niu_trend_avg} %"
-            f"{newline}"
-            f"{newline}"
-            )
-               
-        harmonic_report_string = (
-            f"{newline}"
-            f"{newline}"
-            f"{newline}HARMONICS"
-            f"{newline}{tdd_conclusion_string}"
-            f"{newline}{thd_conclusion_string}"
-            f"{newline}"
-            f"{newline}* Excessive harmonics are a concern as they may cause heating in synchronous/induction machines, interference in communication systems, or damage to capacitors and computers."
-            f"{newline}* Powerside recommends that Total Harmonic Distortion should not exceed 5% for more than 5% of a 30-day period, and the Total Demand Distortion not to exceed 25% for more than 25% of a 30-day period."
-            # f"{newline}This Month"
-            # f"{newline}Average TDD: {tdd_trend_avg} %"
-            # f"{newline}Average THD-V: {thd_trend_avg} %"
-            # f"{newline}Total time while THD-v > 5%: {thd_mask_time}"
-            # f"{newline}Percentage of time while THD-v > 5%: {thd_mask_perc} %"
-            # f"{newline}"
-            # f"{newline}Previous Month"
-            # f"{newline}Average TDD: {prev_tdd_trend_avg} %"
-            # f"{newline}Average THD-V: {prev_thd_trend_avg} %"
-            # f"{newline}Total time while THD-v > 5%: {prev_thd_mask_time}"
-            # f"{newline}Percentage of time while THD-v > 5%: {prev_thd_mask_perc} %"
-            f"{newline}"
-            f"{newline}"
-            )
-            
-         
-        gnd_report_string = (
-            f"{newline}"
-            f"{newline}"
-            f"{newline}GROUND CURRENT"
-            f"{newline}{gnd_conclusion_string}"
-            f"{newline}"
-            f"{newline}* The National Electrical Code (NEC) mandates that a ground cannot serve as a current-carrying conductor. While any amount of current over 10 milliamps (0.01 A) can produce painful to severe shock, currents between 100 and 200 mA (0.1 to 0.2 A) are lethal. Currents above 200 milliamps (0.2 A), while producing severe burns and unconsciousness, do not usually cause death if the victim is given immediate attention. Resuscitation, consisting of artificial respiration, will usually revive the victim."
-            f"{newline}* Powerside's Insite monitors and alerts when ground current exceeds a threshold of 100 milliamps (0.1 A)."
-            # f"{newline}Previous Month"
-            # f"{newline}Total time while ground current > 0.1: {prev_gnd_mask1_time}"
-            # f"{newline}Percentage of time in high gnd curr: {prev_gnd_mask1_perc} %"
-            # f"{newline}Average ground current: {prev_gnd_trend_avg} amps"
-            # f"{newline}Max of 1-min avg ground current readings: {prev_gnd_trend_max} amps"
-            f"{newline}"
-            f"{newline}"
-            )
+    def durations(self, masks):
+        '''
+        Sampled time during which each row of the (phases x minutes) boolean array masks is True.
+        '''
+        return [int(n) * self.resolution for n in masks.sum(axis=1)]
 
-        #######################################################################
-        #  PRINT REPORT STRINGS
-        # 
-        #######################################################################
-        print(report_header_string)
-        print(pwr_report_string)
-        print(pf_report_string)
-        print(vf_report_string)
-        print(unb_report_string)
-        print(harmonic_report_string)
-        print(gnd_report_string)
-        file.write(report_header_string + pwr_report_string + pf_report_string + vf_report_string + unb_report_string + harmonic_report_string +gnd_report_string)
-        
-        file.close()
+    def percent(self, duration):
+        '''
+        duration as a percentage of the sampled time.
+        '''
+        if not self.sampled_minutes:
+            return np.nan
+        return round(100 * duration / self.sampled_timespan, 2)
 
-## Add export to tables, gifs, and to a document
+    def quality_metrics(self):
+        '''
+        Coverage and gap figures of the data quality section of the report.
+        '''
+        longest = max(self.gaps, key=lambda g: g[1], default=(None, 0))
+        return {
+            "sampled_time": self.sampled_timespan,
+            "coverage_perc": round(100 * self.sampled_minutes / self.minutes, 2) if self.minutes else np.nan,
+            "gap_count": len(self.gaps),
+            "gap_time": (self.minutes - self.sampled_minutes) * self.resolution,
+            "longest_gap": longest[1] * self.resolution,
+            "longest_gap_start": longest[0].strftime('%Y-%m-%dT%H:%M:%SZ') if longest[0] is not None else None,
+            }
 
-        #######################################################################
-        #  PLOT
-        # 
-        #######################################################################
-
-        # date_format = mpl_dates.DateFormatter('%d-%m-%Y T %H:%M:%S')
-
-        # nvu_trend_hist = px.histogram(trend_df, x="neg_v_unbal",
-            # title=f"{acct_name} Histogram of Voltage Unbalance (Negative Sequence)",
-            # histnorm='percent',
-            
-            # labels={
-                # "neg_v_unbal": "Voltage Unbalance Percentage",
-                # }
-        # )
-        # nvu_trend_hist.layout.yaxis.title.text = 'Percent of Month'
-        # nvu_trend_hist.show()
-
-        # niu_trend_hist = px.histogram(trend_df, x="neg_i_unbal",
-            # title=f"{acct_name} Histogram of Current Unbalance (Negative Sequence)",
-            # histnorm='percent',
-            
-            # labels={
-                # "neg_i_unbal": "Current Unbalance Percentage",
-                # }
-        # )
-        # niu_trend_hist.layout.yaxis.title.text = 'Percent of Month'
-        # niu_trend_hist.show()
-
-        # tdd_hist = px.histogram(trend_df, x="tdd_avg",
-                                # title=f"{acct_name} Histogram of TDD %",
-                                # histnorm='percent',
-                                
-                                # labels={
-                                        # "tdd_avg": "Total Demand Distortion TDD %",
-                                        # }
-                                # )
-        # tdd_hist.layout.yaxis.title.text = 'Percent of Month'
-        # tdd_hist.show()
-
-        # thd_hist = px.histogram(trend_df, x="thd_avg",
-                                # title=f"{acct_name} Histogram of THD-v%",
-                                # histnorm='percent',
-                                
-                                # labels={
-                                        # "thd_avg": "Total Harmonic Distortion TDD-v %",
-                                        # }
-                                # )
-        # thd_hist.layout.yaxis.title.text = 'Percent of Month'
-        # thd_hist.show()
-
-        # pf_hist = px.histogram(trend_df, x="tot_pf_avg",
-                                # title=f"{acct_name} Histogram of Power Factor%",
-                                # histnorm='percent',
-                                
-                                # labels={
-                                        # "tot_pf_avg": "Total Power Factor",
-                                        # }
-                                # )
-        # pf_hist.layout.yaxis.title.text = 'Percent of Month'
-        # pf_hist.show()
-        
-        # trend_df["date_time"] = trend_df["date_time"].astype(str).str[:-6]
-        # trend_df["date_time"] = pd.to_datetime(trend_df["date_time"], format='%Y%m%d %H:%M:%S')
-        
-        # sun_gnd_plt = px.scatter(sun_df, x="date_time", y="gnd_curr_avg",
-                                    # title=f"{acct_name} Sunday Gnd Current (Amps)",
-                                    # )
-        # sun_gnd_plt.show()
-        # gnd_plots = go.Figure()
-        # gnd_plots.add_trace(go.Scatter(
-            # x=sun_df["date_time"],
-            # y=sun_df["gnd_curr_avg"],
-            # name="Sunday",
-            # mode="markers"
-            # ))  
-        # gnd_plots.add_trace(go.Scatter(
-            # x=mon_df["date_time"],
-            # y=mon_df["gnd_curr_avg"],
-            # name="Monday",
-            # mode="markers"
-            # ))
-        # gnd_plots.add_trace(go.Scatter(
-            # x=tue_df["date_time"],
-            # y=tue_df["gnd_curr_avg"],
-            # name="Tuesday",
-            # mode="markers"
-            # ))
-        # gnd_plots.add_trace(go.Scatter(
-            # x=wed_df["date_time"],
-            # y=wed_df["gnd_curr_avg"],
-            # name="Wednesday",
-            # mode="markers"
-            # ))
-        # gnd_plots.add_trace(go.Scatter(
-            # x=thu_df["date_time"],
-            # y=thu_df["gnd_curr_avg"],
-            # name="Thursday",
-            # mode="markers"
-            # ))
-        # gnd_plots.add_trace(go.Scatter(
-            # x=fri_df["date_time"],
-            # y=fri_df["gnd_curr_avg"],
-            # name="Friday",
-            # mode="markers"
-            # ))
-        # gnd_plots.add_trace(go.Scatter(
-            # x=sat_df["date_time"],
-            # y=sat_df["gnd_curr_avg"],
-            # name="Saturday",
-            # mode="markers"
-            # ))
-            
-        
-        # fig.update_layout(
-            # xaxis=dict(
-                # domain=[0.3, 0.7]
-            # ),
-            # yaxis=dict(
-                # title="yaxis title",
-                # titlefont=dict(
-                    # color="#1f77b4"
-                # ),
-                # tickfont=dict(
-                    # color="#1f77b4"
-                # )
-            # ),
-            # yaxis2=dict(
-                # title="yaxis2 title",
-                # titlefont=dict(
-                    # color="#ff7f0e"
-                # ),
-                # tickfont=dict(
-                    # color="#ff7f0e"
-                # ),
-                # anchor="free",
-                # overlaying="y",
-                # side="left",
-                # position=0.15
-            # ),
-            # yaxis3=dict(
-                # title="yaxis3 title",
-                # titlefont=dict(
-                    # color="#d62728"
-                # ),
-                # tickfont=dict(
-                    # color="#d62728"
-                # ),
-                # anchor="x",
-                # overlaying="y",
-                # side="right"
-            # ),
-            # yaxis4=dict(
-                # title="yaxis4 title",
-                # titlefont=dict(
-                    # color="#9467bd"
-                # ),
-                # tickfont=dict(
-                    # color="#9467bd"
-                # ),
-                # anchor="free",
-                # overlaying="y",
-                # side="right",
-                # position=0.85
-            # )
-        # )
-
-        # # Update layout properties
-        # fig.update_layout(
-            # title_text="multiple y-axes example",
-            # width=800,
-        # )
-
-        #gnd_plots.show()
-        
-        # trend_csv = trend_df.to_csv(f"{acct_name}output.csv", index = True)
-        # sun_csv = sun_df.to_csv(f"{acct_name}_sun.csv", index = True)
-        # mon_csv = mon_df.to_csv(f"{acct_name}_mon.csv", index = True)
-        # tue_csv = tue_df.to_csv(f"{acct_name}_tue.csv", index = True)
-        # wed_csv = wed_df.to_csv(f"{acct_name}_wed.csv", index = True)
-        # thu_csv = thu_df.to_csv(f"{acct_name}_thu.csv", index = True)
-        # fri_csv = fri_df.to_csv(f"{acct_name}_fri.csv", index = True)
-        # sat_csv = sat_df.to_csv(f"{acct_name}_sat.csv", index = True)
+def aggregate_metrics(pq, report_timespan):
+    '''
+    Answer report metrics from the server-side aggregates returned by get_pq_meausres.
+    Returns a dict keyed by metric ("pf", "thd", "tdd", "nvu", "niu", "gnd", "pst", "vf") holding the
+    values used by the report strings. A metric is left out when its aggregate is missing, reported
+    as not enough data (powerQualityStatusType 3), covers less than aggregate_min_coverage of the period,
+    or lies within aggregate_margin of the threshold, so the caller knows to download its minute trend.
+        - P95 below a threshold means the threshold was exceeded for at most 5% of the samples.
+        - TDD and Pst are judged over 25% and 95% of the month, so a P95 only answers the "within" case.
+    Power factor, ground current and voltage fluctuation are never answered:
+        - The power factor "count" and "coverage" are not documented as minutes below 0.9 at qualifying load.
+        - groundCurrentPrior30Days is a single value that is not documented as the period's peak rather than
+          its average, so it cannot rule out minutes above 0.1 A.
+        - The P05 and P95 RMS voltages only bound the time outside the 7% band to 10%, not the 5% of the
+          report, and are not per phase.
+    '''
+    decided = {}
+    if not pq:
+        return decided
 
-        #print(trend_df)
-        # plt.gca().xaxis.set_major_formatter(date_format)
+    expected_samples = report_timespan / pd.Timedelta(1, 'minutes')
 
-        # sns.scatterplot(x="date_time", y="gnd_curr_avg", data=gnd_diff_result_df)
-        # plt.xticks(rotation=90)
-        # plt.title("Ground Current")
-        # plt.show()
+    def value(key):
+        measure = pq.get(key) or {}
+        if measure.get('powerQualityStatusType') == 3:
+            return None
+        v = measure.get('value')
+        if isinstance(v, dict):
+            samples = v.get('samplesThisPeriod')
+            if samples is not None and samples < aggregate_min_coverage * expected_samples:
+                return None
+        return v
 
+    def below(x, threshold):
+        # True when clearly below the threshold, False when clearly above, None when near or unknown
+        if x is None:
+            return None
+        if abs(x - threshold) <= aggregate_margin * threshold:
+            return None
+        return x < threshold
 
-        # fig = go.Figure(data=go.Scatter(x=trend_df['date_time'], y=trend_df['gnd_curr_avg']))
-        # fig.update_layout(title = 'Ground Current Events')
-        # fig.show()
+    harmonics = value('harmonicsPrior30Days') or {}
+    thd_below = below(harmonics.get('P95_THD'), 5)
+    if thd_below is not None:
+        decided["thd"] = {"thd_conclusion_string": conclusion_strings["thd"]["within" if thd_below else "exceeded"]}
+    if below(harmonics.get('P95_TDD'), 25):
+        decided["tdd"] = {"tdd_conclusion_string": conclusion_strings["tdd"]["within"]}
 
-        # fig1 = px.scatter(x=gnd_diff_result_df['date_time'], y=gnd_diff_result_df['gnd_curr_avg'])
-        # fig1.show()
+    imbalance = value('imbalancePrior30Days') or {}
+    nvu_below = below(imbalance.get('P95_V_UNB'), 2)
+    if nvu_below is not None:
+        decided["nvu"] = {"nvu_conclusion_string": conclusion_strings["nvu"]["within" if nvu_below else "exceeded"]}
+    niu_below = below(imbalance.get('P95_I_UNB'), 50)
+    if niu_below is not None:
+        decided["niu"] = {"niu_conclusion_string": conclusion_strings["niu"]["within" if niu_below else "exceeded"]}
 
-        # fig2 = px.scatter(x=pf_diff_result_df['date_time'], y=pf_diff_result_df['tot_pf_avg'])
-        # fig2.show()
+    volt_fluct = value('voltageFluctuationsPrior30Days') or {}
+    if below(volt_fluct.get('P95_PST'), 1):
+        decided["pst"] = {
+            "pst_p95": volt_fluct['P95_PST'],
+            "pst_conclusion_string": conclusion_strings["pst"]["within"],
+            }
 
+    return decided
 
-        # print("Description of trends dataframe: \n", trend_df.describe(), "\n")
+def fixed_histogram(values, channel):
+    '''
+    Counts of a channel's values in its histogram_bins, with an underflow bin first and an overflow bin last.
+    NaN values are not counted.
+    '''
+    low, high, width = histogram_bins[channel]
+    n_bins = int(round((high - low) / width))
+    v = np.asarray(values, dtype=float)
+    v = v[~np.isnan(v)]
+    b = np.clip(np.floor((v - low) / width), -1, n_bins).astype(np.int64) + 1
+    return np.bincount(b, minlength=n_bins + 2).astype(np.int32)
 
-        # corrrelation = trend_df.corr(method="pearson");
-        # print("Pearson correlation coefficient:");
-        # print(corrrelation);
+def histogram_edges(channel):
+    '''
+    Bin edges of a channel's histogram, without the underflow and overflow bins.
+    '''
+    low, high, width = histogram_bins[channel]
+    return low + width * np.arange(int(round((high - low) / width)) + 1)
 
-        # corrrelation    = trend_df.corr(method="kendall");
-        # print("Kendall Tau correlation coefficient:");
-        # print(corrrelation);
+def histogram_quantile(hist, channel, q):
+    '''
+    Approximate q quantile (0 to 1) of the values counted in a fixed_histogram of channel, interpolated linearly
+    within its bin. The exact quantile lies in the same bin, so the error is at most one bin width of histogram_bins,
+    except in the underflow and overflow bins, for which the lower or upper edge is returned.
+    NaN for an empty histogram.
+    '''
+    total = hist.sum()
+    if not total:
+        return np.nan
+    edges = histogram_edges(channel)
+    cumulative = np.cumsum(hist)
+    rank = q * total
+    b = int(np.searchsorted(cumulative, rank))
+    if b == 0:
+        return edges[0]
+    if b >= len(edges):
+        return edges[-1]
+    return edges[b - 1] + (rank - cumulative[b - 1]) / hist[b] * (edges[b] - edges[b - 1])
 
-        # corrrelation    = trend_df.corr(method="spearman");
-        # print("Spearman rank correlation:");
-        # print(corrrelation);
+def local_energy_data(site_data, s_t, e_t):
+    '''
+    Energy figures of get_energy_data computed from the tot_activ_pwr_avg (W) and tot_pf_avg minute trends
+    from s_t to e_t:
+        - totalActiveEnergyConsumed (kWh): active power integrated over the sampled minutes.
+        - maxActivePowerDemand (kW): highest demand_window minute rolling average of active power,
+          starting at dateTimeOfMaxActivePowerDemand, and powerFactorAtMaxDemand the average PF over it.
+        - avgActivePowerDemand (kW) and avgLoadFactor (average / peak demand, %).
+    Returns None when the power trend is missing or covers less than local_energy_min_coverage of the period.
+    '''
+    if site_data is None or not site_data.has(["tot_activ_pwr_avg"]):
+        return None
+    timeline = SiteTimeline(s_t, e_t, site_data)
+    power = timeline.grid(site_data, "tot_activ_pwr_avg")
+    sampled = np.isfinite(power)
+    samples = int(sampled.sum())
+    if not samples or samples < local_energy_min_coverage * timeline.minutes:
+        return None
+
+    energy = power[sampled].sum() / 60 / 1000
+    avg_demand = energy / (samples / 60)
+
+    # Window sums from cumulative sums; a window only counts when all of its minutes were sampled.
+    w = demand_window
+    power_sum = np.concatenate(([0], np.cumsum(np.where(sampled, power, 0))))
+    sampled_sum = np.concatenate(([0], np.cumsum(sampled)))
+    full = (sampled_sum[w:] - sampled_sum[:-w]) == w
+    demand = np.where(full, (power_sum[w:] - power_sum[:-w]) / w / 1000, -np.inf)
+    peak_demand, peak_time, peak_pf = np.nan, None, np.nan
+    if full.any():
+        peak = int(np.argmax(demand))
+        peak_demand = demand[peak]
+        peak_time = (timeline.start + peak * timeline.resolution).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        if site_data.has(["tot_pf_avg"]):
+            peak_pf = np.nanmean(timeline.grid(site_data, "tot_pf_avg")[peak:peak + w])
+
+    return {
+        "source": "trend",
+        "totalActiveEnergyConsumed": energy,
+        "maxActivePowerDemand": peak_demand,
+        "dateTimeOfMaxActivePowerDemand": peak_time,
+        "powerFactorAtMaxDemand": peak_pf,
+        "avgActivePowerDemand": avg_demand,
+        "avgLoadFactor": 100 * avg_demand / peak_demand,
+        "samples": samples,
+        }
+
+def demand_metrics(energy_dict, last_energy_dict):
+    '''
+    Peak demand figures of the period from the energy data computed from the power trend (see local_energy_data).
+    Empty when the energy came from the server.
+    '''
+    if energy_dict.get("source") != "trend":
+        return {}
+    m = {
+        "max_demand": round(energy_dict["maxActivePowerDemand"], 2),
+        "max_demand_time": energy_dict["dateTimeOfMaxActivePowerDemand"],
+        "pf_at_max_demand": round(energy_dict["powerFactorAtMaxDemand"], 2),
+        "avg_demand": round(energy_dict["avgActivePowerDemand"], 2),
+        "load_factor": round(energy_dict["avgLoadFactor"], 2),
+        }
+    if last_energy_dict.get("source") == "trend":
+        m["prev_max_demand"] = round(last_energy_dict["maxActivePowerDemand"], 2)
+        m["max_demand_chg"] = round(100 * (m["max_demand"] - m["prev_max_demand"]) / m["prev_max_demand"], 2)
+    return m
+
+def power_metrics(this_month_active_energy, last_month_active_energy, last_year_active_energy=None):
+    '''
+    This 30 day period energy use is > 15% compared to prev month
+    OR this 30 day period > 30% of prev year 30 day period
+    The year over year change is only computed when last year's energy is known (see rollup_energy).
+    pwr_recommend is kept in the results store and returned by the metrics service; the report text does not print it.
+    '''
+    #print(last_month_active_energy)
+    chg = this_month_active_energy - last_month_active_energy
+    perc_chg = abs(round(100 * chg / last_month_active_energy, 2))
+    #print("percent change")
+    #print(perc_chg, "percent change")
+    pwr_recommend = None
+    if perc_chg >= 0 and perc_chg <= 15:
+        pwr_recommend = "No action."
+        pwr_state = "a minor increase "
+    elif perc_chg < 0:
+        pwr_state = "a reduction "
+    else:
+        pwr_recommend = "Investigate increase in energy consumption."
+        pwr_state = "an excessive increase "
+
+    m = {
+        "this_month_active_energy": this_month_active_energy,
+        "last_month_active_energy": last_month_active_energy,
+        "perc_chg": perc_chg,
+        "pwr_state": pwr_state,
+        "pwr_recommend": pwr_recommend,
+        }
+    if last_year_active_energy:
+        yoy_perc_chg = round(100 * (this_month_active_energy - last_year_active_energy) / last_year_active_energy, 2)
+        if yoy_perc_chg > 30:
+            m["pwr_recommend"] = "Investigate increase in energy consumption."
+        m.update({
+            "last_year_active_energy": last_year_active_energy,
+            "yoy_perc_chg": yoy_perc_chg,
+            })
+    return m
+
+def pf_metrics(site_data, prev_site_data, timeline, prev_timeline):
+    '''
+    Below 0.9 more than 5 cumulated hrs over 30 days.
+    Only minutes meeting the "pf" qualifying_load rules are counted (e.g. {"min_power_fraction": 0.4} leaves out
+    PF values below 40% of maximum kW). The previous month also only counts minutes with all phase currents above 40 A.
+    '''
+    pf_mask = (site_data["tot_pf_avg"] < 0.9) & site_data.qualifies("pf")
+    pf_result = site_data["tot_pf_avg"][pf_mask]
+    #print(pf_result)
+    this_month_pf_result_time = timeline.duration(pf_mask)
+    pf_time_percent = timeline.percent(this_month_pf_result_time)
+    this_month_pf_result_avg = round(pf_result.mean(), 2)
+    this_month_pf_result_min = round(pf_result.min(), 2)
+    #this_month_var_result_avg = round(site_data["tot_react_pwr_avg"][pf_mask].mean(), 2)
+
+    if this_month_pf_result_time > pd.Timedelta(5,'h'):
+        pf_state = "exceeds"
+    else:
+        pf_state = "is within tolerance of"
+
+    m = {
+        "this_month_pf_result_time": this_month_pf_result_time,
+        "pf_time_percent": pf_time_percent,
+        "tot_pf_avg_hist": fixed_histogram(site_data["tot_pf_avg"], "tot_pf_avg"),
+        "this_month_pf_result_avg": this_month_pf_result_avg,
+        "this_month_pf_result_min": this_month_pf_result_min,
+        "pf_state": pf_state,
+        }
+    if prev_site_data is None:
+        return m
+
+    prev_all_loaded = phase_band(prev_site_data.phases(phase_currents), high=40)[2]
+    prev_pf_mask = (prev_site_data["tot_pf_avg"] < 0.9) & prev_all_loaded & prev_site_data.qualifies("pf")
+    prev_pf_result = prev_site_data["tot_pf_avg"][prev_pf_mask]
+    prev_month_pf_result_time = prev_timeline.duration(prev_pf_mask)
+    prev_pf_time_percent = prev_timeline.percent(prev_month_pf_result_time)
+    prev_month_pf_result_avg = round(prev_pf_result.mean(), 2)
+    prev_month_pf_result_min = round(prev_pf_result.min(), 2)
+    #prev_month_var_result_avg = round(prev_site_data["tot_react_pwr_avg"][prev_pf_mask].mean(), 2)
+    pf_change = round(pf_time_percent - prev_pf_time_percent, 2)
+
+    if pf_change > 0:
+        pf_recommend = "Investigate why power factor has degraded since previous month"
+    else:
+        pf_recommend = "No action."
+
+    m.update({
+        "prev_month_pf_result_time": prev_month_pf_result_time,
+        "prev_pf_time_percent": prev_pf_time_percent,
+        "prev_month_pf_result_avg": prev_month_pf_result_avg,
+        "prev_month_pf_result_min": prev_month_pf_result_min,
+        "pf_change": pf_change,
+        "pf_recommend": pf_recommend,
+        })
+    return m
+
+def phase_fluct_metrics(site_data, nom_pn_voltage, timeline, prefix=""):
+    '''
+    Voltage fluctuation of the three phases of one period, evaluated as one (phases x minutes) array:
+    average fluctuation (percent of nominal phase to neutral voltage), time outside +/- 7% of nominal per phase,
+    and the time any phase / all phases were outside. Metric names start with prefix.
+    '''
+    volts = site_data.phases(phase_voltages)
+    fluct_avg = phase_means(np.abs(1 - nom_pn_voltage / volts) * 100)
+
+    lower_fluct_thresh = nom_pn_voltage - nom_pn_voltage*0.07
+    upper_fluct_thresh = nom_pn_voltage + nom_pn_voltage*0.07
+    outside, any_outside, all_outside = phase_band(volts, lower_fluct_thresh, upper_fluct_thresh)
+    qualifies = site_data.qualifies("vf")
+    outside, any_outside, all_outside = outside & qualifies, any_outside & qualifies, all_outside & qualifies
+
+    m = {}
+    for phase, avg, fluct_time in zip(phase_names, fluct_avg, timeline.durations(outside)):
+        m[f"{prefix}{phase}_fluct_avg"] = round(avg, 2)
+        m[f"{prefix}{phase}_fluct_time"] = fluct_time
+        m[f"{prefix}{phase}_fluct_time_perc"] = timeline.percent(fluct_time)
+    m[f"{prefix}vf_any_phase_time"] = timeline.duration(any_outside)
+    m[f"{prefix}vf_any_phase_time_perc"] = timeline.percent(m[f"{prefix}vf_any_phase_time"])
+    m[f"{prefix}vf_all_phases_time"] = timeline.duration(all_outside)
+    m[f"{prefix}vf_all_phases_time_perc"] = timeline.percent(m[f"{prefix}vf_all_phases_time"])
+    return m
+
+def pst_metrics(site_data, prev_site_data, timeline, prev_timeline):
+    '''
+    10min Pst > 1 for 95% of 30 day period.
+    '''
+    pst_threshold = 1
+    pst_mask = (site_data["tot_Pst_avg"] >= pst_threshold) & site_data.qualifies("pst")
+
+    pst_time = timeline.duration(pst_mask)
+    pst_mask_perc = timeline.percent(pst_time)
+
+    if pst_mask_perc > 95:
+        pst_conclusion_string = conclusion_strings["pst"]["exceeded"]
+    else:
+        pst_conclusion_string = conclusion_strings["pst"]["within"]
+    #print(site_data["tot_Pst_avg"][pst_mask])
+
+    m = {
+        "pst_threshold": pst_threshold,
+        "pst_time": pst_time,
+        "pst_mask_perc": pst_mask_perc,
+        "pst_conclusion_string": pst_conclusion_string,
+        }
+    if prev_site_data is None:
+        return m
+
+    prev_pst_mask = (prev_site_data["tot_Pst_avg"] >= pst_threshold) & prev_site_data.qualifies("pst")
+
+    prev_pst_time = prev_timeline.duration(prev_pst_mask)
+    prev_pst_mask_perc = prev_timeline.percent(prev_pst_time)
+
+    m.update({
+        "prev_pst_time": prev_pst_time,
+        "prev_pst_mask_perc": prev_pst_mask_perc,
+        })
+    return m
+
+def vf_metrics(site_data, prev_site_data, nom_pn_voltage, timeline, prev_timeline):
+    '''
+    1min volt outside +/- 7% nom_pn_voltage more than 5% of 30 day period.
+    TODO look into taknig average variance of nom_pn_voltage as a metric to display.
+     Report would show Voltage fluctuation percentage to 347 L-N: max, min, avg
+    '''
+    m = phase_fluct_metrics(site_data, nom_pn_voltage, timeline)
+
+    # Within tolerance when any phase was outside the band for less than 5% of the time.
+    if any(m[f"{phase}_fluct_time_perc"] < 5 for phase in phase_names):
+        m["vf_conclusion_string"] = conclusion_strings["vf"]["within"]
+    else:
+        m["vf_conclusion_string"] = conclusion_strings["vf"]["exceeded"]
+    if prev_site_data is None:
+        return m
+
+    m.update(phase_fluct_metrics(prev_site_data, nom_pn_voltage, prev_timeline, "prev_"))
+    return m
+
+def harmonic_metrics(site_data, prev_site_data, timeline, prev_timeline):
+    '''
+    1min THD-v >5% for more than 5% of 30 day period
+    OR 1 min  current TDD >25% for more than 25% of the 30 day period
+    '''
+    tdd_trend_max = site_data["tdd_avg"].max()
+    tdd_trend_avg = round(site_data["tdd_avg"].mean(), 2)
+    thd_trend_avg = round(site_data["thd_avg"].mean(), 2)
+    tdd_thresh = round(tdd_trend_max - tdd_trend_avg, 2)
+    tdd_mask = (site_data["tdd_avg"] >= 25) & site_data.qualifies("tdd")
+    tdd_mask_time = timeline.duration(tdd_mask)
+    tdd_mask_perc = timeline.percent(tdd_mask_time)
+
+    thd_mask = (site_data["thd_avg"] >= 5) & site_data.qualifies("thd")
+    thd_mask_time = timeline.duration(thd_mask)
+    thd_mask_perc = timeline.percent(thd_mask_time)
+    #print("tdd thresh    ", tdd_thresh)
+
+    if thd_mask_perc > 5:
+        thd_conclusion_string = conclusion_strings["thd"]["exceeded"]
+    else:
+        thd_conclusion_string = conclusion_strings["thd"]["within"]
+
+    if tdd_mask_perc > 25:
+        tdd_conclusion_string = conclusion_strings["tdd"]["exceeded"]
+    else:
+        tdd_conclusion_string = conclusion_strings["tdd"]["within"]
+
+    m = {
+        "tdd_trend_max": tdd_trend_max,
+        "tdd_trend_avg": tdd_trend_avg,
+        "thd_trend_avg": thd_trend_avg,
+        "tdd_thresh": tdd_thresh,
+        "tdd_avg_hist": fixed_histogram(site_data["tdd_avg"], "tdd_avg"),
+        "thd_avg_hist": fixed_histogram(site_data["thd_avg"], "thd_avg"),
+        "tdd_mask_time": tdd_mask_time,
+        "tdd_mask_perc": tdd_mask_perc,
+        "thd_mask_time": thd_mask_time,
+        "thd_mask_perc": thd_mask_perc,
+        "thd_conclusion_string": thd_conclusion_string,
+        "tdd_conclusion_string": tdd_conclusion_string,
+        }
+    if prev_site_data is None:
+        return m
+
+    prev_tdd_trend_max = prev_site_data["tdd_avg"].max()
+    prev_tdd_trend_avg = round(prev_site_data["tdd_avg"].mean(), 2)
+    prev_thd_trend_avg = round(prev_site_data["thd_avg"].mean(), 2)
+    prev_tdd_thresh = round(prev_tdd_trend_max - tdd_trend_avg, 2)
+    prev_tdd_mask = (prev_site_data["tdd_avg"] >= 25) & prev_site_data.qualifies("tdd")
+    prev_tdd_mask_time = prev_timeline.duration(prev_tdd_mask)
+    prev_tdd_mask_perc = prev_timeline.percent(prev_tdd_mask_time)
+
+    prev_thd_mask = (prev_site_data["thd_avg"] >= 5) & prev_site_data.qualifies("thd")
+    prev_thd_mask_time = prev_timeline.duration(prev_thd_mask)
+    prev_thd_mask_perc = prev_timeline.percent(prev_thd_mask_time)
+
+    m.update({
+        "prev_tdd_trend_max": prev_tdd_trend_max,
+        "prev_tdd_trend_avg": prev_tdd_trend_avg,
+        "prev_thd_trend_avg": prev_thd_trend_avg,
+        "prev_tdd_thresh": prev_tdd_thresh,
+        "prev_tdd_mask_time": prev_tdd_mask_time,
+        "prev_tdd_mask_perc": prev_tdd_mask_perc,
+        "prev_thd_mask_time": prev_thd_mask_time,
+        "prev_thd_mask_perc": prev_thd_mask_perc,
+        })
+    return m
+
+def unbalance_metrics(site_data, prev_site_data, timeline, prev_timeline):
+    '''
+    Negative voltage unbalance is > 2% for more than 5% of the 30 day period
+    OR Negative current unbalance is > 50% for more than 5% of the 30 day period
+    Current unbalance at light load can be left out with the "niu" qualifying_load rules (e.g. {"min_phase_current": 30}).
+    '''
+    nvu_trend_avg = round(site_data["neg_v_unbal"].mean(), 2)
+    nvu_mask = (site_data["neg_v_unbal"] >= 2) & site_data.qualifies("nvu")
+    nvu_mask_time = timeline.duration(nvu_mask)
+    nvu_mask_perc = timeline.percent(nvu_mask_time)
+
+    niu_trend_avg = round(site_data["neg_i_unbal"].mean(), 2)
+    niu_mask = (site_data["neg_i_unbal"] >= 50) & site_data.qualifies("niu")
+    niu_mask_time = timeline.duration(niu_mask & site_data["neg_v_unbal"].notna())
+    niu_mask_perc = timeline.percent(niu_mask_time)
+
+    if nvu_mask_perc > 5:
+        nvu_conclusion_string = conclusion_strings["nvu"]["exceeded"]
+    else:
+        nvu_conclusion_string = conclusion_strings["nvu"]["within"]
+
+    if niu_mask_perc > 5:
+        niu_conclusion_string = conclusion_strings["niu"]["exceeded"]
+    else:
+        niu_conclusion_string = conclusion_strings["niu"]["within"]
+
+    m = {
+        "nvu_trend_avg": nvu_trend_avg,
+        "neg_v_unbal_hist": fixed_histogram(site_data["neg_v_unbal"], "neg_v_unbal"),
+        "nvu_mask_time": nvu_mask_time,
+        "nvu_mask_perc": nvu_mask_perc,
+        "niu_trend_avg": niu_trend_avg,
+        "neg_i_unbal_hist": fixed_histogram(site_data["neg_i_unbal"], "neg_i_unbal"),
+        "niu_mask_time": niu_mask_time,
+        "niu_mask_perc": niu_mask_perc,
+        "nvu_conclusion_string": nvu_conclusion_string,
+        "niu_conclusion_string": niu_conclusion_string,
+        }
+    if prev_site_data is None:
+        return m
+
+    prev_nvu_trend_avg = round(prev_site_data["neg_v_unbal"].mean(), 2)
+    prev_nvu_mask = (prev_site_data["neg_v_unbal"] >= 2) & prev_site_data.qualifies("nvu")
+    prev_nvu_mask_time = prev_timeline.duration(prev_nvu_mask)
+    prev_nvu_mask_perc = prev_timeline.percent(nvu_mask_time)
+
+    prev_niu_trend_avg = round(prev_site_data["neg_i_unbal"].mean(), 2)
+    prev_niu_mask = (prev_site_data["neg_i_unbal"] >= 50) & prev_site_data.qualifies("niu")
+    prev_niu_mask_time = prev_timeline.duration(prev_niu_mask & prev_site_data["neg_v_unbal"].notna())
+    prev_niu_mask_perc = prev_timeline.percent(prev_niu_mask_time)
+
+    m.update({
+        "prev_nvu_trend_avg": prev_nvu_trend_avg,
+        "prev_nvu_mask_time": prev_nvu_mask_time,
+        "prev_nvu_mask_perc": prev_nvu_mask_perc,
+        "prev_niu_trend_avg": prev_niu_trend_avg,
+        "prev_niu_mask_time": prev_niu_mask_time,
+        "prev_niu_mask_perc": prev_niu_mask_perc,
+        })
+    return m
+
+def gnd_metrics(site_data, prev_site_data, timeline, prev_timeline):
+    '''
+    1 min avg > 0.1 amps for 30 day period
+    '''
+    gnd_trend_avg = round(site_data["gnd_curr_avg"].mean(), 2)
+    gnd_trend_max = round(site_data["gnd_curr_avg"].max(), 2)
+    gnd_mask1 = (site_data["gnd_curr_avg"] >= 0.1) & site_data.qualifies("gnd")
+    gnd_mask1_time = timeline.duration(gnd_mask1)
+    gnd_mask1_perc = timeline.percent(gnd_mask1_time)
+
+    gnd_mask = (site_data["gnd_diff"] > 0.2) & gnd_mask1
+
+    if gnd_mask1_perc > 0:
+        gnd_conclusion_string = (
+            f"Ground current exceeded 0.1 A during this 30-day period for an accumulated time of {gnd_mask1_time} with an average ground current reading of {gnd_trend_avg} A and the maximum reading of {gnd_trend_max} A."
+            )
+    else:
+        gnd_conclusion_string = conclusion_strings["gnd"]["within"]
+    # print("Ground Current Events: \n", site_data["gnd_curr_avg"][gnd_mask], "\n")
+
+    m = {
+        "gnd_trend_avg": gnd_trend_avg,
+        "gnd_trend_max": gnd_trend_max,
+        "gnd_mask1_time": gnd_mask1_time,
+        "gnd_mask1_perc": gnd_mask1_perc,
+        "gnd_diff_events": int(gnd_mask.sum()),
+        "gnd_conclusion_string": gnd_conclusion_string,
+        }
+    if prev_site_data is None:
+        return m
+
+    prev_gnd_trend_avg = round(prev_site_data["gnd_curr_avg"].mean(), 2)
+    prev_gnd_trend_max = round(prev_site_data["gnd_curr_avg"].max(), 2)
+    prev_gnd_mask1 = (prev_site_data["gnd_curr_avg"] >= 0.1) & prev_site_data.qualifies("gnd")
+    prev_gnd_mask1_time = prev_timeline.duration(prev_gnd_mask1)
+    prev_gnd_mask1_perc = prev_timeline.percent(prev_gnd_mask1_time)
+
+    prev_gnd_mask = (prev_site_data["gnd_diff"] > 0.2) & prev_gnd_mask1
+
+    m.update({
+        "prev_gnd_trend_avg": prev_gnd_trend_avg,
+        "prev_gnd_trend_max": prev_gnd_trend_max,
+        "prev_gnd_mask1_time": prev_gnd_mask1_time,
+        "prev_gnd_mask1_perc": prev_gnd_mask1_perc,
+        "prev_gnd_diff_events": int(prev_gnd_mask.sum()),
+        })
+    return m
+
+class MetricsAccumulator:
+    '''
+    Report metrics of one site and period computed from its minute data in chunks: SiteData of consecutive time
+    ranges (see stream_trend_chunks), added in time order. Only running figures are kept, so memory does not grow
+    with the period: threshold minute counts, counts, sums, min and max of the channels, their histograms, the last
+    row of the previous chunk (for the step events) and the last demand_window minutes of active power.
+    metrics() returns the figures of the report period that compute_site_metrics returns for the same data:
+        - durations, percentages, min, max, histograms, step events and data quality figures are identical;
+        - averages and energy are sums over the chunks, identical up to floating point rounding;
+        - <channel>_p95 of the histogram_bins channels is read from the histograms (see histogram_quantile).
+    The previous period metrics are not computed.
+    '''
+    resolution = SiteTimeline.resolution
+
+    def __init__(self, start, end, names, nom_pn_voltage):
+        if get_period_load_rules():
+            metric, rule = get_period_load_rules()[0]
+            raise ValueError(f"The {rule} qualifying load rule of {metric} needs the whole period and cannot be streamed")
+        self.start = pd.Timestamp(start)
+        self.end = pd.Timestamp(end)
+        self.minutes = int((self.end - self.start) / self.resolution)
+        self.names = list(names)
+        self.nom_pn_voltage = nom_pn_voltage
+
+        self.sampled_minutes = 0
+        self.last_slot = -1
+        self.gap_count = 0
+        self.longest_gap = (None, 0)
+        self.stats = {}
+        self.counts = {}
+        self.histograms = {name: np.zeros(len(histogram_edges(name)) + 1, dtype=np.int64) for name in histogram_bins if name in self.names}
+        self.last_row = {}
+
+        # Local energy and demand (see local_energy_data): the minute grid is built up to grid_end.
+        self.grid_end = 0
+        self.power_tail = np.empty(0)
+        self.pf_tail = np.empty(0)
+        self.energy = 0.0
+        self.power_samples = 0
+        self.peak = (-np.inf, None, np.nan)
+
+    def has(self, *metrics):
+        return all(name in self.names for name in get_metric_channels(metrics, rules=False))
+
+    def count(self, name, mask):
+        self.counts[name] = self.counts.get(name, 0) + int(np.count_nonzero(mask))
+
+    def update_stats(self, name, x):
+        # [count, sum, min, max] of the values of x that are not NaN.
+        x = x[~np.isnan(x)]
+        stats = self.stats.setdefault(name, [0, 0.0, np.nan, np.nan])
+        if len(x):
+            stats[2] = min(stats[2], x.min()) if stats[0] else x.min()
+            stats[3] = max(stats[3], x.max()) if stats[0] else x.max()
+            stats[0] += len(x)
+            stats[1] += x.sum()
+
+    def add(self, chunk):
+        '''
+        Add the minute data of the SiteData chunk, which follows the chunks added before.
+        '''
+        if not len(chunk):
+            return
+        slots = ((pd.DatetimeIndex(chunk["date_time"]) - self.start) // self.resolution).to_numpy()
+        self.add_minutes(slots)
+        self.add_power(chunk, slots)
+
+        if self.has("pf"):
+            pf = chunk.view("tot_pf_avg")
+            low = (pf < 0.9) & chunk.qualifies("pf")
+            self.count("pf", low)
+            self.update_stats("pf_low", pf[low])
+        if self.has("thd", "tdd"):
+            self.count("tdd", (chunk.view("tdd_avg") >= 25) & chunk.qualifies("tdd"))
+            self.count("thd", (chunk.view("thd_avg") >= 5) & chunk.qualifies("thd"))
+        if self.has("nvu", "niu"):
+            nvu = chunk.view("neg_v_unbal")
+            self.count("nvu", (nvu >= 2) & chunk.qualifies("nvu"))
+            self.count("niu", (chunk.view("neg_i_unbal") >= 50) & chunk.qualifies("niu") & ~np.isnan(nvu))
+        if self.has("gnd"):
+            gnd = chunk.view("gnd_curr_avg")
+            high = (gnd >= 0.1) & chunk.qualifies("gnd")
+            self.count("gnd", high)
+            # Steps from the last row of the previous chunk, like gnd_diff over the whole period.
+            steps = np.diff(np.concatenate(([self.last_row.get("gnd_curr_avg", np.nan)], gnd)))
+            self.count("gnd_steps", (steps > 0.2) & high)
+        if self.has("pst"):
+            self.count("pst", (chunk.view("tot_Pst_avg") >= 1) & chunk.qualifies("pst"))
+        if self.has("vf"):
+            nom = self.nom_pn_voltage
+            volts = chunk.phases(phase_voltages)
+            outside, any_outside, all_outside = phase_band(volts, nom - nom*0.07, nom + nom*0.07)
+            qualifies = chunk.qualifies("vf")
+            for phase, fluct, phase_outside in zip(phase_names, np.abs(1 - nom / volts) * 100, outside & qualifies):
+                self.update_stats(f"{phase}_fluct", fluct)
+                self.count(f"{phase}_fluct", phase_outside)
+            self.count("vf_any_phase", any_outside & qualifies)
+            self.count("vf_all_phases", all_outside & qualifies)
+
+        for name in self.names:
+            self.update_stats(name, chunk.view(name))
+            self.last_row[name] = chunk.view(name)[-1]
+        for name, hist in self.histograms.items():
+            hist += fixed_histogram(chunk.view(name), name)
+
+    def add_minutes(self, slots):
+        # Sampled minutes and the runs of missing minutes before them (see SiteTimeline.gaps).
+        slots = np.unique(slots[(slots > self.last_slot) & (slots < self.minutes)])
+        if not len(slots):
+            return
+        runs = np.diff(np.concatenate(([self.last_slot], slots))) - 1
+        self.gap_count += int(np.count_nonzero(runs))
+        longest = int(np.argmax(runs))
+        if runs[longest] > self.longest_gap[1]:
+            self.longest_gap = (int(slots[longest] - runs[longest]), int(runs[longest]))
+        self.sampled_minutes += len(slots)
+        self.last_slot = int(slots[-1])
+
+    def add_power(self, chunk, slots):
+        # Energy and the peak demand_window demand of the minute grid from grid_end to the chunk's last minute.
+        # Windows starting in the previous chunk are completed with the minutes kept in power_tail.
+        if "tot_activ_pwr_avg" not in self.names:
+            return
+        rows = np.flatnonzero((slots >= self.grid_end) & (slots < self.minutes))
+        if not len(rows):
+            return
+        first, last = self.grid_end, int(slots[rows].max()) + 1
+        power = np.full(last - first, np.nan)
+        power[slots[rows] - first] = chunk.view("tot_activ_pwr_avg")[rows]
+        pf = np.full(last - first, np.nan)
+        if "tot_pf_avg" in self.names:
+            pf[slots[rows] - first] = chunk.view("tot_pf_avg")[rows]
+        sampled = np.isfinite(power)
+        self.energy += power[sampled].sum()
+        self.power_samples += int(sampled.sum())
+
+        w = demand_window
+        power = np.concatenate((self.power_tail, power))
+        pf = np.concatenate((self.pf_tail, pf))
+        sampled = np.isfinite(power)
+        power_sum = np.concatenate(([0], np.cumsum(np.where(sampled, power, 0))))
+        sampled_sum = np.concatenate(([0], np.cumsum(sampled)))
+        full = (sampled_sum[w:] - sampled_sum[:-w]) == w
+        if full.any():
+            demand = np.where(full, (power_sum[w:] - power_sum[:-w]) / w / 1000, -np.inf)
+            peak = int(np.argmax(demand))
+            if demand[peak] > self.peak[0]:
+                peak_pf = np.nanmean(pf[peak:peak + w]) if "tot_pf_avg" in self.names else np.nan
+                self.peak = (demand[peak], first - len(self.power_tail) + peak, peak_pf)
+        self.power_tail = power[len(power) - (w - 1):] if w > 1 else np.empty(0)
+        self.pf_tail = pf[len(pf) - (w - 1):] if w > 1 else np.empty(0)
+        self.grid_end = last
+
+    def mean(self, name):
+        count, total, low, high = self.stats.get(name, [0, 0.0, np.nan, np.nan])
+        return total / count if count else np.nan
+
+    def minimum(self, name):
+        return self.stats.get(name, [0, 0.0, np.nan, np.nan])[2]
+
+    def maximum(self, name):
+        return self.stats.get(name, [0, 0.0, np.nan, np.nan])[3]
+
+    def duration(self, name):
+        return self.counts.get(name, 0) * self.resolution
+
+    def percent(self, duration):
+        if not self.sampled_minutes:
+            return np.nan
+        return round(100 * duration / (self.sampled_minutes * self.resolution), 2)
+
+    def quantile(self, name, q):
+        return histogram_quantile(self.histograms[name], name, q)
+
+    def quality_metrics(self):
+        '''
+        Data quality figures of SiteTimeline.quality_metrics, with the missing minutes after the last chunk.
+        '''
+        gap_count, longest = self.gap_count, self.longest_gap
+        trailing = self.minutes - 1 - self.last_slot
+        if trailing > 0:
+            gap_count += 1
+            if trailing > longest[1]:
+                longest = (self.last_slot + 1, trailing)
+        return {
+            "sampled_time": self.sampled_minutes * self.resolution,
+            "coverage_perc": round(100 * self.sampled_minutes / self.minutes, 2) if self.minutes else np.nan,
+            "gap_count": gap_count,
+            "gap_time": (self.minutes - self.sampled_minutes) * self.resolution,
+            "longest_gap": longest[1] * self.resolution,
+            "longest_gap_start": (self.start + longest[0] * self.resolution).strftime('%Y-%m-%dT%H:%M:%SZ') if longest[0] is not None else None,
+            }
+
+    def energy_data(self):
+        '''
+        Energy figures of local_energy_data, or None when the power trend covers less than local_energy_min_coverage.
+        '''
+        samples = self.power_samples
+        if not samples or samples < local_energy_min_coverage * self.minutes:
+            return None
+        energy = self.energy / 60 / 1000
+        avg_demand = energy / (samples / 60)
+        peak_demand, peak, peak_pf = self.peak
+        if peak is None:
+            peak_demand, peak_time = np.nan, None
+        else:
+            peak_time = (self.start + peak * self.resolution).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        return {
+            "source": "trend",
+            "totalActiveEnergyConsumed": energy,
+            "maxActivePowerDemand": peak_demand,
+            "dateTimeOfMaxActivePowerDemand": peak_time,
+            "powerFactorAtMaxDemand": peak_pf,
+            "avgActivePowerDemand": avg_demand,
+            "avgLoadFactor": 100 * avg_demand / peak_demand,
+            "samples": samples,
+            }
+
+    def metrics(self):
+        '''
+        Metrics of the report period added so far, as returned by the metric functions (pf_metrics, harmonic_metrics,
+        unbalance_metrics, gnd_metrics, vf_metrics) without a previous period, and the data quality figures.
+        '''
+        m = self.quality_metrics()
+        for name in self.histograms:
+            m[f"{name}_hist"] = self.histograms[name].astype(np.int32)
+            m[f"{name}_p95"] = self.quantile(name, 0.95)
+
+        if self.has("pf"):
+            m.update({
+                "this_month_pf_result_time": self.duration("pf"),
+                "pf_time_percent": self.percent(self.duration("pf")),
+                "this_month_pf_result_avg": round(self.mean("pf_low"), 2),
+                "this_month_pf_result_min": round(self.minimum("pf_low"), 2),
+                "pf_state": "exceeds" if self.duration("pf") > pd.Timedelta(5, 'h') else "is within tolerance of",
+                })
+
+        if self.has("thd", "tdd"):
+            tdd_trend_max = self.maximum("tdd_avg")
+            tdd_trend_avg = round(self.mean("tdd_avg"), 2)
+            thd_mask_perc = self.percent(self.duration("thd"))
+            tdd_mask_perc = self.percent(self.duration("tdd"))
+            m.update({
+                "tdd_trend_max": tdd_trend_max,
+                "tdd_trend_avg": tdd_trend_avg,
+                "thd_trend_avg": round(self.mean("thd_avg"), 2),
+                "tdd_thresh": round(tdd_trend_max - tdd_trend_avg, 2),
+                "tdd_mask_time": self.duration("tdd"),
+                "tdd_mask_perc": tdd_mask_perc,
+                "thd_mask_time": self.duration("thd"),
+                "thd_mask_perc": thd_mask_perc,
+                "thd_conclusion_string": conclusion_strings["thd"]["exceeded" if thd_mask_perc > 5 else "within"],
+                "tdd_conclusion_string": conclusion_strings["tdd"]["exceeded" if tdd_mask_perc > 25 else "within"],
+                })
+
+        if self.has("nvu", "niu"):
+            nvu_mask_perc = self.percent(self.duration("nvu"))
+            niu_mask_perc = self.percent(self.duration("niu"))
+            m.update({
+                "nvu_trend_avg": round(self.mean("neg_v_unbal"), 2),
+                "nvu_mask_time": self.duration("nvu"),
+                "nvu_mask_perc": nvu_mask_perc,
+                "niu_trend_avg": round(self.mean("neg_i_unbal"), 2),
+                "niu_mask_time": self.duration("niu"),
+                "niu_mask_perc": niu_mask_perc,
+                "nvu_conclusion_string": conclusion_strings["nvu"]["exceeded" if nvu_mask_perc > 5 else "within"],
+                "niu_conclusion_string": conclusion_strings["niu"]["exceeded" if niu_mask_perc > 5 else "within"],
+                })
+
+        if self.has("gnd"):
+            gnd_trend_avg = round(self.mean("gnd_curr_avg"), 2)
+            gnd_trend_max = round(self.maximum("gnd_curr_avg"), 2)
+            gnd_mask1_time = self.duration("gnd")
+            gnd_mask1_perc = self.percent(gnd_mask1_time)
+            if gnd_mask1_perc > 0:
+                gnd_conclusion_string = (
+                    f"Ground current exceeded 0.1 A during this 30-day period for an accumulated time of {gnd_mask1_time} with an average ground current reading of {gnd_trend_avg} A and the maximum reading of {gnd_trend_max} A."
+                    )
+            else:
+                gnd_conclusion_string = conclusion_strings["gnd"]["within"]
+            m.update({
+                "gnd_trend_avg": gnd_trend_avg,
+                "gnd_trend_max": gnd_trend_max,
+                "gnd_mask1_time": gnd_mask1_time,
+                "gnd_mask1_perc": gnd_mask1_perc,
+                "gnd_diff_events": self.counts.get("gnd_steps", 0),
+                "gnd_conclusion_string": gnd_conclusion_string,
+                })
+
+        if self.has("pst"):
+            pst_mask_perc = self.percent(self.duration("pst"))
+            m.update({
+                "pst_threshold": 1,
+                "pst_time": self.duration("pst"),
+                "pst_mask_perc": pst_mask_perc,
+                "pst_conclusion_string": conclusion_strings["pst"]["exceeded" if pst_mask_perc > 95 else "within"],
+                })
+        if self.has("vf"):
+            for phase in phase_names:
+                m[f"{phase}_fluct_avg"] = round(self.mean(f"{phase}_fluct"), 2)
+                m[f"{phase}_fluct_time"] = self.duration(f"{phase}_fluct")
+                m[f"{phase}_fluct_time_perc"] = self.percent(m[f"{phase}_fluct_time"])
+            for name in ("vf_any_phase", "vf_all_phases"):
+                m[f"{name}_time"] = self.duration(name)
+                m[f"{name}_time_perc"] = self.percent(m[f"{name}_time"])
+            m["vf_conclusion_string"] = conclusion_strings["vf"]["within" if any(m[f"{phase}_fluct_time_perc"] < 5 for phase in phase_names) else "exceeded"]
+        return m
+
+def build_report_strings(site, period, m):
+    '''
+    Build the report text for one measurement point from its site information (acct_name, voltages,
+    wiring configuration), report period and computed metrics m.
+    The data quality section is added when m holds the minute coverage (see SiteTimeline.quality_metrics).
+    '''
+    ##Your In-Site gateway provides six alarm indicators to help analyze and trend the quality of your facility’s power. It compares data for the current period to the data #from the previous period based on a rolling 30-day window. Below are findings for the month of ###MONTH VARIABLE.
+
+    report_header_string = (
+        f"###################    Monthly report for {site['acct_name']}  ##################"
+        f"{newline}Nominal Phase to Neutral Voltage: {site['nom_pn_voltage']} Volts"
+        f"{newline}Nominal Phase to Phase Voltage: {site['nom_pp_voltage']} Volts"
+        f"{newline}Wiring Configuratoin: {site['power_config']}"
+        f"{newline}"
+        f"{newline}+++ This Period +++"
+        f"{newline}Start time: {period['s_t']}"
+        f"{newline}End time: {period['e_t']}"
+        f"{newline}Duration: {period['report_timespan']}"
+        f"{newline}"
+        f"{newline}+++ Prev Period +++"
+        f"{newline}Start time: {period['ps_str']}Z"
+        f"{newline}End time: {period['pe_str']}Z"
+        f"{newline}Duration: {period['pe_time'] - period['ps_time']}"
+        f"{newline}################################################################################ "
+        f"{newline}"
+        f"{newline}"
+        )
+
+    demand_string = ""
+    if 'max_demand' in m:
+        demand_string = (
+            f"{newline}Peak {demand_window}-minute demand was {m['max_demand']} kW starting {m['max_demand_time']} at a power factor of {m['pf_at_max_demand']}, "
+            f"with a load factor of {m['load_factor']}%."
+            )
+        if 'max_demand_chg' in m:
+            demand_string += f" Peak demand changed by {m['max_demand_chg']}% from the previous month."
+    if 'yoy_perc_chg' in m:
+        demand_string = f"{newline}Power consumption changed by {m['yoy_perc_chg']}% from the same period last year." + demand_string
+
+    pwr_report_string = (
+        f"{newline}"
+        f"{newline}"
+        f"POWER"
+
+        #f"{newline}Recommendation: {m['pwr_recommend']}"
+        f"{newline}This measurement point had {m['pwr_state']}in power consumption of {m['perc_chg']}% from the previous month."
+        #f"{newline}This period energy consumption: {m['this_month_active_energy']} kWh"
+        #f"{newline}Prev period energy consumption: {m['last_month_active_energy']} kWh"
+        #f"{newline}Energy consumption change from prev period: {m['perc_chg']} %"
+        #TODO A reduction in power usage of {perc_chg} % compared to the previous month.
+        #TODO Add the reduction or increase in Max Power Demand
+        f"{demand_string}"
+        f"{newline}"
+        f"{newline}"
+        )
+
+    pf_report_string = (
+        f"{newline}"
+        f"{newline}"
+        f"POWER FACTOR"
+        f"{newline}For this period, Power Factor (PF) degraded below 0.9 for a total of {m['this_month_pf_result_time']} which {m['pf_state']} the 5-hour threshold for a 30-day period.  ."
+        f"{newline}"
+        f"{newline}* Power Factor Correction may be required if your power factor slips below 0.9 for more than 5 hours in a 30-day period. Failing to correct a poor PF not only leads to much higher power bills, it may significantly damage sensitive electrical components in equipment and machinery."
+        # f"{newline}The percentage of time while PF was less than 0.9 changed by {m['pf_change']} % from the previous month."
+        # f"{newline}Recommendation: {m['pf_recommend']}"
+        # f"{newline}This Month"
+        # f"{newline}Total time while PF < 0.9: {m['this_month_pf_result_time']}"
+        # f"{newline}Percentage of time in low PF: {m['pf_time_percent']} %"
+        # f"{newline}Avg low PF: {m['this_month_pf_result_avg']}"
+        # f"{newline}Min low PF: {m['this_month_pf_result_min']}"
+        # f"{newline}Avg positive reactive power during low PF: {this_month_var_result_avg} VAR"
+        # f"{newline}"
+        # f"{newline}Previous Month"
+        # f"{newline}Total time while PF < 0.9: {m['prev_month_pf_result_time']}"
+        # f"{newline}Percentage of time in low PF: {m['prev_pf_time_percent']} %"
+        # f"{newline}Avg low PF: {m['prev_month_pf_result_avg']}"
+        # f"{newline}Min low PF: {m['prev_month_pf_result_min']}"
+        # #f"{newline}Avg positive reactive power during low PF: {prev_month_var_result_avg} VAR"
+        f"{newline}"
+        f"{newline}"
+
+        )
+
+    if 'pst_mask_perc' in m:
+        pst_string = f"Short term Flicker (Pst) values exceeded 1 for {m['pst_mask_perc']}% of the 30-day period."
+    else:
+        pst_string = f"Short term Flicker (Pst) 95th percentile value was {m['pst_p95']} for the 30-day period."
+
+    vf_report_string = (
+        f"{newline}"
+        f"{newline}"
+        f"VOLTAGE FLUCTUATION"
+        f"{newline}{pst_string}"
+        f"{newline}{m['pst_conclusion_string']}"
+        f"{newline}{m['vf_conclusion_string']}"
+        # f"{newline}"
+        # f"{newline}This month's Voltage fluctuation percentages and durations by phase:"
+        # f"{newline}L1 avg fluctuation: {m['L1_fluct_avg']} %"
+        # f"{newline}L2 avg fluctuation: {m['L2_fluct_avg']} %"
+        # f"{newline}L3 avg fluctuation: {m['L3_fluct_avg']} %"
+        # f"{newline}L1 fluctuation > 7% duration: {m['L1_fluct_time']}"
+        # f"{newline}L2 fluctuation > 7% duration: {m['L2_fluct_time']}"
+        # f"{newline}L3 fluctuation > 7% duration: {m['L3_fluct_time']}"
+        # f"{newline}"
+        # f"{newline}* Voltage fluctuations are defined as repetitive or random variations in the magnitude of the supply voltage which may cause spurious tripping of relays, interference with communication equipment, or even severe fluctuations may not allow other loads to be started due to the reduction in supply voltage. Additionally, induction motors that operate at maximum torque may stall if voltage fluctuations are of significant magnitude."
+        # f"{newline}* The foremost effect of voltage fluctuations is lamp flicker. Lamp flicker is quantified using a measure called the short-term flicker index (Pst), which is normalized to 1.0 to represent the conventional threshold of irritability to the human eye."
+        # f"{newline}* In general, the magnitudes of these variations should not exceed 7% of the nominal supply voltage for more than 5% of the 30-day period, and Flicker Pst values should not exceed 1 for 95% of the 30-day period."
+        # f"{newline}"
+        # f"{newline}Previous Month"
+        # f"{newline}L1 avg fluctuation: {m['prev_L1_fluct_avg']} %"
+        # f"{newline}L2 avg fluctuation: {m['prev_L2_fluct_avg']} %"
+        # f"{newline}L3 avg fluctuation: {m['prev_L3_fluct_avg']} %"
+        # f"{newline}L1 fluctuation > +/- 7% time: {m['prev_L1_fluct_time']}"
+        # f"{newline}L2 fluctuation > +/- 7% time: {m['prev_L2_fluct_time']}"
+        # f"{newline}L3 fluctuation > +/- 7% time: {m['prev_L3_fluct_time']}"
+        # f"{newline}"
+        # f"{newline}Total time while Flicker Pst >= {m['pst_threshold']} : {m['prev_pst_time']}"
+        # f"{newline}Percentage of time while flicker Pst >= {m['pst_threshold']}: {m['prev_pst_mask_perc']} %"
+        f"{newline}"
+        f"{newline}"
+
+        )
+
+    unb_report_string = (
+        f"{newline}"
+        f"{newline}"
+        f"{newline}UNBALANCE"
+        f"{newline}{m['nvu_conclusion_string']}"
+        f"{newline}{m['niu_conclusion_string']}"
+        f"{newline}"
+        f"{newline}* The greatest effect of voltage unbalance is on three-phase induction motors. This will lead to a reduction in motor efficiency while reducing the insulation life caused by overheating."
+        f"{newline}* Powerside recommends that the negative sequence voltage unbalance remain under 2%, and the current unbalance to remain under 50%, both of which should remain below the thresholds for at least 95% of the 30-day period."
+        # f"{newline}This Month"
+        # f"{newline}Negative voltage unbalance average: {m['nvu_trend_avg']} %"
+        #f"{newline}Negative current unbalance average: {m['niu_trend_avg']} %"
+        # f"{newline}"
+        # f"{newline}Previous Month"
+        # f"{newline}Negative voltage unbalance average: {m['prev_nvu_trend_avg']} %"
+        # f"{newline}Negative current unbalance average: {m['prev_niu_trend_avg']} %"
+        f"{newline}"
+        f"{newline}"
+        )
+
+    harmonic_report_string = (
+        f"{newline}"
+        f"{newline}"
+        f"{newline}HARMONICS"
+        f"{newline}{m['tdd_conclusion_string']}"
+        f"{newline}{m['thd_conclusion_string']}"
+        f"{newline}"
+        f"{newline}* Excessive harmonics are a concern as they may cause heating in synchronous/induction machines, interference in communication systems, or damage to capacitors and computers."
+        f"{newline}* Powerside recommends that Total Harmonic Distortion should not exceed 5% for more than 5% of a 30-day period, and the Total Demand Distortion not to exceed 25% for more than 25% of a 30-day period."
+        # f"{newline}This Month"
+        # f"{newline}Average TDD: {m['tdd_trend_avg']} %"
+        # f"{newline}Average THD-V: {m['thd_trend_avg']} %"
+        # f"{newline}Total time while THD-v > 5%: {m['thd_mask_time']}"
+        # f"{newline}Percentage of time while THD-v > 5%: {m['thd_mask_perc']} %"
+        # f"{newline}"
+        # f"{newline}Previous Month"
+        # f"{newline}Average TDD: {m['prev_tdd_trend_avg']} %"
+        # f"{newline}Average THD-V: {m['prev_thd_trend_avg']} %"
+        # f"{newline}Total time while THD-v > 5%: {m['prev_thd_mask_time']}"
+        # f"{newline}Percentage of time while THD-v > 5%: {m['prev_thd_mask_perc']} %"
+        f"{newline}"
+        f"{newline}"
+        )
+
+
+    gnd_report_string = (
+        f"{newline}"
+        f"{newline}"
+        f"{newline}GROUND CURRENT"
+        f"{newline}{m['gnd_conclusion_string']}"
+        f"{newline}"
+        f"{newline}* The National Electrical Code (NEC) mandates that a ground cannot serve as a current-carrying conductor. While any amount of current over 10 milliamps (0.01 A) can produce painful to severe shock, currents between 100 and 200 mA (0.1 to 0.2 A) are lethal. Currents above 200 milliamps (0.2 A), while producing severe burns and unconsciousness, do not usually cause death if the victim is given immediate attention. Resuscitation, consisting of artificial respiration, will usually revive the victim."
+        f"{newline}* Powerside's Insite monitors and alerts when ground current exceeds a threshold of 100 milliamps (0.1 A)."
+        # f"{newline}Previous Month"
+        # f"{newline}Total time while ground current > 0.1: {m['prev_gnd_mask1_time']}"
+        # f"{newline}Percentage of time in high gnd curr: {m['prev_gnd_mask1_perc']} %"
+        # f"{newline}Average ground current: {m['prev_gnd_trend_avg']} amps"
+        # f"{newline}Max of 1-min avg ground current readings: {m['prev_gnd_trend_max']} amps"
+        f"{newline}"
+        f"{newline}"
+        )
+
+    report_strings = [
+        report_header_string,
+        pwr_report_string,
+        pf_report_string,
+        vf_report_string,
+        unb_report_string,
+        harmonic_report_string,
+        gnd_report_string,
+        ]
+
+    if 'coverage_perc' in m:
+        if m['gap_count']:
+            gap_string = (
+                f"{newline}Gaps in the one minute data: {m['gap_count']}, missing {m['gap_time']} in total. "
+                f"The longest gap was {m['longest_gap']} starting {m['longest_gap_start']}."
+                )
+        else:
+            gap_string = f"{newline}No one minute samples are missing from this period."
+        report_strings.append(
+            f"{newline}"
+            f"{newline}"
+            f"{newline}DATA QUALITY"
+            f"{newline}One minute samples were received for {m['sampled_time']} of the {pd.Timedelta(period['report_timespan'])} period ({m['coverage_perc']}%)."
+            f"{gap_string}"
+            f"{newline}* Time percentages in this report are of the sampled time, so missing minutes are not counted as within tolerance."
+            f"{newline}"
+            f"{newline}"
+            )
+    return report_strings
+
+def open_results_store(path=None):
+    '''
+    Open (and create if needed) the SQLite results store.
+    One row per measurement point, report period and metric:
+        site | acct_name | period_start | period_end | metric | value | text
+    Numbers are stored in value, durations as minutes in value, and strings in text.
+    Histograms (see fixed_histogram) are kept in a second table, one row per site, period and channel,
+    with the bin counts packed as int32 bytes.
+    A period is identified by both its start and end, so a custom period never replaces the month starting on the same day.
+    Stores created before period_end was part of the keys are migrated.
+    '''
+    con = sqlite3.connect(path or results_db)
+    tables = {
+        ("metrics", "metric"): (
+            "site TEXT, acct_name TEXT, period_start TEXT, period_end TEXT, metric TEXT, value REAL, text TEXT, "
+            "PRIMARY KEY (site, period_start, period_end, metric)"
+            ),
+        ("histograms", "channel"): (
+            "site TEXT, period_start TEXT, period_end TEXT, channel TEXT, low REAL, high REAL, width REAL, "
+            "samples INTEGER, minutes REAL, counts BLOB, "
+            "PRIMARY KEY (site, period_start, period_end, channel)"
+            ),
+        }
+    with con:
+        for (table, key), columns in tables.items():
+            row = con.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            if row and f"period_end, {key})" not in row[0]:
+                con.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+                con.execute(f"CREATE TABLE {table} ({columns})")
+                con.execute(f"INSERT INTO {table} SELECT * FROM {table}_old")
+                con.execute(f"DROP TABLE {table}_old")
+            else:
+                con.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+        con.execute("CREATE INDEX IF NOT EXISTS metrics_by_metric ON metrics (metric, period_start, value)")
+    return con
+
+def store_metrics(num, acct_name, period, m, path=None):
+    '''
+    Append the computed metrics m of measurement point num to the results store.
+    Re-running a site and period replaces its previous rows.
+    '''
+    rows = []
+    hist_rows = []
+    minutes = m.get("sampled_time", period["report_timespan"]) / pd.Timedelta(1, 'minutes')
+    for metric, v in m.items():
+        if metric.endswith("_hist"):
+            channel = metric[:-len("_hist")]
+            low, high, width = histogram_bins[channel]
+            hist_rows.append((num, period["period_start"], period["period_end"], channel, low, high, width,
+                              int(v.sum()), minutes, v.astype(np.int32).tobytes()))
+            continue
+        value, text = None, None
+        if isinstance(v, pd.Timedelta):
+            value = v / pd.Timedelta(1, 'minutes')
+        elif isinstance(v, (int, float, np.number)) and not isinstance(v, bool):
+            value = None if pd.isna(v) else float(v)
+        elif v is not None:
+            text = str(v)
+        rows.append((num, acct_name, period["period_start"], period["period_end"], metric, value, text))
+
+    with closing(open_results_store(path)) as con:
+        with con:
+            con.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            con.executemany("INSERT OR REPLACE INTO histograms VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", hist_rows)
+
+def query_metric(metric, period_start, period_end, min_value=None, path=None):
+    '''
+    Rows of one metric for every site with a report period starting in [period_start, period_end).
+    Example, sites where TDD was >= 25% for more than 25% of a month last quarter:
+        query_metric("tdd_mask_perc", "2021-04-01", "2021-07-01", min_value=25)
+    '''
+    sql = "SELECT site, acct_name, period_start, period_end, metric, value, text FROM metrics WHERE metric = ? AND period_start >= ? AND period_start < ?"
+    params = [metric, period_start, period_end]
+    if min_value is not None:
+        sql += " AND value > ?"
+        params.append(min_value)
+    with closing(open_results_store(path)) as con:
+        return pd.read_sql_query(sql + " ORDER BY period_start, site", con, params=params)
+
+def load_histograms(channel, period_start, percent_of="samples", path=None):
+    '''
+    Stored histograms of one channel for every site with a report period starting on period_start.
+    Returns a dataframe indexed by site with one column per bin (labelled by its lower edge,
+    -inf for the underflow bin and the upper edge for the overflow bin).
+    percent_of="samples" gives the share of recorded samples in each bin, "month" the percent of the
+    report period's minutes, and None the raw counts.
+    '''
+    sql = "SELECT site, low, high, width, samples, minutes, counts FROM histograms WHERE channel = ? AND period_start = ? ORDER BY site"
+    with closing(open_results_store(path)) as con:
+        rows = con.execute(sql, (channel, period_start)).fetchall()
+
+    data = {}
+    columns = None
+    for site, low, high, width, samples, minutes, counts in rows:
+        counts = np.frombuffer(counts, dtype=np.int32).astype(float)
+        edges = low + width * np.arange(len(counts) - 1)
+        columns = [-np.inf] + list(edges)
+        if percent_of == "samples":
+            counts = 100 * counts / max(samples, 1)
+        elif percent_of == "month":
+            counts = 100 * counts / minutes
+        data[site] = counts
+    return pd.DataFrame.from_dict(data, orient="index", columns=columns)
+
+def load_site_metrics(num, period_start, period_end, path=None):
+    '''
+    Stored metrics of measurement point num for the report period from period_start to period_end, as written by
+    store_metrics (durations in minutes, histograms as their bin counts), or None when the period was never stored.
+    '''
+    with closing(open_results_store(path)) as con:
+        rows = con.execute("SELECT metric, value, text FROM metrics WHERE site = ? AND period_start = ? AND period_end = ?",
+                           (num, period_start, period_end)).fetchall()
+        hist_rows = con.execute("SELECT channel, counts FROM histograms WHERE site = ? AND period_start = ? AND period_end = ?",
+                                (num, period_start, period_end)).fetchall()
+    if not rows:
+        return None
+
+    m = {metric: text if value is None else value for metric, value, text in rows}
+    for channel, counts in hist_rows:
+        m[f"{channel}_hist"] = np.frombuffer(counts, dtype=np.int32)
+    return m
+
+def open_rollup_store(path=None):
+    '''
+    Open (and create if needed) the SQLite rollup store (see section 23).
+    rollups holds one row per measurement point, level ("hour", "day", "month"), channel and bucket:
+        site | level | channel | start | end | samples | total | low | high
+    with the number of samples, their sum, min and max, and exceedances the minutes beyond each rollup_thresholds
+    threshold of the channel in the bucket. start and end are UTC time strings like s_t.
+    '''
+    con = sqlite3.connect(path or rollup_db)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS rollups ("
+        "site TEXT, level TEXT, channel TEXT, start TEXT, end TEXT, samples INTEGER, total REAL, low REAL, high REAL, "
+        "PRIMARY KEY (site, level, channel, start))"
+        )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS exceedances ("
+        "site TEXT, level TEXT, channel TEXT, start TEXT, end TEXT, threshold TEXT, minutes INTEGER, "
+        "PRIMARY KEY (site, level, channel, start, threshold))"
+        )
+    return con
+
+def get_local_date(t, tz):
+    '''
+    Local date of the UTC time string t for a measurement point in tz (UTC offset or timezone name, see get_utc_start).
+    '''
+    utc = pd.Timestamp(t).tz_convert(None)
+    try:
+        return (utc - timedelta(hours=float(tz))).date()
+    except ValueError:
+        return pd.Timestamp(t).tz_convert(tz).date()
+
+def get_rollup_buckets(tz, s_t, e_t):
+    '''
+    Local days and months of tz overlapping s_t to e_t, as (level, child level, start, end, number of children):
+    a day is complete with all of its hours, a month with all of its days.
+    Days that do not start on a whole hour in UTC (half hour offsets) have no daily or monthly rollups.
+    '''
+    first, last = get_local_date(s_t, tz), get_local_date(e_t, tz)
+    buckets = []
+    day = first
+    while day <= last:
+        start = get_utc_start(day.isoformat(), tz)
+        end = get_utc_start((day + timedelta(days=1)).isoformat(), tz)
+        hours = (pd.Timestamp(end) - pd.Timestamp(start)) / pd.Timedelta(1, 'h')
+        if hours == int(hours) and pd.Timestamp(start).minute == 0:
+            buckets.append(("day", "hour", start, end, int(hours)))
+        day += timedelta(days=1)
+
+    month = first.replace(day=1)
+    while month <= last:
+        next_month = month + relativedelta(months=1)
+        start = get_utc_start(month.isoformat(), tz)
+        end = get_utc_start(next_month.isoformat(), tz)
+        buckets.append(("month", "day", start, end, (next_month - month).days))
+        month = next_month
+    return buckets
+
+def store_rollups(num, tz, s_t, e_t, site_data, path=None):
+    '''
+    Roll up the minute data of measurement point num from s_t to e_t (SiteData) into hourly records, one per channel
+    and whole hour of the range, replacing earlier ones, then (re)build the daily and monthly records (local days of tz)
+    of every channel whose hours, or days, are all stored.
+    '''
+    hour = pd.Timedelta(1, 'h')
+    first = pd.Timestamp(s_t).ceil('h')
+    hours = int((pd.Timestamp(e_t).floor('h') - first) / hour)
+    if hours <= 0 or site_data is None:
+        return
+    index = ((pd.DatetimeIndex(site_data.date_time) - first) // hour).to_numpy()
+    rows = np.flatnonzero((index >= 0) & (index < hours))
+    index = index[rows]
+    starts = [(first + h * hour).strftime('%Y-%m-%dT%H:%M:%S.000Z') for h in range(hours + 1)]
+
+    hour_rows = []
+    exceedance_rows = []
+    for name in site_data.channels:
+        x = site_data.view(name)[rows]
+        valid = ~np.isnan(x)
+        samples = np.bincount(index[valid], minlength=hours)
+        total = np.bincount(index[valid], x[valid], minlength=hours)
+        low = np.full(hours, np.inf)
+        high = np.full(hours, -np.inf)
+        np.minimum.at(low, index[valid], x[valid])
+        np.maximum.at(high, index[valid], x[valid])
+        for h in range(hours):
+            n = int(samples[h])
+            hour_rows.append((num, "hour", name, starts[h], starts[h + 1], n, float(total[h]),
+                              float(low[h]) if n else None, float(high[h]) if n else None))
+
+        for op, value in rollup_thresholds.get(name, ()):
+            if op == "outside" and not site_data.nom_pn_voltage:
+                continue
+            minutes = np.bincount(index, rollup_operators[op](x, value, site_data.nom_pn_voltage), minlength=hours)
+            exceedance_rows += [(num, "hour", name, starts[h], starts[h + 1], f"{op} {value}", int(minutes[h])) for h in range(hours)]
+
+    with closing(open_rollup_store(path)) as con:
+        with con:
+            con.executemany("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", hour_rows)
+            con.executemany("INSERT OR REPLACE INTO exceedances VALUES (?, ?, ?, ?, ?, ?, ?)", exceedance_rows)
+            for level, child, start, end, children in get_rollup_buckets(tz, s_t, e_t):
+                con.execute(
+                    "INSERT OR REPLACE INTO rollups SELECT site, ?, channel, ?, ?, SUM(samples), SUM(total), MIN(low), MAX(high) "
+                    "FROM rollups WHERE site = ? AND level = ? AND start >= ? AND end <= ? GROUP BY channel HAVING COUNT(*) = ?",
+                    (level, start, end, num, child, start, end, children),
+                    )
+                con.execute(
+                    "INSERT OR REPLACE INTO exceedances SELECT site, ?, channel, ?, ?, threshold, SUM(minutes) "
+                    "FROM exceedances WHERE site = ? AND level = ? AND start >= ? AND end <= ? GROUP BY channel, threshold HAVING COUNT(*) = ?",
+                    (level, start, end, num, child, start, end, children),
+                    )
+
+def query_rollups(num, channel, s_t, e_t, path=None):
+    '''
+    Figures of one channel of measurement point num from s_t to e_t (UTC time strings), summed from the coarsest
+    rollups inside the period: monthly records first, then daily and hourly ones for the parts they leave.
+    Returns {"samples", "total", "low", "high", "exceedances": {threshold: minutes}, "missing": [(start, end), ...]},
+    missing being the parts of the period without rollups (never downloaded, or partial hours at its edges).
+    '''
+    result = {"samples": 0, "total": 0.0, "low": np.nan, "high": np.nan, "exceedances": {}}
+    intervals = [(s_t, e_t)]
+    with closing(open_rollup_store(path)) as con:
+        for level in ("month", "day", "hour"):
+            remaining = []
+            for a, b in intervals:
+                where = (num, level, channel, a, b)
+                t = a
+                for start, end, samples, total, low, high in con.execute(
+                        "SELECT start, end, samples, total, low, high FROM rollups "
+                        "WHERE site = ? AND level = ? AND channel = ? AND start >= ? AND end <= ? ORDER BY start", where):
+                    if start > t:
+                        remaining.append((t, start))
+                    t = end
+                    result["samples"] += samples
+                    result["total"] += total
+                    result["low"] = np.fmin(result["low"], np.nan if low is None else low)
+                    result["high"] = np.fmax(result["high"], np.nan if high is None else high)
+                if t < b:
+                    remaining.append((t, b))
+                for threshold, minutes in con.execute(
+                        "SELECT threshold, SUM(minutes) FROM exceedances "
+                        "WHERE site = ? AND level = ? AND channel = ? AND start >= ? AND end <= ? GROUP BY threshold", where):
+                    result["exceedances"][threshold] = result["exceedances"].get(threshold, 0) + minutes
+            intervals = remaining
+    result["missing"] = intervals
+    return result
+
+def rollup_energy(num, s_t, e_t, path=None):
+    '''
+    Active energy (kWh) of measurement point num from s_t to e_t summed from the rollups of tot_activ_pwr_avg,
+    or None when they do not cover the period or less than local_energy_min_coverage of it was sampled.
+    '''
+    r = query_rollups(num, "tot_activ_pwr_avg", s_t, e_t, path)
+    minutes = (pd.Timestamp(e_t) - pd.Timestamp(s_t)) / pd.Timedelta(1, 'minutes')
+    if r["missing"] or not r["samples"] or r["samples"] < local_energy_min_coverage * minutes:
+        return None
+    return r["total"] / 60 / 1000
+
+def stratified_sample(strata, n, seed=0):
+    '''
+    Row positions of a sample of about n rows, drawn from each stratum (e.g. hour of day)
+    in proportion to its size so daily load patterns keep their weight.
+    '''
+    rng = np.random.default_rng(seed)
+    strata = np.asarray(strata)
+    keep = []
+    for s in np.unique(strata):
+        idx = np.flatnonzero(strata == s)
+        k = min(len(idx), max(1, int(round(n * len(idx) / len(strata)))))
+        keep.append(rng.choice(idx, k, replace=False))
+    return np.sort(np.concatenate(keep))
+
+def correlation_matrices(df, columns, methods, sample=None):
+    '''
+    Cross-channel correlation matrices of the columns of a trend dataframe, computed on the rows where
+    every channel has a value.
+        - pearson: one np.corrcoef over the channel matrix.
+        - spearman: each column is ranked once, then pearson of the ranks.
+        - kendall: tau-b per channel pair with scipy's O(n log n) algorithm instead of pandas' O(n^2) one.
+    With sample set, the matrices are estimated from a sample stratified by hour of day.
+    Returns a dict of method: dataframe.
+    '''
+    data = df[["date_time"] + columns].dropna()
+    if sample and len(data) > sample:
+        data = data.iloc[stratified_sample(data["date_time"].dt.hour, sample)]
+    values = data[columns].to_numpy(dtype=float)
+
+    matrices = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for method in methods:
+            if method == "pearson":
+                c = np.corrcoef(values, rowvar=False)
+            elif method == "spearman":
+                ranks = np.column_stack([sp.stats.rankdata(values[:, i]) for i in range(len(columns))])
+                c = np.corrcoef(ranks, rowvar=False)
+            elif method == "kendall":
+                c = np.eye(len(columns))
+                for i in range(len(columns)):
+                    for j in range(i + 1, len(columns)):
+                        c[i, j] = c[j, i] = sp.stats.kendalltau(values[:, i], values[:, j]).statistic
+            else:
+                raise ValueError(f"Unknown correlation method {method}")
+            matrices[method] = pd.DataFrame(c, index=columns, columns=columns)
+    return matrices
+
+def lttb(x, y, n_out):
+    '''
+    Largest-Triangle-Three-Buckets downsampling of the series (x, y) to n_out points.
+    The first and last points are kept, and from each bucket in between the point forming the largest
+    triangle with the previously kept point and the average of the next bucket.
+    x and y are float arrays without NaN. Returns the indices of the kept points.
+    '''
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    idx = np.empty(n_out, dtype=int)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+def downsample_series(t, y, n_out=None):
+    '''
+    LTTB downsample of a time series (pandas datetime Series t, values y) for plotting.
+    Returns local (timezone naive) datetime64 and float arrays.
+    '''
+    valid = y.notna().to_numpy()
+    t = t.dt.tz_localize(None).to_numpy()[valid]
+    y = y.to_numpy(dtype=float)[valid]
+    if len(y) == 0:
+        return t, y
+    x = (t - t[0]) / np.timedelta64(1, 'm')
+    keep = lttb(x, y, n_out or plot_points)
+    return t[keep], y[keep]
+
+def build_site_charts(acct_name, site_data, m):
+    '''
+    Chart definitions for render_site_plots from a site's SiteData and computed metrics m.
+    Series are downsampled here so only a few thousand points per chart are sent to the plot workers,
+    and the histograms come from the ones built in the metrics pass.
+    '''
+    charts = {}
+
+    date_time = site_data['date_time']
+    gnd_curr_avg = site_data['gnd_curr_avg']
+    weekday = date_time.dt.day_name()
+    gnd_series = []
+    for day in ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]:
+        day_mask = weekday == day
+        gnd_series.append((day,) + downsample_series(date_time[day_mask], gnd_curr_avg[day_mask], plot_points // 7))
+    charts["Ground Current"] = {
+        "kind": "scatter",
+        "title": f"{acct_name} Ground Current (Amps)",
+        "ylabel": "Amps",
+        "series": gnd_series,
+        "hline": 0.1,
+        }
+
+    gnd_mask = (site_data["gnd_diff"] > 0.2) & (gnd_curr_avg >= .1)
+    charts["Ground Current Events"] = {
+        "kind": "scatter",
+        "title": f"{acct_name} Ground Current Events",
+        "ylabel": "Amps",
+        "series": [("Events", date_time[gnd_mask].dt.tz_localize(None).to_numpy(), gnd_curr_avg[gnd_mask].to_numpy())],
+        }
+
+    charts["Power Factor"] = {
+        "kind": "line",
+        "title": f"{acct_name} Power Factor",
+        "ylabel": "Total Power Factor",
+        "series": [("PF",) + downsample_series(date_time, site_data['tot_pf_avg'])],
+        "hline": 0.9,
+        }
+
+    hists = {
+        "neg_v_unbal": ("Histogram of Voltage Unbalance (Negative Sequence)", "Voltage Unbalance Percentage"),
+        "neg_i_unbal": ("Histogram of Current Unbalance (Negative Sequence)", "Current Unbalance Percentage"),
+        "tdd_avg": ("Histogram of TDD %", "Total Demand Distortion TDD %"),
+        "thd_avg": ("Histogram of THD-v%", "Total Harmonic Distortion THD-v %"),
+        "tot_pf_avg": ("Histogram of Power Factor", "Total Power Factor"),
+        }
+    for col, (title, xlabel) in hists.items():
+        # under and overflow samples are drawn in the first and last bins
+        counts = m[f"{col}_hist"][1:-1].copy()
+        counts[0] += m[f"{col}_hist"][0]
+        counts[-1] += m[f"{col}_hist"][-1]
+        edges = histogram_edges(col)
+        charts[title] = {
+            "kind": "hist",
+            "title": f"{acct_name} {title}",
+            "xlabel": xlabel,
+            "ylabel": "Percent of Month",
+            "counts": counts,
+            "edges": edges,
+            }
+
+    return charts
+
+def render_site_plots(prefix, charts, num=None, period_start=None):
+    '''
+    Draw the charts of one site (see build_site_charts) to "<prefix> - <chart name>.png".
+    Runs in a plot worker process. Returns the written file names.
+    num and period_start name the render profile of the plots when the site is profiled.
+    '''
+    if num is None:
+        return draw_site_plots(prefix, charts)
+    with profiled(num, "render", f"{period_start} plots"):
+        return draw_site_plots(prefix, charts)
+
+def draw_site_plots(prefix, charts):
+    files = []
+    for name, chart in charts.items():
+        fig, ax = plt.subplots(figsize=(11, 4))
+        if chart["kind"] == "hist":
+            counts = chart["counts"]
+            percent = 100 * counts / max(counts.sum(), 1)
+            ax.bar(chart["edges"][:-1], percent, width=np.diff(chart["edges"]), align="edge")
+        else:
+            for label, x, y in chart["series"]:
+                if chart["kind"] == "scatter":
+                    ax.plot(x, y, ".", markersize=2, label=label)
+                else:
+                    ax.plot(x, y, linewidth=0.8, label=label)
+            if len(chart["series"]) > 1:
+                ax.legend(loc="upper right", fontsize="small", markerscale=4)
+            ax.xaxis.set_major_formatter(mpl_dates.DateFormatter('%d-%m-%Y'))
+        if "hline" in chart:
+            ax.axhline(chart["hline"], color="red", linewidth=0.8)
+        ax.set_title(chart["title"])
+        ax.set_xlabel(chart.get("xlabel", ""))
+        ax.set_ylabel(chart.get("ylabel", ""))
+        fig.tight_layout()
+        filename = f"{prefix} - {name}.png"
+        fig.savefig(filename, dpi=100)
+        plt.close(fig)
+        files.append(filename)
+    return files
+
+def report_plot_errors(future):
+    if future.exception() is not None:
+        print("render_site_plots failed - ", future.exception())
+
+def get_page_items(page):
+    '''
+    Items and total count of a get_mp_page response, which is either a plain list or an object
+    holding the list (rows/items/data) and the total (count/total). The total is None when unknown.
+    '''
+    if isinstance(page, list):
+        return page, None
+    for key in ("rows", "items", "data", "measurementPoints"):
+        if isinstance(page.get(key), list):
+            return page[key], page.get("count", page.get("total"))
+    return [], None
+
+def list_measurement_points(account=None):
+    '''
+    Every measurement point visible to the api token, optionally for one account id.
+    The first page gives the total, then the remaining pages are fetched concurrently. When the API
+    does not report a total, pages are fetched discovery_workers at a time until a short page comes back.
+    '''
+    n = discovery_page_size
+    items, total = get_page_items(require(get_mp_page(0, n, account), "measurement point list"))
+    if len(items) < n:
+        return items
+
+    def fetch(o):
+        return get_page_items(require(get_mp_page(o, n, account), f"measurement point list at {o}"))[0]
+
+    with ThreadPoolExecutor(discovery_workers) as pool:
+        if total is not None:
+            for page in pool.map(in_account(fetch), range(n, total, n)):
+                items += page
+            return items
+
+        o = n
+        while True:
+            pages = list(pool.map(in_account(fetch), range(o, o + n * discovery_workers, n)))
+            for page in pages:
+                items += page
+            if any(len(page) < n for page in pages):
+                return items
+            o += n * discovery_workers
+
+def discover_measurement_points(accounts=None, status=None):
+    '''
+    Sites for the report pipeline listed from the API, in the same form as mps but with the
+    measurement point's timezone name instead of a fixed UTC offset: {"2168": "America/Los_Angeles"}.
+    accounts is a list of account ids (None or empty for every account), status a measurement point status name.
+    Accounts are listed concurrently.
+    '''
+    accounts = accounts or [None]
+    with ThreadPoolExecutor(discovery_workers) as pool:
+        lists = list(pool.map(in_account(list_measurement_points), accounts))
+
+    sites = {}
+    for items in lists:
+        for mp in items:
+            if status and mp.get("measurementPointStatusName") != status:
+                continue
+            if accounts != [None] and mp.get("accountId") not in accounts:
+                continue
+            mp_id = mp.get("measurementPointId", mp.get("id"))
+            sites[str(mp_id)] = mp["timezone"]
+    return sites
+
+def require(response, what):
+    '''
+    Raise instead of carrying on with a missing API response (the get_/post_ functions return None on failure).
+    '''
+    if response is None:
+        raise RuntimeError(f"No response for {what}")
+    return response
+
+profile_lock = threading.Lock()
+profile_state = threading.local()
+profile_counts = {}
+
+def reset_profile_state():
+    '''
+    Plot workers forked while a stage is being profiled would otherwise inherit its held lock and active flag.
+    '''
+    global profile_lock, profile_state
+    profile_lock = threading.Lock()
+    profile_state = threading.local()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_profile_state)
+
+def profile_path(num, stage, label):
+    '''
+    Path of a profile without its extension. A stage profiled again for the same label in this run gets a numbered path.
+    '''
+    name = f"{num}_{stage}_{label}".replace(':', '-').replace(' ', '_')
+    count = profile_counts[name] = profile_counts.get(name, 0) + 1
+    if count > 1:
+        name += f"_{count}"
+    return os.path.join(profile_dir, name)
+
+@contextmanager
+def profiled(num, stage, label):
+    '''
+    Run the enclosed code under cProfile (and tracemalloc) when stage of measurement point num is profiled (section 18),
+    writing the profile files named by site, stage and label (the period). Does nothing otherwise.
+    '''
+    if stage not in profile_stages or (profile_sites and str(num) not in profile_sites) or getattr(profile_state, "active", False):
+        yield
+        return
+
+    with profile_lock:
+        profile_state.active = True
+        trace = profile_memory and not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start(10)
+        if profile_memory:
+            tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            seconds = time.perf_counter() - started
+            snapshot, peak = None, None
+            if profile_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                snapshot = tracemalloc.take_snapshot()
+            if trace:
+                tracemalloc.stop()
+            profile_state.active = False
+            write_profile(profile_path(num, stage, label), f"Measurement point {num}, {stage} {label}", seconds, profiler, snapshot, peak)
+
+def write_profile(path, title, seconds, profiler, snapshot=None, peak=None):
+    '''
+    Write a profile (.prof), its summary (.txt) and the allocation snapshot (.snapshot) when there is one.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profiler.dump_stats(path + ".prof")
+    with open(path + ".txt", "w") as f:
+        f.write(f"{title}{newline}Wall time: {seconds:.3f} s{newline}")
+        if snapshot is not None:
+            f.write(f"Peak traced memory: {peak / 2**20:.1f} MiB{newline}")
+        f.write(newline)
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(profile_top)
+        if snapshot is not None:
+            snapshot.dump(path + ".snapshot")
+            f.write(f"Largest allocations still held at the end of the stage:{newline}")
+            for stat in snapshot.statistics("lineno")[:profile_top]:
+                f.write(f"{stat}{newline}")
+    print(f"Profile written to {path}.prof")
+
+def archive_path(num, s_t=None, e_t=None):
+    '''
+    Archive folder of measurement point num, or of its period from s_t to e_t (UTC time strings).
+    '''
+    path = os.path.join(archive_dir, str(num))
+    if s_t:
+        path = os.path.join(path, f"{s_t[:19]}_{e_t[:19]}".replace(':', '-'))
+    return path
+
+def archive_response(num, name, call, s_t=None, e_t=None):
+    '''
+    API response of call() for measurement point num (and its period from s_t to e_t), saved in the archive as
+    <name>.json. When offline the archived response is returned instead, or None when there is none.
+    '''
+    if not archive_dir:
+        return None if offline else call()
+    path = os.path.join(archive_path(num, s_t, e_t), f"{name}.json")
+    if offline:
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    response = call()
+    if response is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(response, f)
+        os.replace(path + ".tmp", path)
+    return response
+
+def save_archive(num, s_t, e_t, site_data):
+    '''
+    Write the minute data of measurement point num from s_t to e_t to the archive.
+    meta.json is written last, so a month is only loaded once all of its files are complete.
+    '''
+    path = archive_path(num, s_t, e_t)
+    os.makedirs(path, exist_ok=True)
+    date_time = pd.DatetimeIndex(site_data.date_time).as_unit('ns')
+    arrays = {
+        "values": np.ascontiguousarray(site_data.values, dtype=np.float64),
+        "date_time": date_time.asi8,
+        }
+    for name, array in arrays.items():
+        with open(os.path.join(path, f"{name}.npy.tmp"), "wb") as f:
+            np.save(f, array)
+        os.replace(os.path.join(path, f"{name}.npy.tmp"), os.path.join(path, f"{name}.npy"))
+
+    meta = {"s_t": s_t, "e_t": e_t, "timezone": str(date_time.tz), "channels": list(site_data.channels)}
+    with open(os.path.join(path, "meta.json.tmp"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(path, "meta.json.tmp"), os.path.join(path, "meta.json"))
+
+def load_archive(num, s_t, e_t, names=(), nom_pn_voltage=None):
+    '''
+    SiteData of measurement point num from s_t to e_t from the archive, with its values memory-mapped
+    (read only, nothing is copied until used). None when the period, or any channel of names, is not archived.
+    '''
+    if not archive_dir:
+        return None
+    path = archive_path(num, s_t, e_t)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if any(name not in meta["channels"] for name in names):
+        return None
+
+    values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+    date_time = np.load(os.path.join(path, "date_time.npy"), mmap_mode="r")
+    date_time = pd.DatetimeIndex(date_time.view("M8[ns]")).tz_localize("UTC").tz_convert(meta["timezone"])
+    return SiteData(pd.Series(date_time, name="date_time"), values, meta["channels"], nom_pn_voltage)
+
+def fetch_month_data(num, acct_tz, s_t, e_t, energy_params, nom_pn_voltage, names=()):
+    '''
+    Download the minute trends of the channels names (as one SiteData) from s_t to e_t of measurement point num,
+    or load them from the archive when it holds every one of them. Otherwise only the channels the archive lacks
+    are downloaded, and they are merged into the archived ones and archived with them.
+    The energy is computed from the trends (see local_energy_data), or downloaded for energy_params
+    when the trends do not cover the period.
+    '''
+    site_data = load_archive(num, s_t, e_t, names, nom_pn_voltage)
+    if site_data is None and offline:
+        raise RuntimeError(f"Trends of {num} from {s_t} are not in the archive")
+
+    if site_data is None:
+        archived = load_archive(num, s_t, e_t, (), nom_pn_voltage)
+        dfs = [archived.to_frame(archived.channels)] if archived is not None else []
+        # TODO: Look into why I needed to set, reset index to date_time in order for conversion to work
+        for columns in get_trend_requests([name for name in names if archived is None or name not in archived.channels]):
+            j = get_trend_json(s_t, e_t, [channel_registry[name]["firmware"] for name in columns])
+            dfs.append(require(post_trend_data(num, j, acct_tz, columns), f"trends {columns} of {num} from {s_t}"))
+
+        site_data = SiteData.from_frames(dfs, nom_pn_voltage)
+        if archive_dir and site_data is not None:
+            save_archive(num, s_t, e_t, site_data)
+        if rollup_db:
+            store_rollups(num, acct_tz, s_t, e_t, site_data)
+
+    energy_dict = local_energy_data(site_data, s_t, e_t)
+    if energy_dict is None or (energy_cross_check and not offline):
+        server_energy_dict = require(archive_response(num, "energy", lambda: get_energy_data(num, energy_params), s_t, e_t), f"energy of {num} from {energy_params[0][1]}")
+        if energy_dict is None:
+            energy_dict = server_energy_dict
+        else:
+            local = energy_dict['totalActiveEnergyConsumed']
+            server = server_energy_dict['totalActiveEnergyConsumed']
+            energy_dict["serverActiveEnergyConsumed"] = server
+            if server and abs(local - server) > energy_tolerance * abs(server):
+                print(f"Measurement point {num} from {s_t}: local energy {local:.1f} kWh differs from the server's {server:.1f} kWh")
+
+    return {
+        "site_data": site_data,
+        "energy_dict": energy_dict,
+        }
+
+def get_stream_chunks(s_t, e_t):
+    '''
+    Start and end (UTC time strings) of the stream_chunk_days chunks a streamed period from s_t to e_t is downloaded in.
+    '''
+    start, end = pd.Timestamp(s_t), pd.Timestamp(e_t)
+    chunks = []
+    while start < end:
+        stop = min(start + pd.Timedelta(stream_chunk_days, 'D'), end)
+        chunks.append((start.strftime('%Y-%m-%dT%H:%M:%S.000Z'), stop.strftime('%Y-%m-%dT%H:%M:%S.000Z')))
+        start = stop
+    return chunks
+
+def stream_trend_chunks(num, acct_tz, s_t, e_t, names, nom_pn_voltage=None):
+    '''
+    Minute trends of the channels names from s_t to e_t of measurement point num, downloaded and yielded as one SiteData
+    per chunk of get_stream_chunks, so only one chunk is held in memory. Streamed periods are not archived,
+    but they are rolled up (see store_rollups).
+    '''
+    if offline:
+        raise RuntimeError(f"Trends of {num} from {s_t} to {e_t} are streamed and not in the archive")
+    for start, end in get_stream_chunks(s_t, e_t):
+        dfs = []
+        for columns in get_trend_requests(list(names)):
+            j = get_trend_json(start, end, [channel_registry[name]["firmware"] for name in columns])
+            dfs.append(require(post_trend_data(num, j, acct_tz, columns), f"trends {columns} of {num} from {start}"))
+        chunk = SiteData.from_frames(dfs, nom_pn_voltage)
+        if rollup_db:
+            store_rollups(num, acct_tz, start, end, chunk)
+        if chunk is not None:
+            yield chunk
+
+def stream_site_metrics(data):
+    '''
+    MetricsAccumulator of the report period of a site whose trends fetch_site_data left to be streamed.
+    '''
+    site = data["site"]
+    period = data["period"]
+    names = data["stream"]["names"]
+    accumulator = MetricsAccumulator(period["s_t"], period["e_t"], names, site["nom_pn_voltage"])
+    for chunk in stream_trend_chunks(site["num"], data["stream"]["acct_tz"], period["s_t"], period["e_t"], names, site["nom_pn_voltage"]):
+        accumulator.add(chunk)
+    return accumulator
+
+def fetch_site_data(num, tz, dates=None, months=None):
+    '''
+    Download everything the report of measurement point num (UTC offset tz) needs for the report dates
+    (see get_report_dates). With fast_report, minute trends are only downloaded for the metrics
+    the server aggregates cannot answer.
+    months optionally holds months already downloaded by fetch_month_data, keyed by their start date.
+    The previous month is taken from it instead of downloaded when present.
+    The trends of periods longer than stream_days are left to compute_site_metrics to stream (see section 22).
+    '''
+    dates = dates or get_report_dates()
+    mp_info = require(archive_response(num, "measurement_point", lambda: get_mp(num)), f"measurement point {num}")
+    acct_tz = mp_info['timezone']
+    period = get_report_period(tz, dates)
+    s_t = period["s_t"]
+    e_t = period["e_t"]
+    pr_s_t = period["pr_s_t"]
+
+    pq_measures = archive_response(num, "pq_measures", lambda: get_pq_meausres(num, period["period_params"]), s_t, e_t)
+    pq_params = require(archive_response(num, "parameters", lambda: get_params(num)), f"parameters of measurement point {num}")
+    power_config, nom_pn_voltage, nom_pp_voltage = get_site_config(pq_params)
+
+    site = {
+        "num": num,
+        "acct_name": mp_info['accountName'] + mp_info['mpId'],
+        "power_config": power_config,
+        "nom_pn_voltage": nom_pn_voltage,
+        "nom_pp_voltage": nom_pp_voltage,
+        }
+
+    #print(json.dumps(pq_measures, indent=1))
+
+    decided = {}
+    if fast_report:
+        decided = aggregate_metrics(pq_measures, period["report_timespan"])
+
+    # Only the channels of the metric groups with an undecided metric are downloaded, and the power channels with them.
+    # The previous month trends only feed the month-over-month figures, which the fast report skips.
+    needed = [k for group in metric_groups if any(k not in decided for k in group) for k in group]
+    names = get_metric_channels(needed + ["power"]) if needed else []
+    need_prev = not fast_report
+    prev_names = names if need_prev else []
+
+    if names and period["report_timespan"] > timedelta(days=stream_days):
+        previous = fetch_month_data(num, acct_tz, pr_s_t, s_t, period["prev_period_params"], nom_pn_voltage)
+        return {
+            "site": site,
+            "period": period,
+            "decided": decided,
+            "site_data": None,
+            "prev_site_data": None,
+            "energy_dict": None,
+            "last_energy_dict": previous["energy_dict"],
+            "stream": {"acct_tz": acct_tz, "names": names},
+            }
+
+    current = fetch_month_data(num, acct_tz, s_t, e_t, period["period_params"], nom_pn_voltage, names)
+    previous = (months or {}).get(dates["prev_start_time"])
+    if previous is None or (prev_names and (previous["site_data"] is None or not previous["site_data"].has(prev_names))):
+        previous = fetch_month_data(num, acct_tz, pr_s_t, s_t, period["prev_period_params"], nom_pn_voltage, prev_names)
+
+    return {
+        "site": site,
+        "period": period,
+        "decided": decided,
+        "site_data": current["site_data"],
+        "prev_site_data": previous["site_data"] if need_prev else None,
+        "energy_dict": current["energy_dict"],
+        "last_energy_dict": previous["energy_dict"],
+        }
+
+def compute_site_metrics(data):
+    '''
+    Compute the report metrics from the data downloaded by fetch_site_data.
+    The trends it left to stream are downloaded and summarized here chunk by chunk (see MetricsAccumulator).
+    '''
+    period = data["period"]
+    site_data = data["site_data"]
+    prev_site_data = data["prev_site_data"]
+
+    m = {}
+    for values in data["decided"].values():
+        m.update(values)
+
+    # One minute grid per period, shared by all metrics of that period: the current and previous periods each get their
+    # own, built from that period's timestamps, so a minute counts as sampled when that period's download has it.
+    timeline = SiteTimeline(period["s_t"], period["e_t"], site_data)
+    prev_timeline = SiteTimeline(period["pr_s_t"], period["s_t"], prev_site_data)
+    if site_data is not None:
+        m.update(timeline.quality_metrics())
+
+    # Each metric function runs when the channels of its metrics were downloaded (see metric_groups).
+    def has(*metrics):
+        return site_data is not None and site_data.has(get_metric_channels(metrics, rules=False))
+
+    if has("pf"):
+        m.update(pf_metrics(site_data, prev_site_data, timeline, prev_timeline))
+    if has("thd", "tdd"):
+        m.update(harmonic_metrics(site_data, prev_site_data, timeline, prev_timeline))
+    if has("nvu", "niu"):
+        m.update(unbalance_metrics(site_data, prev_site_data, timeline, prev_timeline))
+    if has("gnd"):
+        m.update(gnd_metrics(site_data, prev_site_data, timeline, prev_timeline))
+    if has("pst"):
+        m.update(pst_metrics(site_data, prev_site_data, timeline, prev_timeline))
+    if has("vf"):
+        m.update(vf_metrics(site_data, prev_site_data, data["site"]["nom_pn_voltage"], timeline, prev_timeline))
+
+    energy_dict = data["energy_dict"]
+    if data.get("stream"):
+        num = data["site"]["num"]
+        accumulator = stream_site_metrics(data)
+        m.update(accumulator.metrics())
+        energy_dict = accumulator.energy_data()
+        if energy_dict is None:
+            energy_dict = require(archive_response(num, "energy", lambda: get_energy_data(num, period["period_params"]), period["s_t"], period["e_t"]), f"energy of {num} from {period['s_t']}")
+
+    # Power ###############################################################
+    last_year_energy = rollup_energy(data["site"]["num"], period["ly_s_t"], period["ly_e_t"]) if rollup_db else None
+    m.update(power_metrics(energy_dict['totalActiveEnergyConsumed'], data["last_energy_dict"]['totalActiveEnergyConsumed'], last_year_energy))
+    m.update(demand_metrics(energy_dict, data["last_energy_dict"]))
+    return m
+
+def write_site_outputs(data, m, plot_pool=None):
+    '''
+    Print and write the text report, store the metrics and write the correlation matrices of one site.
+    When a plot_pool is given, the site's charts are rendered in it in the background.
+    '''
+    site = data["site"]
+    period = data["period"]
+    site_data = data["site_data"]
+    # The charts need every metric of the trends and their histograms.
+    has_trends = site_data is not None and site_data.has(get_metric_channels(["pf", "thd", "tdd", "nvu", "niu", "gnd"], rules=False))
+    prefix = f"{site['acct_name']} - {period['report_month_yr']}"
+
+    report_strings = build_report_strings(site, period, m)
+    for s in report_strings:
+        print(s)
+
+    filename = f"{prefix}.txt"
+    with open(filename, "w") as file:
+        file.write("".join(report_strings))
+
+    store_metrics(site["num"], site['acct_name'], period, m)
+
+    if has_trends and correlation_methods:
+        names = [name for name in channel_registry if name in site_data]
+        matrices = correlation_matrices(site_data.to_frame(names), names, correlation_methods, correlation_sample)
+        for method, matrix in matrices.items():
+            matrix.round(4).to_csv(f"{prefix} - {method} correlation.csv")
+
+    #######################################################################
+    #  PLOT
+    #
+    #######################################################################
+    if render_plots and plot_pool is not None and has_trends:
+        charts = build_site_charts(site['acct_name'], site_data, m)
+        plot_pool.submit(render_site_plots, prefix, charts, site["num"], period["period_start"]).add_done_callback(report_plot_errors)
+
+def write_site_report(num, tz, plot_pool=None, dates=None):
+    '''
+    Download, analyze and write the monthly report of measurement point num (UTC offset tz).
+    Returns the computed metrics.
+    '''
+    data = fetch_site_data(num, tz, dates)
+    m = compute_site_metrics(data)
+    write_site_outputs(data, m, plot_pool)
+    return m
+
+def open_job_ledger(path=None):
+    '''
+    Open (and create if needed) the job ledger: one row per measurement point and report period with
+    its status (running, failed, done), last completed stage, attempts and the last error.
+    A second table keeps one row per trend request sent by a site job (see record_trend_request).
+    '''
+    con = sqlite3.connect(path or job_ledger)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "site TEXT, period_start TEXT, status TEXT, stage TEXT, attempts INTEGER, error TEXT, updated TEXT, "
+        "PRIMARY KEY (site, period_start))"
+        )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS trend_requests ("
+        "site TEXT, start TEXT, end TEXT, columns INTEGER, minutes REAL, status INTEGER, bytes INTEGER, seconds REAL, "
+        "updated TEXT)"
+        )
+    return con
+
+def get_job(num, period_start):
+    '''
+    Ledger row of a site and period as a dict, or None when it has never run.
+    '''
+    with closing(open_job_ledger()) as con:
+        con.row_factory = sqlite3.Row
+        row = con.execute("SELECT * FROM jobs WHERE site = ? AND period_start = ?", (num, period_start)).fetchone()
+    return dict(row) if row else None
+
+def set_job(num, period_start, status, stage, error=None, attempt=False):
+    '''
+    Record the status and last completed stage of a site and period. attempt=True counts a new attempt.
+    '''
+    with closing(open_job_ledger()) as con:
+        with con:
+            con.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (site, period_start) DO UPDATE SET "
+                "status = excluded.status, stage = excluded.stage, attempts = attempts + excluded.attempts, "
+                "error = excluded.error, updated = excluded.updated",
+                (num, period_start, status, stage, int(attempt), error, datetime.now(timezone.utc).isoformat()),
+                )
+
+def checkpoint_path(num, period_start, stage):
+    return os.path.join(checkpoint_dir, f"{num}_{period_start}", f"{stage}.pkl")
+
+def save_checkpoint(num, period_start, stage, obj):
+    path = checkpoint_path(num, period_start, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    set_job(num, period_start, "running", stage)
+
+def load_checkpoint(num, period_start, stage):
+    path = checkpoint_path(num, period_start, stage)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def run_site_job(num, tz, dates=None, plot_pool=None, months=None):
+    '''
+    Run the report of one site and period through the fetch, metrics and report stages, checkpointing
+    after each one. Resumes after the last completed stage recorded in the job ledger.
+    A failure is recorded in the ledger instead of raised. Returns the metrics, or None when the site
+    failed or was already done.
+    With a months dict (see fetch_site_data), the downloaded month is added to it for the next report.
+    '''
+    dates = dates or get_report_dates()
+    period_start = dates["start_time"]
+    job = get_job(num, period_start)
+    if job and job["status"] == "done" and not rerun_completed:
+        print(f"Measurement point {num} {dates['report_month_yr']} already done, skipping.")
+        return None
+
+    stage = job["stage"] if job and job["status"] != "done" else None
+    set_job(num, period_start, "running", stage, attempt=True)
+    trend_request_state.rows = []
+    try:
+        data = load_checkpoint(num, period_start, "fetch") if stage in ("fetch", "metrics") else None
+        if data is None:
+            with profiled(num, "fetch", period_start):
+                data = fetch_site_data(num, tz, dates, months)
+            save_checkpoint(num, period_start, "fetch", data)
+            stage = "fetch"
+        if months is not None:
+            months[period_start] = {"site_data": data["site_data"], "energy_dict": data["energy_dict"]}
+
+        m = load_checkpoint(num, period_start, "metrics") if stage == "metrics" else None
+        if m is None:
+            with profiled(num, "metrics", period_start):
+                m = compute_site_metrics(data)
+            save_checkpoint(num, period_start, "metrics", m)
+            stage = "metrics"
+
+        with profiled(num, "render", period_start):
+            write_site_outputs(data, m, plot_pool)
+    except Exception:
+        set_job(num, period_start, "failed", stage, traceback.format_exc())
+        print(f"Measurement point {num} {dates['report_month_yr']} failed (last completed stage: {stage}):")
+        print(traceback.format_exc())
+        return None
+    finally:
+        store_trend_requests(trend_request_state.rows)
+        trend_request_state.rows = None
+
+    set_job(num, period_start, "done", "report")
+    shutil.rmtree(os.path.dirname(checkpoint_path(num, period_start, "report")), ignore_errors=True)
+    return m
+
+def run_fleet(sites, dates=None, plot_pool=None):
+    '''
+    Run every site of sites ({measurement point id: UTC offset}) for the report dates, isolating failures.
+    fleet_workers sites run at the same time; the API rate limits are shared between them.
+    Returns {measurement point id: metrics} of the sites completed in this run.
+    '''
+    dates = dates or get_report_dates()
+    results = {}
+    failed = []
+    with ThreadPoolExecutor(fleet_workers) as pool:
+        jobs = {num: pool.submit(in_account(run_site_job), num, tz, dates, plot_pool) for num, tz in sites.items()}
+    for num, job in jobs.items():
+        m = job.result()
+        if m is not None:
+            results[num] = m
+        elif get_job(num, dates["start_time"])["status"] == "failed":
+            failed.append(num)
+
+    print(f"{dates['report_month_yr']}: {len(results)} sites completed, {len(failed)} failed {failed}")
+    return results
+
+def get_backfill_dates(first, last):
+    '''
+    Report dates (see get_report_dates) of every month from first to last ("YYYY-MM", both included).
+    '''
+    month = datetime.strptime(first, '%Y-%m')
+    last = datetime.strptime(last, '%Y-%m')
+    backfill_dates = []
+    while month <= last:
+        backfill_dates.append(get_report_dates(month))
+        month += relativedelta(months=1)
+    return backfill_dates
+
+def run_site_backfill(num, tz, backfill_dates, plot_pool=None):
+    '''
+    Run the reports of one site for each of backfill_dates in order, passing every downloaded month
+    on to the next report as its previous month. Returns {period start: metrics} of the completed reports.
+    '''
+    months = {}
+    results = {}
+    for dates in backfill_dates:
+        m = run_site_job(num, tz, dates, plot_pool, months)
+        if m is not None:
+            results[dates["start_time"]] = m
+        # Only the month just run is needed by the next report.
+        for start in [k for k in months if k != dates["start_time"]]:
+            del months[start]
+    return results
+
+def run_backfill(sites, first=None, last=None, plot_pool=None):
+    '''
+    Write the reports of every site of sites for every month from first to last (default backfill_start
+    and backfill_end). fleet_workers sites run at the same time, each going through its months in order.
+    Returns {measurement point id: {period start: metrics}} of the reports completed in this run.
+    '''
+    backfill_dates = get_backfill_dates(first or backfill_start, last or backfill_end)
+    with ThreadPoolExecutor(fleet_workers) as pool:
+        jobs = {num: pool.submit(in_account(run_site_backfill), num, tz, backfill_dates, plot_pool) for num, tz in sites.items()}
+    results = {num: job.result() for num, job in jobs.items()}
+
+    for dates in backfill_dates:
+        completed = [num for num in results if dates["start_time"] in results[num]]
+        failed = [num for num in sites if get_job(num, dates["start_time"])["status"] == "failed"]
+        print(f"{dates['report_month_yr']}: {len(completed)} sites completed, {len(failed)} failed {failed}")
+    return results
+
+def plan_site_requests(num, tz, dates, prev_downloaded=False):
+    '''
+    API calls fetch_site_data makes for the report of measurement point num (UTC offset tz) for the report dates,
+    as dicts of site, report, endpoint, request, start, end, columns and minutes.
+    With prev_downloaded, the previous month is reused from the report before it (backfill).
+    With fast_report every current month trend is counted, as the aggregates are only known at run time.
+    Energy calls are counted too, although they are skipped when the power trend covers the period (see local_energy_data).
+    Periods longer than stream_days are counted in chunks, without the previous period's trends (see section 22).
+    '''
+    period = get_report_period(tz, dates)
+    streamed = period["report_timespan"] > timedelta(days=stream_days)
+
+    def call(endpoint, request, start=None, end=None, columns=()):
+        minutes = (pd.Timestamp(end) - pd.Timestamp(start)) / pd.Timedelta(1, 'minutes') if columns else 0
+        return {"site": num, "report": dates["report_month_yr"], "endpoint": endpoint, "request": request,
+                "start": start, "end": end, "columns": len(columns), "minutes": minutes}
+
+    s_t, e_t, pr_s_t = period["s_t"], period["e_t"], period["pr_s_t"]
+    trend_requests = get_trend_requests(get_metric_channels([k for group in metric_groups for k in group] + ["power"]))
+    calls = [
+        call("measurementPoint", "measurement point"),
+        call("powerQualityMeasures", "power quality measures", s_t, e_t),
+        call("parameters", "parameters"),
+        ]
+    chunks = get_stream_chunks(s_t, e_t) if streamed else [(s_t, e_t)]
+    for start, end in chunks:
+        calls += [call("trends", f"trends {i + 1}/{len(trend_requests)}", start, end, columns) for i, columns in enumerate(trend_requests)]
+    calls.append(call("energy", "energy", s_t, e_t))
+    if not prev_downloaded:
+        if not fast_report and not streamed:
+            calls += [call("trends", f"previous trends {i + 1}/{len(trend_requests)}", pr_s_t, s_t, columns) for i, columns in enumerate(trend_requests)]
+        calls.append(call("energy", "previous energy", *[v for k, v in period["prev_period_params"]]))
+    return calls
+
+def get_request_estimates():
+    '''
+    Bytes per value, seconds per row and the sizes ((columns, minutes) list per site) of the trend requests
+    that returned a 504, from the trend requests recorded in the job ledger.
+    '''
+    with closing(open_job_ledger()) as con:
+        ok = con.execute(
+            "SELECT SUM(bytes), SUM(minutes * (columns + 1)), SUM(seconds), SUM(minutes) "
+            "FROM trend_requests WHERE status = 200"
+            ).fetchone()
+        timeouts = con.execute("SELECT site, columns, minutes FROM trend_requests WHERE status = 504").fetchall()
+
+    bytes_per_value = ok[0] / ok[1] if ok[1] else plan_bytes_per_value
+    seconds_per_row = ok[2] / ok[3] if ok[3] else plan_seconds_per_row
+    failed_sizes = {}
+    for site, columns, minutes in timeouts:
+        failed_sizes.setdefault(site, []).append((columns, minutes))
+    return bytes_per_value, seconds_per_row, failed_sizes
+
+def plan_requests(sites, report_dates, path=None):
+    '''
+    Dry run: the API calls a run of sites ({measurement point id: UTC offset}) over report_dates (list of
+    get_report_dates) would make, with estimated rows, bytes and seconds and the flags of trend requests likely
+    to be rejected. Nothing is sent to the API. Prints a summary, writes the plan to path (default plan_file)
+    and returns it.
+    '''
+    calls = []
+    for num, tz in sites.items():
+        downloaded = set()
+        for dates in report_dates:
+            period_start = dates["start_time"]
+            job = get_job(num, period_start)
+            if job and job["status"] == "done" and not rerun_completed:
+                continue
+            if job and job["status"] != "done" and os.path.exists(checkpoint_path(num, period_start, "fetch")):
+                downloaded.add(period_start)
+                continue
+            calls += plan_site_requests(num, tz, dates, dates["prev_start_time"] in downloaded)
+            downloaded.add(period_start)
+
+    plan = pd.DataFrame(calls, columns=["site", "report", "endpoint", "request", "start", "end", "columns", "minutes"])
+    bytes_per_value, seconds_per_row, failed_sizes = get_request_estimates()
+    trends = plan["endpoint"] == "trends"
+    plan["rows"] = plan["minutes"].where(trends, 0).astype(int)
+    plan["est_bytes"] = (plan["rows"] * (plan["columns"] + 1) * bytes_per_value).round().astype(int)
+    plan["est_seconds"] = (plan["rows"] * seconds_per_row).where(trends, plan_seconds_per_call).round(2)
+
+    def flag(row):
+        flags = []
+        if row["columns"] > trend_max_columns:
+            flags.append(f"over {trend_max_columns} columns")
+        if row["rows"] > trend_max_rows:
+            flags.append(f"over {trend_max_rows} rows")
+        if any(row["columns"] >= c and row["minutes"] >= n for c, n in failed_sizes.get(str(row["site"]), [])):
+            flags.append("504 before at this size")
+        return "; ".join(flags)
+    plan["flag"] = plan[trends].apply(flag, axis=1) if trends.any() else ""
+    plan["flag"] = plan["flag"].fillna("")
+    plan.to_csv(path or plan_file, index=False)
+
+    # Each endpoint is bounded by its concurrency limit and its token bucket; the endpoints run side by side.
+    duration = 0
+    for endpoint, group in plan.groupby("endpoint"):
+        rate = api_rate_limits.get(endpoint, api_rate_limits["default"])[0]
+        concurrency = api_concurrency.get(endpoint, api_concurrency["default"])[0]
+        duration = max(duration, group["est_seconds"].sum() / concurrency, len(group) / rate)
+
+    print(plan.groupby("endpoint").agg(
+        calls=("request", "count"), rows=("rows", "sum"), est_bytes=("est_bytes", "sum"), est_seconds=("est_seconds", "sum"),
+        ).to_string())
+    print(f"{len(plan)} API calls ({trends.sum()} trend requests), about {plan['rows'].sum()} rows and "
+          f"{plan['est_bytes'].sum() / 1e6:.1f} MB, expected duration {pd.Timedelta(seconds=round(duration))}")
+    flagged = plan[plan["flag"] != ""]
+    if len(flagged):
+        print(f"{len(flagged)} trend requests flagged:")
+        print(flagged[["site", "report", "request", "columns", "rows", "flag"]].to_string(index=False))
+    return plan
+
+def benchmark_trend_formats(num, tz, dates=None, formats=None, repeats=3):
+    '''
+    Download the current month trend of measurement point num in each output format and report the
+    bytes on the wire (compressed), the decoded body size, download time and parse time (best of repeats).
+    Returns the results as a dataframe.
+    '''
+    mp_info = require(get_mp(num), f"measurement point {num}")
+    period = get_report_period(tz, dates)
+    names = get_trend_requests(get_metric_channels([k for group in metric_groups for k in group] + ["power"]))[0]
+    rows = []
+    for o in formats or trend_formats:
+        j = dict(get_trend_json(period["s_t"], period["e_t"], [channel_registry[name]["firmware"] for name in names]), output=o)
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            response = require(post_trend_request(num, j), f"{o} trends of {num}")
+            downloaded = time.perf_counter()
+            df = parse_trend_response(response.content, o, mp_info['timezone'], names)
+            parsed = time.perf_counter()
+            result = {
+                "format": o,
+                "encoding": response.headers.get('Content-Encoding', 'identity'),
+                "wire_bytes": response.raw.tell() if response.raw is not None else len(response.content),
+                "body_bytes": len(response.content),
+                "rows": len(df),
+                "download_s": round(downloaded - start, 3),
+                "parse_s": round(parsed - downloaded, 3),
+                }
+            if best is None or result["download_s"] + result["parse_s"] < best["download_s"] + best["parse_s"]:
+                best = result
+        rows.append(best)
+
+    results = pd.DataFrame(rows).set_index("format")
+    print(results.to_string())
+    return results
+
+def metrics_json(m):
+    '''
+    The metrics m in JSON types, converted the way store_metrics stores them: durations in minutes,
+    numbers as floats (NaN as null), histograms as lists of bin counts and anything else as a string.
+    '''
+    out = {}
+    for metric, v in m.items():
+        if metric.endswith("_hist"):
+            out[metric] = [int(c) for c in v]
+        elif isinstance(v, pd.Timedelta):
+            out[metric] = v / pd.Timedelta(1, 'minutes')
+        elif isinstance(v, (int, float, np.number)) and not isinstance(v, bool):
+            out[metric] = None if pd.isna(v) else float(v)
+        else:
+            out[metric] = None if v is None else str(v)
+    return out
+
+class MetricsCache:
+    '''
+    Least recently used cache of up to size results. get(key, compute) returns the cached result of key, or calls
+    compute() once for it: callers asking for a key that is being computed wait for that call instead of repeating it.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.results = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        '''
+        Returns (result, hit), hit is True when the result was already cached.
+        '''
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key], True
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pending[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return future.result(), False
+
+        try:
+            result = compute()
+        except BaseException as e:
+            # Failures are not cached, the next query tries again.
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.pending[key]
+            self.results[key] = result
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+        future.set_result(result)
+        return result, False
+
+def get_query_dates(query):
+    '''
+    Report dates (see get_report_dates) of a metrics query: month=YYYY-MM, or start=YYYY-MM-DD and end=YYYY-MM-DD
+    (compared with the month before start).
+    '''
+    if "month" in query:
+        return get_report_dates(datetime.strptime(query["month"], '%Y-%m'))
+    start = datetime.strptime(query["start"], '%Y-%m-%d')
+    end = datetime.strptime(query["end"], '%Y-%m-%d')
+    if end <= start:
+        raise ValueError("end must be after start")
+    return {
+        "prev_start_time": (start - relativedelta(months=1)).strftime('%Y-%m-%d'),
+        "start_time": start.strftime('%Y-%m-%d'),
+        "end_time": end.strftime('%Y-%m-%d'),
+        "report_month_yr": f"{start:%Y-%m-%d} to {end:%Y-%m-%d}",
+        }
+
+def query_site_metrics(num, tz, dates):
+    '''
+    Metrics of measurement point num (UTC offset tz) for the report dates as JSON types (see metrics_json),
+    from the results store when the period is stored, otherwise computed and stored.
+    '''
+    m = load_site_metrics(num, dates["start_time"], dates["end_time"])
+    source = "store"
+    if m is None:
+        data = fetch_site_data(num, tz, dates)
+        m = compute_site_metrics(data)
+        store_metrics(num, data["site"]["acct_name"], data["period"], m)
+        source = "computed"
+    return {
+        "site": num,
+        "period_start": dates["start_time"],
+        "period_end": dates["end_time"],
+        "source": source,
+        "metrics": metrics_json(m),
+        }
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    GET /metrics and /sites of the metrics service (see serve_metrics).
+    '''
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == "/sites":
+            self.send_json(200, self.server.sites)
+        elif url.path == "/metrics":
+            self.get_metrics(query)
+        else:
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def get_metrics(self, query):
+        started = time.perf_counter()
+        num = query.get("site")
+        if num not in self.server.sites:
+            self.send_json(404, {"error": f"Unknown measurement point {num}"})
+            return
+        try:
+            dates = get_query_dates(query)
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {"error": f"Give month=YYYY-MM or start=YYYY-MM-DD and end=YYYY-MM-DD ({e})"})
+            return
+
+        key = (num, dates["prev_start_time"], dates["start_time"], dates["end_time"])
+        account = self.server.site_accounts.get(num) or get_account()
+
+        def compute():
+            with using_account(account):
+                return query_site_metrics(num, self.server.sites[num], dates)
+
+        try:
+            result, hit = self.server.cache.get(key, compute)
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+
+        result = dict(result, source="cache" if hit else result["source"])
+        if "metrics" in query:
+            names = query["metrics"].split(",")
+            result["metrics"] = {k: v for k, v in result["metrics"].items() if k in names}
+        result["milliseconds"] = round(1000 * (time.perf_counter() - started), 3)
+        self.send_json(200, result)
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+def serve_metrics(sites, host=None, port=None, cache_size=None, site_accounts=None):
+    '''
+    Serve the metrics of sites ({measurement point id: UTC offset}) over HTTP until interrupted (see section 17).
+    Every query is answered in its own thread; computing a site goes through the API rate limits of its account,
+    from site_accounts ({measurement point id: ApiAccount}) or the default one.
+    '''
+    server = ThreadingHTTPServer((host or serve_host, port or serve_port), MetricsHandler)
+    server.sites = sites
+    server.site_accounts = site_accounts or {}
+    server.cache = MetricsCache(cache_size or serve_cache_size)
+    print(f"Serving metrics of {len(sites)} sites on http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# Synthetic sites of the regression run: tz as entered in mps and timezone as the measurement point reports it.
+# Their months are generated from the seed, minutes in gaps (start minute, length) are left out, and gaps in
+# the report month make the energy come from the archived energy endpoint response.
+regression_fixtures = {
+    "wye-los-angeles": {
+        "tz": "America/Los_Angeles", "timezone": "America/Los_Angeles", "month": "2021-05", "power_config": "Wye", "nom_pn_voltage": 277,
+        "seed": 1, "gaps": [],
+        },
+    "wye-toronto-gaps": {
+        "tz": "America/Toronto", "timezone": "America/Toronto", "month": "2021-03", "power_config": "Wye", "nom_pn_voltage": 347,
+        "seed": 2, "gaps": [(1000, 100), (20000, 1440)],
+        },
+    "delta-offset-leap": {
+        "tz": "6", "timezone": "America/Chicago", "month": "2020-03", "power_config": "Delta", "nom_pn_voltage": 120,
+        "seed": 3, "gaps": [(5, 30)],
+        },
+    }
+
+def make_fixture_data(fixture, s_t, e_t):
+    '''
+    SiteData of every trend and voltage channel of a regression fixture from s_t to e_t, as the API would return it.
+    '''
+    date_time = pd.date_range(s_t[:19], e_t[:19], freq="1min", inclusive="left", tz="UTC")
+    n = len(date_time)
+    rng = np.random.default_rng([fixture["seed"], int(date_time[0].timestamp())])
+    t = np.arange(n)
+    load = 1 + 0.6 * np.sin(2 * np.pi * t / 1440)
+    nom = fixture["nom_pn_voltage"]
+    channels = {
+        "L1_curr_avg": 100 * load + rng.normal(0, 2, n),
+        "L2_curr_avg": 95 * load + rng.normal(0, 2, n),
+        "L3_curr_avg": 105 * load + rng.normal(0, 2, n),
+        "gnd_curr_avg": np.abs(rng.normal(0.05, 0.05, n)),
+        "tot_activ_pwr_avg": 50000 * load + rng.normal(0, 500, n),
+        "tot_pf_avg": np.clip(0.93 + 0.04 * np.sin(2 * np.pi * t / 700) + rng.normal(0, 0.005, n), 0, 1),
+        "tot_Pst_avg": np.abs(rng.normal(0.5, 0.4, n)),
+        "thd_avg": np.abs(rng.normal(3, 1.5, n)),
+        "tdd_avg": np.abs(rng.normal(15, 8, n)),
+        "neg_i_unbal": np.abs(rng.normal(20, 20, n)),
+        "neg_v_unbal": np.abs(rng.normal(1, 0.6, n)),
+        "L1_v_avg": nom * (1 + 0.02 * np.sin(2 * np.pi * t / 300) + rng.normal(0, 0.005, n)),
+        "L2_v_avg": nom * (1 + 0.04 * np.sin(2 * np.pi * t / 500) + rng.normal(0, 0.005, n)),
+        "L3_v_avg": nom * (1 + 0.07 * np.sin(2 * np.pi * t / 900) + rng.normal(0, 0.005, n)),
+        }
+    keep = np.ones(n, dtype=bool)
+    for start, minutes in fixture["gaps"]:
+        keep[start:start + minutes] = False
+
+    names = [name for name in channel_registry if name in channels]
+    values = np.array([channels[name][keep] for name in names])
+    return SiteData(pd.Series(date_time[keep].tz_convert(fixture["timezone"]), name="date_time"), values, names, fixture["nom_pn_voltage"])
+
+def write_fixture_archive(name, fixture):
+    '''
+    Archive the report month and previous month of a regression fixture (under archive_dir) with the API responses
+    an offline report reads. Returns the fixture's report dates.
+    '''
+    dates = get_report_dates(datetime.strptime(fixture["month"], '%Y-%m'))
+    period = get_report_period(fixture["tz"], dates)
+    responses = {
+        "measurement_point": {"mpId": name, "accountName": "Regression ", "timezone": fixture["timezone"]},
+        "parameters": {"content": {
+            "powerConfiguration": {"defaultValue": "Wye", "value": fixture["power_config"]},
+            "nominalPhaseToPhaseVoltage": {"defaultValue": 480, "value": str(round(fixture["nom_pn_voltage"] * 3 ** 0.5))},
+            "nominalPhaseToNeutralVoltage": {"defaultValue": 277, "value": str(fixture["nom_pn_voltage"])},
+            }},
+        }
+    for response, body in responses.items():
+        os.makedirs(archive_path(name), exist_ok=True)
+        with open(os.path.join(archive_path(name), f"{response}.json"), "w") as f:
+            json.dump(body, f)
+
+    for s_t, e_t in ((period["pr_s_t"], period["s_t"]), (period["s_t"], period["e_t"])):
+        site_data = make_fixture_data(fixture, s_t, e_t)
+        save_archive(name, s_t, e_t, site_data)
+        # What the energy endpoint would answer: the integral of the minutes that were recorded.
+        energy = {"totalActiveEnergyConsumed": round(float(np.sum(site_data["tot_activ_pwr_avg"])) / 60000, 3)}
+        with open(os.path.join(archive_path(name, s_t, e_t), "energy.json"), "w") as f:
+            json.dump(energy, f)
+    return dates
+
+def run_stage(stage, call, timings):
+    '''
+    Run one stage of a regression fixture twice: timed, then under tracemalloc for its peak memory.
+    Adds (seconds, MiB) to timings and returns the result of the timed run.
+    '''
+    started = time.perf_counter()
+    result = call()
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    try:
+        call()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+    timings[stage] = (seconds, peak)
+    return result
+
+def compare_metrics(expected, actual, tolerance):
+    '''
+    Differences between golden and computed metrics (both as returned by metrics_json), one message each.
+    '''
+    differences = []
+    for metric in sorted(set(expected) | set(actual)):
+        if metric not in actual:
+            differences.append(f"{metric} missing")
+        elif metric not in expected:
+            differences.append(f"{metric} not in the golden file")
+        else:
+            e, a = expected[metric], actual[metric]
+            if isinstance(e, float) and isinstance(a, float):
+                same = e == a or (np.isnan(e) and np.isnan(a)) or abs(a - e) <= tolerance * max(abs(e), abs(a))
+            else:
+                same = e == a
+            if not same:
+                differences.append(f"{metric}: expected {e}, got {a}")
+    return differences
+
+def compare_streamed(data, m, chunk_minutes=1440):
+    '''
+    Differences between the report period metrics computed in memory (m, from the data of fetch_site_data) and by a
+    MetricsAccumulator given the same minute data chunk_minutes rows at a time, one message each.
+    The histogram quantiles are checked against the exact ones, within one bin width.
+    Skipped (no differences) when a qualifying_load rule needs the whole period, as the metrics cannot be streamed then.
+    '''
+    if get_period_load_rules():
+        print(f"Streamed metrics not compared: the qualifying load rules {get_period_load_rules()} cannot be streamed")
+        return []
+    site_data = data["site_data"]
+    period = data["period"]
+    accumulator = MetricsAccumulator(period["s_t"], period["e_t"], site_data.channels, data["site"]["nom_pn_voltage"])
+    for first in range(0, len(site_data), chunk_minutes):
+        accumulator.add(site_data.slice(first, first + chunk_minutes))
+    streamed = metrics_json(accumulator.metrics())
+    expected = {k: v for k, v in metrics_json(m).items() if k in streamed}
+    differences = [f"streamed {d}" for d in compare_metrics(expected, {k: streamed[k] for k in expected}, regression_tolerance)]
+
+    if data["energy_dict"].get("source") == "trend":
+        differences += [f"streamed energy {d}" for d in compare_metrics(data["energy_dict"], accumulator.energy_data() or {}, regression_tolerance)]
+    for name in accumulator.histograms:
+        exact = np.nanpercentile(site_data.view(name), 95)
+        low, high, width = histogram_bins[name]
+        if low <= exact <= high and not abs(streamed[f"{name}_p95"] - exact) <= width:
+            differences.append(f"streamed {name}_p95 {streamed[f'{name}_p95']} is not within {width} of {exact}")
+    return differences
+
+def compare_rollups(data, m, path):
+    '''
+    Differences between the report period metrics computed in memory (m, from the data of fetch_site_data) and the
+    same figures summed from the rollups of its minute data (stored in the rollup store at path), one message each.
+    Only meaningful without qualifying_load rules, which the rollups do not apply.
+    '''
+    site_data = data["site_data"]
+    period = data["period"]
+    num = data["site"]["num"]
+    store_rollups(num, str(site_data.date_time.dt.tz), period["s_t"], period["e_t"], site_data, path)
+    r = {name: query_rollups(num, name, period["s_t"], period["e_t"], path) for name in rollup_thresholds}
+    missing = {name: r[name]["missing"] for name in r if r[name]["missing"]}
+    if missing:
+        return [f"rollups are missing {missing}"]
+
+    minute = pd.Timedelta(1, 'minutes')
+    expected = {
+        "this_month_pf_result_time": m["this_month_pf_result_time"] / minute,
+        "thd_mask_time": m["thd_mask_time"] / minute,
+        "tdd_mask_time": m["tdd_mask_time"] / minute,
+        "nvu_mask_time": m["nvu_mask_time"] / minute,
+        "gnd_mask1_time": m["gnd_mask1_time"] / minute,
+        "pst_time": m["pst_time"] / minute,
+        "L3_fluct_time": m["L3_fluct_time"] / minute,
+        "tdd_trend_max": float(m["tdd_trend_max"]),
+        "gnd_trend_max": float(m["gnd_trend_max"]),
+        "thd_trend_avg": float(m["thd_trend_avg"]),
+        }
+    actual = {
+        "this_month_pf_result_time": float(r["tot_pf_avg"]["exceedances"]["< 0.9"]),
+        "thd_mask_time": float(r["thd_avg"]["exceedances"][">= 5"]),
+        "tdd_mask_time": float(r["tdd_avg"]["exceedances"][">= 25"]),
+        "nvu_mask_time": float(r["neg_v_unbal"]["exceedances"][">= 2"]),
+        "gnd_mask1_time": float(r["gnd_curr_avg"]["exceedances"][">= 0.1"]),
+        "pst_time": float(r["tot_Pst_avg"]["exceedances"][">= 1"]),
+        "L3_fluct_time": float(r["L3_v_avg"]["exceedances"]["outside 0.07"]),
+        "tdd_trend_max": float(r["tdd_avg"]["high"]),
+        "gnd_trend_max": round(float(r["gnd_curr_avg"]["high"]), 2),
+        "thd_trend_avg": round(r["thd_avg"]["total"] / r["thd_avg"]["samples"], 2),
+        }
+    if data["energy_dict"].get("source") == "trend":
+        expected["energy"] = float(data["energy_dict"]["totalActiveEnergyConsumed"])
+        actual["energy"] = rollup_energy(num, period["s_t"], period["e_t"], path)
+    return [f"rollup {d}" for d in compare_metrics(expected, actual, regression_tolerance)]
+
+def run_regression(fixtures=None, update=None):
+    '''
+    Run the report pipeline offline on the regression fixtures and compare the metrics and report text with the
+    golden files, and each stage with regression_budgets. The metrics are also streamed and rolled up (see
+    compare_streamed and compare_rollups).
+    With update (default regression_update) the golden files are rewritten instead. Returns the number of fixtures that failed.
+    The settings of regression_settings, the archive and the rollup store are pinned for the run.
+    '''
+    fixtures = fixtures or regression_fixtures
+    update = regression_update if update is None else update
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        pinned = dict(regression_settings, archive_dir=os.path.join(tmp, "archive"), offline=True, rollup_db=os.path.join(tmp, "rollups.db"))
+        settings = {name: globals()[name] for name in pinned}
+        globals().update(pinned)
+        try:
+            for name, fixture in fixtures.items():
+                dates = write_fixture_archive(name, fixture)
+                timings = {}
+                data = run_stage("fetch", lambda: fetch_site_data(name, fixture["tz"], dates), timings)
+                m = run_stage("metrics", lambda: compute_site_metrics(data), timings)
+                report = run_stage("render", lambda: "".join(build_report_strings(data["site"], data["period"], m)), timings)
+                metrics = metrics_json(m)
+
+                golden = os.path.join(golden_dir, name)
+                if update:
+                    os.makedirs(golden_dir, exist_ok=True)
+                    with open(golden + ".json", "w") as f:
+                        json.dump(metrics, f, indent=1, sort_keys=True)
+                        f.write(newline)
+                    with open(golden + ".txt", "w") as f:
+                        f.write(report)
+                    print(f"{name}: golden files written")
+                    continue
+
+                problems = []
+                if not os.path.exists(golden + ".json"):
+                    problems.append("no golden files, run with regression_update = True")
+                else:
+                    with open(golden + ".json") as f:
+                        problems += compare_metrics(json.load(f), metrics, regression_tolerance)
+                    with open(golden + ".txt") as f:
+                        expected = f.read()
+                    if report != expected:
+                        diff = difflib.unified_diff(expected.splitlines(), report.splitlines(), "golden", "report", lineterm="")
+                        problems.append("report text differs:" + newline + newline.join(diff))
+                problems += compare_streamed(data, m)
+                problems += compare_rollups(data, m, rollup_db)
+                for stage, (seconds, peak) in timings.items():
+                    max_seconds, max_mib = regression_budgets[stage]
+                    if seconds > max_seconds:
+                        problems.append(f"{stage} took {seconds:.3f} s, budget {max_seconds} s")
+                    if peak > max_mib:
+                        problems.append(f"{stage} peaked at {peak:.1f} MiB, budget {max_mib} MiB")
+
+                stages = ", ".join(f"{stage} {seconds:.3f} s {peak:.1f} MiB" for stage, (seconds, peak) in timings.items())
+                print(f"{name}: {'FAIL' if problems else 'ok'} ({stages})")
+                for problem in problems:
+                    print(f"    {problem}")
+                if problems:
+                    failed.append(name)
+        finally:
+            globals().update(settings)
+
+    if not update:
+        print(f"Regression: {len(fixtures) - len(failed)} of {len(fixtures)} fixtures match {failed}")
+    return len(failed)
+
+def run_schedule(sites, plot_pool=None):
+    '''
+    Run the monthly batch of sites automatically. The batch of a month starts once it has closed
+    (schedule_delay_hours after midnight UTC on the next 1st), is resumed if the script was restarted,
+    and its failed sites are retried on every wake up (at most hourly) until the next month closes.
+    '''
+    while True:
+        now = datetime.now(timezone.utc)
+        this_month = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
+        due = this_month + timedelta(hours=schedule_delay_hours)
+        if now >= due:
+            report_month = this_month - relativedelta(months=1)
+            due = this_month + relativedelta(months=1) + timedelta(hours=schedule_delay_hours)
+        else:
+            report_month = this_month - relativedelta(months=2)
+
+        run_fleet(sites, get_report_dates(report_month), plot_pool)
+        wait = (due - datetime.now(timezone.utc)).total_seconds()
+        print(f"Next monthly batch at {due.isoformat()}")
+        time.sleep(max(60, min(wait, 3600)))
+
+alert_lock = threading.Lock()
+
+def record_alert(event):
+    '''
+    Print an alert event and append it to alert_file as one JSON line.
+    '''
+    print(f"{event['time']} measurement point {event['site']}: {event['rule']} {event['state']}, "
+          f"{event['percent']}% of the last {alert_window} minutes {event['condition']}")
+    if alert_file:
+        with alert_lock, open(alert_file, "a") as f:
+            f.write(json.dumps(event) + newline)
+
+class AlertWindow:
+    '''
+    Sliding window of the last alert_window minutes of one alert rule of a site: the minutes received, whether each
+    was beyond the rule's threshold, and their running counts, so adding or expiring a minute costs O(1).
+    firing is True between the alert and the clear events of the rule.
+    '''
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.samples = deque()
+        self.exceeded = 0
+        self.firing = False
+
+    def add(self, slots, exceeded):
+        # slots: minutes since the epoch, increasing; exceeded: boolean array of the same length.
+        for slot, e in zip(slots.tolist(), exceeded.tolist()):
+            self.samples.append((slot, e))
+            self.exceeded += e
+
+    def expire(self, end):
+        # Drop the minutes before the window ending at minute end.
+        while self.samples and self.samples[0][0] < end - self.minutes:
+            self.exceeded -= self.samples.popleft()[1]
+
+    def percent(self):
+        return round(100 * self.exceeded / len(self.samples), 2) if self.samples else np.nan
+
+class SiteMonitor:
+    '''
+    Alerting state of one measurement point (UTC offset tz): the newest minute received and an AlertWindow per rule
+    of alert_rules. Every poll only downloads the minutes after the newest one received.
+    '''
+    def __init__(self, num, tz):
+        self.num = num
+        self.tz = tz
+        self.acct_tz = None
+        self.nom_pn_voltage = None
+        self.last_slot = None
+        self.windows = {rule: AlertWindow(alert_window) for rule in alert_rules}
+
+    def poll(self, now=None):
+        '''
+        Download the minutes since the last poll (the last alert_window minutes the first time) up to now (UTC),
+        slide the windows to now and return the alert events: "alert" when the percentage of a window's minutes
+        beyond the rule's threshold rises above its tolerance, "clear" when it falls back.
+        '''
+        minute = pd.Timedelta(1, 'minutes')
+        epoch = pd.Timestamp(0, tz="UTC")
+        now = pd.Timestamp(now or datetime.now(timezone.utc)).floor('min')
+        end = (now - epoch) // minute
+        if self.acct_tz is None:
+            self.acct_tz = require(get_mp(self.num), f"measurement point {self.num}")['timezone']
+            if any(op == "outside" for channel, op, value, tolerance in alert_rules.values()):
+                self.nom_pn_voltage = get_site_config(require(get_params(self.num), f"parameters of measurement point {self.num}"))[1]
+
+        first = end - alert_window if self.last_slot is None else self.last_slot + 1
+        if first < end:
+            s_t = (epoch + first * minute).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            e_t = now.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            names = [name for name in channel_registry if any(name == rule[0] for rule in alert_rules.values())]
+            dfs = []
+            for columns in get_trend_requests(names):
+                j = get_trend_json(s_t, e_t, [channel_registry[name]["firmware"] for name in columns])
+                dfs.append(require(post_trend_data(self.num, j, self.acct_tz, columns), f"trends {columns} of {self.num} from {s_t}"))
+            site_data = SiteData.from_frames(dfs, self.nom_pn_voltage)
+            if site_data is not None and len(site_data):
+                slots = ((pd.DatetimeIndex(site_data.date_time) - epoch) // minute).to_numpy()
+                rows = np.flatnonzero(slots >= first)
+                for rule, (channel, op, value, tolerance) in alert_rules.items():
+                    if channel not in site_data.channels:
+                        continue
+                    x = site_data.view(channel)[rows]
+                    valid = ~np.isnan(x)
+                    self.windows[rule].add(slots[rows][valid], rollup_operators[op](x[valid], value, self.nom_pn_voltage))
+                if len(rows):
+                    self.last_slot = int(slots[rows].max())
+
+        events = []
+        for rule, (channel, op, value, tolerance) in alert_rules.items():
+            window = self.windows[rule]
+            window.expire(end)
+            if len(window.samples) < alert_min_coverage * alert_window:
+                continue
+            percent = window.percent()
+            if (percent > tolerance) != window.firing:
+                window.firing = not window.firing
+                events.append({
+                    "site": self.num,
+                    "rule": rule,
+                    "state": "alert" if window.firing else "clear",
+                    "time": now.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    "percent": percent,
+                    "tolerance": tolerance,
+                    "condition": f"{channel} {op} {value}",
+                    })
+        return events
+
+def run_alerts(sites, polls=None):
+    '''
+    Poll every site of sites ({measurement point id: UTC offset}) every alert_interval seconds (polls times, or until
+    interrupted) with fleet_workers at a time, and record the alert events (see record_alert). A failed poll is
+    reported and retried on the next one without losing the site's windows.
+    '''
+    monitors = [SiteMonitor(num, tz) for num, tz in sites.items()]
+
+    def poll(monitor):
+        try:
+            return monitor.poll()
+        except Exception:
+            print(f"Measurement point {monitor.num} poll failed:")
+            print(traceback.format_exc())
+            return []
+
+    print(f"Alerting on {len(monitors)} measurement points every {alert_interval} s")
+    with ThreadPoolExecutor(fleet_workers) as pool:
+        while True:
+            started = time.monotonic()
+            for events in pool.map(in_account(poll), monitors):
+                for event in events:
+                    record_alert(event)
+            if polls is not None:
+                polls -= 1
+                if not polls:
+                    break
+            time.sleep(max(0, alert_interval - (time.monotonic() - started)))
+
+def run_sites(sites, plot_pool=None):
+    '''
+    Run run_mode (section 9), or the dry run, for sites ({measurement point id: UTC offset}) with the thread's account.
+    '''
+    if dry_run:
+        account = get_account()
+        path = plan_file if account is default_account else f"{account.name} - {plan_file}"
+        plan_requests(sites, get_backfill_dates(backfill_start, backfill_end) if run_mode == "backfill" else [get_report_dates()], path)
+    elif run_mode == "schedule":
+        run_schedule(sites, plot_pool)
+    elif run_mode == "backfill":
+        run_backfill(sites, plot_pool=plot_pool)
+    elif run_mode == "alert":
+        run_alerts(sites)
+    elif run_mode == "benchmark":
+        num, tz = next(iter(sites.items()))
+        benchmark_trend_formats(num, tz)
+    else:
+        run_fleet(sites, get_report_dates(), plot_pool)
+
+def get_account_sites(name, settings):
+    '''
+    ApiAccount and sites ({measurement point id: UTC offset}) of one entry of api_accounts.
+    '''
+    account = ApiAccount(name, settings["token"])
+    sites = settings.get("mps", {})
+    if settings.get("discover"):
+        with using_account(account):
+            sites = discover_measurement_points(discovery_accounts, discovery_status)
+    print(f"Account {name}: {len(sites)} measurement points")
+    return account, sites
+
+def run_accounts(run, accounts=None):
+    '''
+    Call run(sites) for every account of accounts (default api_accounts), account_workers accounts at a time,
+    with the API calls of each made with its own ApiAccount. A failed account is reported without stopping
+    the others. Returns {account name: result of run}.
+    '''
+    def run_account(name, settings):
+        account, sites = get_account_sites(name, settings)
+        with using_account(account):
+            return run(sites)
+
+    accounts = accounts or api_accounts
+    with ThreadPoolExecutor(account_workers) as pool:
+        jobs = {name: pool.submit(run_account, name, settings) for name, settings in accounts.items()}
+    results = {}
+    for name, job in jobs.items():
+        try:
+            results[name] = job.result()
+        except Exception:
+            print(f"Account {name} failed:")
+            print(traceback.format_exc())
+    return results
+
+def get_sites():
+    '''
+    Sites of the api_token of section 1: mps, or the discovered measurement points with discover_mps.
+    '''
+    if not discover_mps:
+        return mps
+    sites = discover_measurement_points(discovery_accounts, discovery_status)
+    print(f"Discovered {len(sites)} measurement points")
+    return sites
+
+if __name__ == '__main__':
+
+    # Plot workers are only started for the run modes that render reports.
+    renders_plots = render_plots and not dry_run and run_mode in ("report", "backfill", "schedule")
+    with ProcessPoolExecutor(plot_workers) if renders_plots else nullcontext() as plot_pool:
+        if run_mode == "regression" and not dry_run:
+            if run_regression():
+                raise SystemExit(1)
+        elif run_mode == "serve" and not dry_run:
+            sites, site_accounts = {}, {}
+            for name, settings in api_accounts.items():
+                account, account_sites = get_account_sites(name, settings)
+                sites.update(account_sites)
+                site_accounts.update(dict.fromkeys(account_sites, account))
+            serve_metrics(sites if api_accounts else get_sites(), site_accounts=site_accounts)
+        elif api_accounts:
+            run_accounts(lambda sites: run_sites(sites, plot_pool))
+        else:
+            run_sites(get_sites(), plot_pool)
+
+## Add export to tables, gifs, and to a document
+
+        # weekday frames for the CSV exports below (trend_df = site_data.to_frame(list(site_data.channels)), trend_df['weekday'] = trend_df['date_time'].dt.day_name())
+        # sun_df = trend_df[trend_df['weekday'] == 'Sunday']
+        # mon_df = trend_df[trend_df['weekday'] == 'Monday']
+        # tue_df = trend_df[trend_df['weekday'] == 'Tuesday']
+        # wed_df = trend_df[trend_df['weekday'] == 'Wednesday']
+        # thu_df = trend_df[trend_df['weekday'] == 'Thursday']
+        # fri_df = trend_df[trend_df['weekday'] == 'Friday']
+        # sat_df = trend_df[trend_df['weekday'] == 'Saturday']
+
+        # trend_csv = trend_df.to_csv(f"{acct_name}output.csv", index = True)
+        # sun_csv = sun_df.to_csv(f"{acct_name}_sun.csv", index = True)
+        # mon_csv = mon_df.to_csv(f"{acct_name}_mon.csv", index = True)
+        # tue_csv = tue_df.to_csv(f"{acct_name}_tue.csv", index = True)
+        # wed_csv = wed_df.to_csv(f"{acct_name}_wed.csv", index = True)
+        # thu_csv = thu_df.to_csv(f"{acct_name}_thu.csv", index = True)
+        # fri_csv = fri_df.to_csv(f"{acct_name}_fri.csv", index = True)
+        # sat_csv = sat_df.to_csv(f"{acct_name}_sat.csv", index = True)
+
+
+        # print("Description of trends dataframe: \n", trend_df.describe(), "\n")
 
 